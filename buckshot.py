@@ -8,9 +8,16 @@
 
 ### ACTUAL CODE NOW ###
 import sys
+import types
 import random
+import struct
+import hashlib
+
+from zobrist import StateHash, zobrist_key
+from events import ItemUsedEvent, ShotFiredEvent, SetEndedEvent, RoundEndedEvent, RunTruncatedEvent, print_event
 
 ## GLOBAL GAME SETTINGS ##
+# these are the defaults for RuleSet (see below).  the game itself only reads settings from the RuleSet it was given, so changing these after import has no effect on default_rules.
 
 live_token = True
 blank_token = False
@@ -42,7 +49,7 @@ def cigs_behavior(run, user, opposite):
     user.give_health(1)
 
 def medicine_behavior(run, user, opposite):
-    coin_flip = random.randint(0, 1) == 0
+    coin_flip = run.rng("medicine").randint(0, 1) == 0
     
     if coin_flip:
         user.give_health(2)
@@ -61,7 +68,7 @@ def medicine_behavior(run, user, opposite):
             raise RoundResetException()
 
 def magnifier_behavior(run, user, opposite):
-    user.known_sequence[0] = run.peek_next_shell()
+    user.reveal_shell(0, run.peek_next_shell())
 
 def inverter_behavior(run, user, opposite):
     run.invert_next_shell()
@@ -74,14 +81,14 @@ def phone_behavior(run, user, opposite):
         return
     
     # pick a random shell
-    reveal_pos = random.randint(1, num_shells_left-1)
+    reveal_pos = run.rng("phone").randint(1, num_shells_left-1)
     
     # NOTE: this is authentic behavior.  the burner phone is deliberately coded to not tell the player (and only the player) the location of the 8th shell.
     if user is run.player:
         if reveal_pos == 7:
             reveal_pos -= 1
     
-    user.known_sequence[reveal_pos] = run.chamber[reveal_pos]
+    user.reveal_shell(reveal_pos, run.chamber[reveal_pos])
 
 def beer_behavior(run, user, opposite):
     run.pop_next_shell()
@@ -171,6 +178,278 @@ default_item_limits = {
     "handcuffs": 1
 }
 
+## rule sets ##
+
+# an immutable set of game parameters, including the item registry.  every BuckshotRun reads its parameters from a RuleSet rather than the module globals, so runs with different rules can be simulated side by side in one process.
+# derived tables (item ids, limit arrays, chamber compositions, observation size) are computed once here instead of every time they're needed.
+class RuleSet():
+    def __init__(
+        self,
+        rounds_per_match=rounds_per_match,
+        min_shells_per_set=min_shells_per_set,
+        max_shells_per_set=max_shells_per_set,
+        min_health=min_health,
+        max_health=max_health,
+        max_items_total=max_items_total,
+        min_items_per_set=min_items_per_set,
+        max_items_per_set=max_items_per_set,
+        base_live_damage=base_live_damage,
+        sawedoff_live_damage=sawedoff_live_damage,
+        item_behaviors=None,
+        item_limits=None
+    ):
+        if item_behaviors is None:
+            item_behaviors = all_item_behaviors
+        
+        if item_limits is None:
+            item_limits = default_item_limits
+        
+        if min_shells_per_set < 1 or min_shells_per_set > max_shells_per_set:
+            raise ValueError("bad shells per set: " + str(min_shells_per_set) + " to " + str(max_shells_per_set))
+        
+        if min_health < 1 or min_health > max_health:
+            raise ValueError("bad health: " + str(min_health) + " to " + str(max_health))
+        
+        if min_items_per_set < 0 or min_items_per_set > max_items_per_set:
+            raise ValueError("bad items per set: " + str(min_items_per_set) + " to " + str(max_items_per_set))
+        
+        if rounds_per_match < 1:
+            raise ValueError("bad rounds per match: " + str(rounds_per_match))
+        
+        if set(item_limits) != set(item_behaviors):
+            raise ValueError("item limits and item behaviors must have the same items")
+        
+        set_attribute = super().__setattr__
+        
+        set_attribute("rounds_per_match", rounds_per_match)
+        set_attribute("min_shells_per_set", min_shells_per_set)
+        set_attribute("max_shells_per_set", max_shells_per_set)
+        set_attribute("min_health", min_health)
+        set_attribute("max_health", max_health)
+        set_attribute("max_items_total", max_items_total)
+        set_attribute("min_items_per_set", min_items_per_set)
+        set_attribute("max_items_per_set", max_items_per_set)
+        set_attribute("base_live_damage", base_live_damage)
+        set_attribute("sawedoff_live_damage", sawedoff_live_damage)
+        
+        set_attribute("item_behaviors", types.MappingProxyType(dict(item_behaviors)))
+        
+        # item names in registry order, and the index of each one
+        item_names = tuple(item_behaviors)
+        
+        set_attribute("item_names", item_names)
+        set_attribute("item_ids", types.MappingProxyType({item_name: i for i, item_name in enumerate(item_names)}))
+        
+        # limits in the same order as item_names
+        set_attribute("item_limits", types.MappingProxyType({item_name: item_limits[item_name] for item_name in item_names}))
+        set_attribute("item_limit_array", tuple(item_limits[item_name] for item_name in item_names))
+        
+        # total shells -> (num live, num blank), see get_random_chamber_sequence
+        set_attribute("chamber_compositions", types.MappingProxyType({total: (total // 2, total - total // 2) for total in range(min_shells_per_set, max_shells_per_set + 1)}))
+        
+        # 2 numbers for num live and num blank, 2 numbers for health, item counts for player and dealer, and the known sequence.  see BuckshotPredictor_CrossEntropy
+        set_attribute("observation_size", 2 + 2 + len(item_names) * 2 + max_shells_per_set)
+    
+    def __setattr__(self, name, value):
+        raise AttributeError("RuleSet is immutable, use with_overrides to make a changed copy")
+    
+    def __delattr__(self, name):
+        raise AttributeError("RuleSet is immutable")
+    
+    # the parameters this rule set was made with, as keyword arguments for RuleSet
+    def as_dict(self):
+        return {
+            "rounds_per_match": self.rounds_per_match,
+            "min_shells_per_set": self.min_shells_per_set,
+            "max_shells_per_set": self.max_shells_per_set,
+            "min_health": self.min_health,
+            "max_health": self.max_health,
+            "max_items_total": self.max_items_total,
+            "min_items_per_set": self.min_items_per_set,
+            "max_items_per_set": self.max_items_per_set,
+            "base_live_damage": self.base_live_damage,
+            "sawedoff_live_damage": self.sawedoff_live_damage,
+            "item_behaviors": dict(self.item_behaviors),
+            "item_limits": dict(self.item_limits)
+        }
+    
+    # a new rule set with some parameters changed
+    def with_overrides(self, **overrides):
+        parameters = self.as_dict()
+        
+        for name in overrides:
+            if not name in parameters:
+                raise ValueError("unknown rule " + name)
+        
+        parameters.update(overrides)
+        
+        return RuleSet(**parameters)
+    
+    def _key(self):
+        parameters = self.as_dict()
+        parameters["item_behaviors"] = tuple(parameters["item_behaviors"].items())
+        parameters["item_limits"] = tuple(parameters["item_limits"].items())
+        
+        return tuple(parameters.items())
+    
+    def __eq__(self, other):
+        return isinstance(other, RuleSet) and self._key() == other._key()
+    
+    # the mapping proxies can't be pickled, so rule sets are pickled as the arguments that rebuild them.  as_dict is in the same order as __init__'s arguments
+    def __reduce__(self):
+        return (RuleSet, tuple(self.as_dict().values()))
+    
+    def __hash__(self):
+        return hash(self._key())
+    
+    def __repr__(self):
+        return "RuleSet(" + ", ".join(name + "=" + repr(value) for name, value in self.as_dict().items() if name != "item_behaviors") + ")"
+    
+    # short hex string that only changes if the rules change, stable across processes.  item behaviors are identified by their function names.
+    # it's worked out the first time it's asked for and kept, rule sets can't change anyways
+    def fingerprint(self):
+        fingerprint = self.__dict__.get("_fingerprint")
+        
+        if fingerprint is None:
+            parameters = self.as_dict()
+            parameters["item_behaviors"] = [(item_name, behavior.__qualname__) for item_name, behavior in parameters["item_behaviors"].items()]
+            parameters["item_limits"] = list(parameters["item_limits"].items())
+            
+            fingerprint = hashlib.sha1(repr(sorted(parameters.items())).encode()).hexdigest()[:16]
+            
+            object.__setattr__(self, "_fingerprint", fingerprint)
+        
+        return fingerprint
+
+default_rules = RuleSet()
+
+# caps on how long a run can go, so that strong players can't make a run (and whatever is waiting on it) take forever.  None means no cap.
+# a run stops as soon as the player has won max_matches matches, max_rounds rounds or max_sets sets, or max_steps shots have been fired by either seat.  it's then truncated, which is a different ending from the player dying, see BuckshotRun.status.
+# unlike rules, limits don't change how the game is played up to the cap.
+class RunLimits():
+    def __init__(self, max_matches=None, max_rounds=None, max_sets=None, max_steps=None):
+        for name, value in (("max_matches", max_matches), ("max_rounds", max_rounds), ("max_sets", max_sets), ("max_steps", max_steps)):
+            if not value is None and (not isinstance(value, int) or value < 1):
+                raise ValueError(name + " must be a positive int or None, not " + repr(value))
+        
+        self.max_matches = max_matches
+        self.max_rounds = max_rounds
+        self.max_sets = max_sets
+        self.max_steps = max_steps
+    
+    def as_dict(self):
+        return {"max_matches": self.max_matches, "max_rounds": self.max_rounds, "max_sets": self.max_sets, "max_steps": self.max_steps}
+    
+    def __eq__(self, other):
+        return isinstance(other, RunLimits) and self.as_dict() == other.as_dict()
+    
+    def __repr__(self):
+        return "RunLimits(" + ", ".join(name + "=" + repr(value) for name, value in self.as_dict().items() if not value is None) + ")"
+    
+    # the name of the first cap run has reached ("matches", "rounds", "sets" or "steps"), or None
+    def reached(self, run):
+        if not self.max_matches is None and run.matches_won >= self.max_matches:
+            return "matches"
+        
+        if not self.max_rounds is None and run.rounds_won() >= self.max_rounds:
+            return "rounds"
+        
+        if not self.max_sets is None and run.sets_won >= self.max_sets:
+            return "sets"
+        
+        if not self.max_steps is None and run.steps >= self.max_steps:
+            return "steps"
+        
+        return None
+
+no_limits = RunLimits()
+
+# common random numbers: separate random streams for every kind of random event, so that two runs with the same seed get the same chamber, health, items and coin flips wherever they're at the same point in the game, no matter what was drawn before.
+# every draw gets its own generator keyed by (seed, match, round, set, event, number of earlier draws of that event in the set), so the whole state of the streams is a few counters (see BuckshotRun.to_bytes).
+class RandomStreams():
+    events = ("chamber", "health", "items", "medicine", "phone", "coin_flip")
+    
+    def __init__(self, seed):
+        self.seed = seed
+        
+        # (match, round, set) the counts below belong to, and event -> draws of it so far in that set
+        self.position = None
+        self.counts = dict()
+    
+    def get(self, run, event):
+        position = (run.matches_won, run.current_round, run.current_set)
+        
+        if position != self.position:
+            self.position = position
+            self.counts.clear()
+        
+        count = self.counts.get(event, 0)
+        self.counts[event] = count + 1
+        
+        # string seeds are hashed with sha512, so streams are the same in every process
+        return random.Random("{}:{}:{}:{}:{}:{}".format(self.seed, position[0], position[1], position[2], event, count))
+
+
+## binary layout of runs ##
+# see BuckshotRun.to_bytes.  a run is one fixed size block of little endian numbers followed by the lists of items, one byte per item (its index in rules.item_names):
+    # run: version, rules fingerprint, flags, whose turn, who's handcuffed, current round, last shell fired, desired steal item, truncation reason, number of shells, matches won, current set, sets won, steps, chamber (bit i is set if shell i is live)
+    # state hash: the accumulators (public, chamber, counts, player known, dealer known), so reading a run doesn't have to hash it all over again
+    # player and dealer: health, max health, known shells mask, known shells values, number of items and the bugged count of every item
+    # dealer's memory: dealer target, known shell, knows shell, flags, length of item_array_dealer
+    # then the player's items, the dealer's items and item_array_dealer, and then the limits and the random streams if the run has them
+
+run_bytes_version = 2
+
+_run_format = "B8sBbbBBBBBHHIII" + "QQQQQ"
+_seat_format = "bbIIB"
+_dealer_format = "BBBBB"
+
+_limits_layout = struct.Struct("<IIII")
+_streams_layout = struct.Struct("<q" + "H" * len(RandomStreams.events))
+
+# number of item types -> the fixed size block for rules with that many items
+_fixed_layouts = dict()
+
+def _fixed_layout(num_item_types):
+    layout = _fixed_layouts.get(num_item_types)
+    
+    if layout is None:
+        seat_format = _seat_format + "b" * num_item_types
+        layout = _fixed_layouts[num_item_types] = struct.Struct("<" + _run_format + seat_format + seat_format + _dealer_format)
+    
+    return layout
+
+# flags
+_game_over_flag = 1
+_truncated_flag = 2
+_sawed_off_flag = 4
+_limits_flag = 8
+_streams_flag = 16
+
+# the values some fields can take, stored as their index in these tuples
+_dealer_targets = ("", "self", "player")
+_known_shells = (None, "", live_token, blank_token)
+_knows_shell = (None, False, True)
+_last_shells = (None, blank_token, live_token)
+_truncation_reasons = (None, "matches", "rounds", "sets", "steps")
+
+# bit masks of the known shells and of the ones known to be live in a known sequence
+def _known_bits(known_sequence):
+    mask = 0
+    values = 0
+    
+    for i, shell in enumerate(known_sequence):
+        if not shell is None:
+            mask |= 1 << i
+            
+            if shell == live_token:
+                values |= 1 << i
+    
+    return mask, values
+
+# rules fingerprint -> a run straight out of setup, which BuckshotRun.from_bytes copies instead of setting up every run from scratch
+_blank_runs = dict()
+
 ## utility methods ##
 
 def shell_is_live(shell):
@@ -185,23 +464,57 @@ def shell_is_blank(shell):
 # 2. the number of live shells is the total amount divided by 2 and rounded down, with the rest being blanks.
 # 3. the shells are arranged in a completely random order.
 # this function returns the number of lives, number of blanks, and the sequence.
-def get_random_chamber_sequence():
-    total_shells = random.randint(min_shells_per_set, max_shells_per_set)
+# rng is where the random numbers come from (anything with randint and shuffle), the global random module by default.  the same goes for the other random functions below.
+def get_random_chamber_sequence(rules=default_rules, rng=random):
+    total_shells = rng.randint(rules.min_shells_per_set, rules.max_shells_per_set)
     
-    num_live = total_shells // 2
-    num_blank = total_shells - num_live
+    num_live, num_blank = rules.chamber_compositions[total_shells]
     
     # arrange them in an array and shuffle
     sequence = [live_token] * num_live + [blank_token] * num_blank
     
     # NOTE: this is technically not authentic behavior.  mike shuffles the order twice for some reason.
-    random.shuffle(sequence)
+    rng.shuffle(sequence)
     
     return sequence
 
 # health is a random number between 2 and 4
-def get_random_health():
-    return random.randint(min_health, max_health)
+def get_random_health(rules=default_rules, rng=random):
+    return rng.randint(rules.min_health, rules.max_health)
+
+# draw num items for every seat in one go, working directly on lists of item limits (one list per seat, in the order of rules.item_names) instead of building limit inventories.
+# this draws exactly the same items in the same order as calling Inventory.get_random_items with each seat's limit inventory one after the other, and uses up the same random numbers.
+# returns a list of drawn item names for each seat.
+def draw_set_items(num, seat_limits, rules=default_rules, rng=random):
+    item_names = rules.item_names
+    choice = rng.choice
+    
+    all_drawn = []
+    
+    for limits in seat_limits:
+        # items with a limit of 0 (or below, thanks to the bugged counts) can't be drawn at all
+        pickable_ids = [item_id for item_id, limit in enumerate(limits) if limit > 0]
+        counts = [0] * len(limits)
+        
+        drawn = []
+        
+        for i in range(num):
+            # no items available
+            if len(pickable_ids) < 1:
+                break
+            
+            item_id = choice(pickable_ids)
+            
+            drawn.append(item_names[item_id])
+            
+            counts[item_id] += 1
+            
+            if counts[item_id] >= limits[item_id]:
+                pickable_ids.remove(item_id)
+        
+        all_drawn.append(drawn)
+    
+    return all_drawn
     
 ## classes ##
 
@@ -219,19 +532,23 @@ class InvalidItemException(Exception):
 class RoundResetException(Exception):
     pass
 
+# state passed to BuckshotRun.from_state isn't a state the game can be in
+class InvalidStateException(Exception):
+    pass
+
 # re-written inventory to support item ordering
 class Inventory():
     # generate an inventory of num random items.
     # limits is also an inventory of items.  it gives limits to the number of items that can be in the random inventory.  if limits is None, then no limits are applied.
     @staticmethod
-    def get_random_items(num, limits=None):
-        random_inventory = Inventory()
+    def get_random_items(num, limits=None, rules=default_rules, rng=random):
+        random_inventory = Inventory(rules=rules)
         
-        pickable_items = all_item_names.copy()
+        pickable_items = list(rules.item_names)
         
         # remove any items that have a hard set 0 limits
         if not limits is None:
-            for item_name in all_item_names:
+            for item_name in rules.item_names:
                 if limits.item_count(item_name) == 0:
                     pickable_items.remove(item_name)
         
@@ -241,7 +558,7 @@ class Inventory():
                 break
             
             # pick random item
-            random_item = random.choice(pickable_items)
+            random_item = rng.choice(pickable_items)
             
             random_inventory.add_item(random_item)
             
@@ -252,14 +569,18 @@ class Inventory():
         
         return random_inventory
     
-    def __init__(self, max_items=None):
+    def __init__(self, max_items=None, rules=default_rules):
         self.items = list()
         self.max_items = max_items
+        self.rules = rules
+        
+        # called with (item_name, old_count, new_count) whenever the count of an item changes.  used by participants to keep the state hash up to date.
+        self.count_listener = None
         
         self.reset()
     
     def check_item_validity(self, item_name):
-        if not item_name in all_item_names:
+        if not item_name in self.rules.item_ids:
             raise InvalidItemException("Invalid item " + item_name)
         
     def has_item(self, item_name):
@@ -274,6 +595,10 @@ class Inventory():
         return len(self.items)
     
     def reset(self):
+        if not self.count_listener is None:
+            for item_name in set(self.items):
+                self.count_listener(item_name, self.items.count(item_name), 0)
+        
         self.items = list()
     
     def num_items(self):
@@ -282,7 +607,7 @@ class Inventory():
     def as_dict(self):
         inventory = dict()
         
-        for item_name in all_item_names:
+        for item_name in self.rules.item_names:
             inventory[item_name] = self.item_count(item_name)
         
         return inventory
@@ -296,6 +621,9 @@ class Inventory():
         return self.items.count(item_name)
     
     def add_item(self, item_name, count=1, ignore_limits=False):
+        if not self.count_listener is None:
+            old_count = self.items.count(item_name)
+        
         if not ignore_limits:
             self.items += [item_name] * count
         else:
@@ -303,11 +631,32 @@ class Inventory():
             
         if (not self.max_items is None) and not ignore_limits:
             self.items = self.items[:self.max_items]
+        
+        if not self.count_listener is None:
+            self.count_listener(item_name, old_count, self.items.count(item_name))
     
     def add_inventory(self, inventory):
         for item_name in inventory.items:
             self.add_item(item_name)
     
+    # add a list of item names in order, dropping whatever doesn't fit.  this is the same as adding them one at a time with add_item, but in one step.
+    # returns the list of items that were actually added.
+    def add_item_list(self, item_names):
+        if self.max_items is None:
+            added = item_names
+        else:
+            added = item_names[:max(0, self.max_items - len(self.items))]
+        
+        if not self.count_listener is None:
+            for item_name in set(added):
+                old_count = self.items.count(item_name)
+                
+                self.count_listener(item_name, old_count, old_count + added.count(item_name))
+        
+        self.items += added
+        
+        return added
+    
     # default behavior is to remove item_name from the inventory count times, or until the item is fully exhausted.  this will raise a NoItemException if the item isn't in the inventory.
     # if consume_all is True, count is ignored and instead all instances of item_name are removed from the inventory.  this will NOT raise a NoItemException (or any exception) if the item isn't in the inventory.
     def consume_item(self, item_name, count=1, consume_all=False):
@@ -316,19 +665,33 @@ class Inventory():
         
         count = min(count, self.item_count(item_name))
         
+        if not self.count_listener is None:
+            old_count = self.items.count(item_name)
+        
         if consume_all:
             while item_name in self.items:
                 self.items.remove(item_name)
         else:
             for i in range(count):
                 self.items.remove(item_name)
+        
+        if not self.count_listener is None:
+            self.count_listener(item_name, old_count, self.items.count(item_name))
 
 # a participant in the game.  there are only two, the dealer and the player, but both inherit from this for shared behavior (such as health, items, etc.)
 class Participant():
-    def __init__(self, name):
+    def __init__(self, name, rules=default_rules):
         self.name = name
-        self.health = 0
-        self.inventory = Inventory(max_items_total)
+        self.rules = rules
+        
+        # set by attach_state_hash.  until then nothing is hashed.
+        self.state_hash = None
+        self.seat_id = None
+        
+        self._health = 0
+        self._current_max_health = 0
+        
+        self.inventory = Inventory(rules.max_items_total, rules=rules)
         
         # see get_participant_item_limits docs for why this exists.
         self.item_counts_for_bugged_limits = dict()
@@ -340,15 +703,108 @@ class Participant():
         # known shells will be either the live or blank token, or None if the shell isn't known.
         # this represents the number of shells left in the chamber, not the number of shells at the start.  the first item always corresponds to the next shell
         self.known_sequence = []
+    
+    # health and max health are properties so that the state hash sees every change to them, including ones made from outside the class
+    @property
+    def health(self):
+        return self._health
+    
+    @health.setter
+    def health(self, new_health):
+        if not self.state_hash is None:
+            self.state_hash.replace("health", self.seat_id, self._health, new_health)
         
-        self.current_max_health = 0
+        self._health = new_health
+    
+    @property
+    def current_max_health(self):
+        return self._current_max_health
+    
+    @current_max_health.setter
+    def current_max_health(self, new_max_health):
+        if not self.state_hash is None:
+            self.state_hash.replace("max_health", self.seat_id, self._current_max_health, new_max_health)
+        
+        self._current_max_health = new_max_health
+    
+    # start keeping state_hash up to date with this participant's part of the game state.  whatever state the participant already has is hashed in immediately.
+    def attach_state_hash(self, state_hash, seat_id):
+        self.state_hash = state_hash
+        self.seat_id = seat_id
+        
+        state_hash.replace("health", seat_id, None, self._health)
+        state_hash.replace("max_health", seat_id, None, self._current_max_health)
+        
+        for item_name in set(self.inventory.items):
+            self.on_item_count_change(item_name, 0, self.inventory.item_count(item_name))
+        
+        for item_name, count in self.item_counts_for_bugged_limits.items():
+            self.on_bugged_count_change(item_name, 0, count)
+        
+        for i, shell in enumerate(self.known_sequence):
+            state_hash.toggle_known(seat_id, len(self.known_sequence) - 1 - i, shell)
+        
+        self.inventory.count_listener = self.on_item_count_change
+    
+    # items change more than anything else, so this skips StateHash.replace and toggles the keys directly
+    def on_item_count_change(self, item_name, old_count, new_count):
+        change = 0
+        
+        if old_count > 0:
+            change = zobrist_key(("item", self.seat_id, item_name, old_count))
+        
+        if new_count > 0:
+            change ^= zobrist_key(("item", self.seat_id, item_name, new_count))
+        
+        self.state_hash.public ^= change
+    
+    # the bugged counts decide which items can be drawn, so they're part of the state hash too.  every change to them goes through here
+    def set_bugged_count(self, item_name, count):
+        bugged_counts = self.item_counts_for_bugged_limits
+        
+        if not self.state_hash is None:
+            self.on_bugged_count_change(item_name, bugged_counts.get(item_name, 0), count)
+        
+        bugged_counts[item_name] = count
+    
+    # like on_item_count_change, counts of 0 don't contribute to the hash so resetting items doesn't cost anything
+    def on_bugged_count_change(self, item_name, old_count, new_count):
+        if old_count == new_count:
+            return
+        
+        change = 0
+        
+        if old_count != 0:
+            change = zobrist_key(("bugged", self.seat_id, item_name, old_count))
+        
+        if new_count != 0:
+            change ^= zobrist_key(("bugged", self.seat_id, item_name, new_count))
+        
+        self.state_hash.public ^= change
     
     def reset_known_sequence(self, num_shells):
+        if not self.state_hash is None:
+            for i, shell in enumerate(self.known_sequence):
+                self.state_hash.toggle_known(self.seat_id, len(self.known_sequence) - 1 - i, shell)
+        
         self.known_sequence = [None] * num_shells
     
     def pop_known_sequence(self):
+        if not self.state_hash is None:
+            self.state_hash.toggle_known(self.seat_id, len(self.known_sequence) - 1, self.known_sequence[0])
+        
         return self.known_sequence.pop(0)
     
+    # the participant learns that the shell at position i (counting from the next shell) is shell
+    def reveal_shell(self, i, shell):
+        if not self.state_hash is None:
+            pos = len(self.known_sequence) - 1 - i
+            
+            self.state_hash.toggle_known(self.seat_id, pos, self.known_sequence[i])
+            self.state_hash.toggle_known(self.seat_id, pos, shell)
+        
+        self.known_sequence[i] = shell
+    
     def peek_known_sequence(self, i):
         return self.known_sequence[i]
     
@@ -376,13 +832,21 @@ class Participant():
         
         # this accounts for any partial counts from hitting the total max item count (not the individual item limits)
         for item_name in self.inventory.as_dict():
-            self.item_counts_for_bugged_limits[item_name] += self.inventory.item_count(item_name) - old_counts[item_name]
+            self.set_bugged_count(item_name, self.item_counts_for_bugged_limits[item_name] + self.inventory.item_count(item_name) - old_counts[item_name])
+    
+    # same as give_items, but takes a list of item names (as returned by draw_set_items) instead of an inventory
+    def give_item_list(self, item_names):
+        bugged_counts = self.item_counts_for_bugged_limits
+        
+        # only the items that actually fit count towards the limits
+        for item_name in self.inventory.add_item_list(item_names):
+            self.set_bugged_count(item_name, bugged_counts[item_name] + 1)
     
     def reset_items(self):
         self.inventory.reset()
         
-        for item_name in all_item_names:
-            self.item_counts_for_bugged_limits[item_name] = 0
+        for item_name in self.rules.item_names:
+            self.set_bugged_count(item_name, 0)
         
     def has_item(self, name):
         return self.inventory.has_item(name)
@@ -391,26 +855,31 @@ class Participant():
         self.inventory.consume_item(name)
         
         # decrement count (won't get this far if we don't have an item because inventory will throw an exception)
-        self.item_counts_for_bugged_limits[name] -= 1
+        self.set_bugged_count(name, self.item_counts_for_bugged_limits[name] - 1)
     
     # get an inventory containing this participant's current limits on each item based on the bugged item counts and the default limits
     def get_limit_inventory(self):
-        limit_inventory = Inventory()
+        limit_inventory = Inventory(rules=self.rules)
         
-        for item_name in default_item_limits:
+        for item_name, default_limit in self.rules.item_limits.items():
             bugged_count = self.item_counts_for_bugged_limits[item_name]
-            default_limit = default_item_limits[item_name]
             
             current_limit = default_limit - bugged_count
             
             limit_inventory.add_item(item_name, count=current_limit)
         
         return limit_inventory
+    
+    # same limits as get_limit_inventory, but as a list of numbers in the order of the rules' item names
+    def get_limit_array(self):
+        bugged_counts = self.item_counts_for_bugged_limits
+        
+        return [limit - bugged_counts[item_name] for item_name, limit in zip(self.rules.item_names, self.rules.item_limit_array)]
 
 # participant with some real authentic dealer ai
 class Dealer(Participant):
-    def __init__(self):
-        super().__init__("Dealer")
+    def __init__(self, rules=default_rules):
+        super().__init__("Dealer", rules=rules)
         
         self.dealer_target = ""
         self.known_shell = None
@@ -422,6 +891,64 @@ class Dealer(Participant):
         # we have a separate list for this because it doesn't necessarily just contain items that the dealer has
         self.item_array_dealer = []
     
+    # the dealer's memory between turns changes what he does next, so it's part of the state hash, in the dealer's private part of it (see StateHash.replace_private).  using_medicine, using_handsaw and main_loop_finished are reset at the start of every turn, so they aren't.
+    @property
+    def dealer_target(self):
+        return self._dealer_target
+    
+    @dealer_target.setter
+    def dealer_target(self, target):
+        if not self.state_hash is None:
+            self.state_hash.replace_private(self.seat_id, "dealer_target", self._dealer_target, target)
+        
+        self._dealer_target = target
+    
+    @property
+    def known_shell(self):
+        return self._known_shell
+    
+    @known_shell.setter
+    def known_shell(self, shell):
+        if not self.state_hash is None:
+            self.state_hash.replace_private(self.seat_id, "known_shell", self._known_shell, shell)
+        
+        self._known_shell = shell
+    
+    @property
+    def dealer_knows_shell(self):
+        return self._dealer_knows_shell
+    
+    # can_peek_next_shell returns None for no, which plays the same as False
+    @dealer_knows_shell.setter
+    def dealer_knows_shell(self, knows_shell):
+        if not self.state_hash is None:
+            self.state_hash.replace_private(self.seat_id, "dealer_knows_shell", bool(self._dealer_knows_shell), bool(knows_shell))
+        
+        self._dealer_knows_shell = knows_shell
+    
+    # the dealer only ever checks the array for cigarettes before rebuilding it (see take_turn), so the number of cigs in it is all the hash needs
+    @property
+    def item_array_dealer(self):
+        return self._item_array_dealer
+    
+    @item_array_dealer.setter
+    def item_array_dealer(self, item_array):
+        num_cigs = item_array.count("cigs")
+        
+        if not self.state_hash is None:
+            self.state_hash.replace_private(self.seat_id, "item_array_cigs", self._item_array_cigs, num_cigs)
+        
+        self._item_array_dealer = item_array
+        self._item_array_cigs = num_cigs
+    
+    def attach_state_hash(self, state_hash, seat_id):
+        super().attach_state_hash(state_hash, seat_id)
+        
+        state_hash.replace_private(seat_id, "dealer_target", None, self._dealer_target)
+        state_hash.replace_private(seat_id, "known_shell", None, self._known_shell)
+        state_hash.replace_private(seat_id, "dealer_knows_shell", None, bool(self._dealer_knows_shell))
+        state_hash.replace_private(seat_id, "item_array_cigs", None, self._item_array_cigs)
+    
     # overrides for handling item_array_dealer
     def reset_items(self):
         super().reset_items()
@@ -433,6 +960,12 @@ class Dealer(Participant):
         
         self.item_array_dealer += inventory_of_items.as_list()
     
+    def give_item_list(self, item_names):
+        super().give_item_list(item_names)
+        
+        # NOTE: this includes any items that didn't fit in the inventory, same as give_items
+        self.item_array_dealer += item_names
+    
     # brain time
     
     # not a true coin flip, but used by the dealer to make decisions if he doesn't know what to do for certain
@@ -440,7 +973,7 @@ class Dealer(Participant):
         c_live = run.num_live()
         c_blank = run.num_blank()
         
-        if c_live == c_blank: return random.randint(0, 1)
+        if c_live == c_blank: return run.rng("coin_flip").randint(0, 1)
         if c_live > c_blank: return 1
         if c_live < c_blank: return 0
         
@@ -477,6 +1010,9 @@ class Dealer(Participant):
         self.using_handsaw = False
         self.using_medicine = False
         
+        # whoever is on the other side of the table.  this is always the player for the real dealer, but going through whose_turn lets the same logic play from the player's seat (see policies.DealerLogicPolicy)
+        opponent = run.whose_turn()[1]
+        
         while True:
             dealer_wants_to_use = ""
             has_handsaw = False
@@ -515,7 +1051,7 @@ class Dealer(Participant):
             self.item_array_dealer = self.inventory.as_list()
             
             if using_adrenaline:
-                self.item_array_dealer += run.player.inventory.as_list()
+                self.item_array_dealer += opponent.inventory.as_list()
             
             # pick an item to use
             for item_name in self.item_array_dealer:
@@ -547,7 +1083,7 @@ class Dealer(Participant):
                     self.known_shell = None
                     break
                 
-                if item_name == "handcuffs" and not run.is_handcuffed(run.player) and run.num_shells_left() != 1:
+                if item_name == "handcuffs" and not run.is_handcuffed(opponent) and run.num_shells_left() != 1:
                     dealer_wants_to_use = item_name
                     break
                 
@@ -594,7 +1130,10 @@ class Dealer(Participant):
                     # use item
                     run.use_item(dealer_wants_to_use)
                 
-                self.item_array_dealer.remove(dealer_wants_to_use)
+                # reassigned so the state hash sees the change
+                item_array = self.item_array_dealer
+                item_array.remove(dealer_wants_to_use)
+                self.item_array_dealer = item_array
                 
                 # loop again to pick another item
             else:
@@ -624,15 +1163,45 @@ class BuckshotRun():
     player_id = 0
     dealer_id = 1
     
-    def __init__(self, logging=True):
-        self.player = Participant("Player")
-        self.dealer = Dealer()
+    # rules is the RuleSet to play by, default_rules if None.  limits is a RunLimits to stop the run early, no_limits if None
+    # if stream_seed isn't None, the game's random events are drawn from RandomStreams(stream_seed) instead of the global random module (see RandomStreams)
+    def __init__(self, logging=True, rules=None, limits=None, stream_seed=None):
+        self.setup(logging, rules, limits, stream_seed)
         
         # initial health
         self.give_both_random_health()
         
+        # initialize game
+        self.on_set_end()
+    
+    # create the participants and every piece of game state, without dealing health, shells or items.  __init__ and from_state both start here.
+    def setup(self, logging, rules, limits=None, stream_seed=None):
+        if rules is None:
+            rules = default_rules
+        
+        self.rules = rules
+        self.limits = no_limits if limits is None else limits
+        self.streams = None if stream_seed is None else RandomStreams(stream_seed)
+        
+        self.player = Participant("Player", rules=rules)
+        self.dealer = Dealer(rules=rules)
+        
+        # zobrist hash of the game state, see zobrist.py.  the participants keep their own parts of it up to date.
+        self.state_hash = StateHash()
+        
+        self.player.attach_state_hash(self.state_hash, self.player_id)
+        self.dealer.attach_state_hash(self.state_hash, self.dealer_id)
+        
+        self._whose_turn_id = None
+        self._who_handcuffed_id = None
+        self._is_sawed_off = None
+        self._matches_won = None
+        self._current_round = None
+        self._current_set = None
+        
         # the current sequence of shells in the chamber
         self.chamber = []
+        self.state_hash.set_counts(0, 0)
         
         # matches won by the player (if the dealer wins any, it's just game over)
         self.matches_won = 0
@@ -649,6 +1218,13 @@ class BuckshotRun():
         # will be set to true if the game is over for the player
         self.game_over = False
         
+        # set to true (with the name of the cap in truncation_reason) if the run hit one of its limits.  the player is still alive, the run just stops here
+        self.truncated = False
+        self.truncation_reason = None
+        
+        # shots fired by either seat, for limits.max_steps
+        self.steps = 0
+        
         # starts at 1 and goes up to rounds_per_match
         self.current_round = 1
         
@@ -667,13 +1243,489 @@ class BuckshotRun():
         # the desired item to steal from opposite of whomever is using adrenaline
         self.desired_steal_item = None
         
+        # callbacks that get every event this run emits, see events.py.  logging just subscribes the text printer.
+        self.subscribers = []
         self.logging = logging
         
-        # initialize game
-        self.on_set_end()
+        if logging:
+            self.subscribe(print_event)
+    
+    # build a run directly in the given state, without any of the random setup __init__ does.  this is meant for putting runs into specific positions, see scenarios.py for generating lots of them.
+    # chamber is the list of shells left, next shell first.  items are lists of item names.  known sequences are lists the same length as the chamber, with None for unknown shells.
+    # max healths default to the larger of the two healths.  bugged counts (see adrenaline_behavior) default to the number of each item held, as if every item had been drawn normally.  dealer_item_array defaults to the dealer's items.
+    # handcuffed is "player", "dealer" or None.
+    # raises InvalidStateException if the state isn't one the game could be in.
+    @classmethod
+    def from_state(
+        cls,
+        chamber,
+        player_health,
+        dealer_health,
+        player_max_health=None,
+        dealer_max_health=None,
+        player_items=(),
+        dealer_items=(),
+        player_known=None,
+        dealer_known=None,
+        player_bugged_counts=None,
+        dealer_bugged_counts=None,
+        dealer_item_array=None,
+        handcuffed=None,
+        sawed_off=False,
+        player_turn=True,
+        current_round=1,
+        current_set=1,
+        matches_won=0,
+        sets_won=0,
+        logging=False,
+        rules=None,
+        limits=None,
+        stream_seed=None
+    ):
+        run = cls.__new__(cls)
+        run.setup(logging, rules, limits, stream_seed)
+        
+        rules = run.rules
+        chamber = list(chamber)
+        
+        if len(chamber) < 1 or len(chamber) > rules.max_shells_per_set:
+            raise InvalidStateException("chamber must have between 1 and " + str(rules.max_shells_per_set) + " shells, not " + str(len(chamber)))
+        
+        for shell in chamber:
+            if not shell_is_live(shell) and not shell_is_blank(shell):
+                raise InvalidStateException("bad shell " + repr(shell))
+        
+        default_max_health = max(player_health, dealer_health)
+        
+        seats = (
+            (run.player, player_health, player_max_health, player_items, player_known, player_bugged_counts),
+            (run.dealer, dealer_health, dealer_max_health, dealer_items, dealer_known, dealer_bugged_counts)
+        )
+        
+        for participant, health, max_health, items, known, bugged_counts in seats:
+            if max_health is None:
+                max_health = default_max_health
+            
+            if health < 1 or health > max_health:
+                raise InvalidStateException(participant.name + " health must be between 1 and " + str(max_health) + ", not " + str(health))
+            
+            participant.set_health(max_health)
+            participant.health = health
+            
+            items = list(items)
+            
+            for item_name in items:
+                if not item_name in rules.item_ids:
+                    raise InvalidStateException("invalid item " + repr(item_name))
+            
+            if len(items) > rules.max_items_total:
+                raise InvalidStateException(participant.name + " can't hold " + str(len(items)) + " items")
+            
+            participant.inventory.add_item_list(items)
+            
+            for item_name in rules.item_names:
+                if bugged_counts is None:
+                    participant.set_bugged_count(item_name, items.count(item_name))
+                else:
+                    participant.set_bugged_count(item_name, bugged_counts.get(item_name, 0))
+            
+            participant.reset_known_sequence(len(chamber))
+            
+            if not known is None:
+                if len(known) != len(chamber):
+                    raise InvalidStateException(participant.name + " known sequence must be as long as the chamber")
+                
+                for i, shell in enumerate(known):
+                    if shell is None:
+                        continue
+                    
+                    if shell != chamber[i]:
+                        raise InvalidStateException(participant.name + " knows the wrong shell at position " + str(i))
+                    
+                    participant.reveal_shell(i, shell)
+        
+        run.dealer.item_array_dealer = list(run.dealer.inventory.items if dealer_item_array is None else dealer_item_array)
+        
+        run.set_chamber(chamber)
+        
+        if not handcuffed in (None, "player", "dealer"):
+            raise InvalidStateException("handcuffed must be \"player\", \"dealer\" or None")
+        
+        # whoever is cuffed skips their next turn, so they can't be the one holding the gun
+        if (handcuffed == "player" and player_turn) or (handcuffed == "dealer" and not player_turn):
+            raise InvalidStateException("the participant whose turn it is can't be handcuffed")
+        
+        run.whose_turn_id = cls.player_id if player_turn else cls.dealer_id
+        run.who_handcuffed_id = {None: cls.nobody_id, "player": cls.player_id, "dealer": cls.dealer_id}[handcuffed]
+        run.is_sawed_off = sawed_off
+        
+        if current_round < 1 or current_round > rules.rounds_per_match:
+            raise InvalidStateException("current round must be between 1 and " + str(rules.rounds_per_match))
+        
+        if current_set < 1 or matches_won < 0 or sets_won < 0:
+            raise InvalidStateException("bad set/match counters")
+        
+        run.current_round = current_round
+        run.current_set = current_set
+        run.matches_won = matches_won
+        run.sets_won = sets_won
+        
+        return run
+    
+    # the complete state of the run as a hundred or so bytes, for moving live games between processes or keeping them on disk.  see the layout at the top of the file.
+    # this includes the dealer's memory between turns (item_array_dealer, known_shell and friends), the bugged item counts, the limits and the random streams, so BuckshotRun.from_bytes gives back a run that plays on exactly like this one would.  the rules themselves are not included, only their fingerprint.
+    def to_bytes(self):
+        rules = self.rules
+        item_names = rules.item_names
+        item_ids = rules.item_ids
+        
+        player = self.player
+        dealer = self.dealer
+        state_hash = self.state_hash
+        
+        flags = (
+            (_game_over_flag if self.game_over else 0)
+            | (_truncated_flag if self.truncated else 0)
+            | (_sawed_off_flag if self._is_sawed_off else 0)
+            | (0 if self.limits is no_limits else _limits_flag)
+            | (0 if self.streams is None else _streams_flag)
+        )
+        
+        chamber_bits = 0
+        
+        for i, shell in enumerate(self.chamber):
+            if shell == live_token:
+                chamber_bits |= 1 << i
+        
+        player_bugged = player.item_counts_for_bugged_limits
+        dealer_bugged = dealer.item_counts_for_bugged_limits
+        
+        parts = [
+            _fixed_layout(len(item_names)).pack(
+                run_bytes_version,
+                bytes.fromhex(rules.fingerprint()),
+                flags,
+                self._whose_turn_id,
+                self._who_handcuffed_id,
+                self.current_round,
+                _last_shells.index(self.last_shell_fired),
+                255 if self.desired_steal_item is None else item_ids[self.desired_steal_item],
+                _truncation_reasons.index(self.truncation_reason),
+                len(self.chamber),
+                self.matches_won,
+                self.current_set,
+                self.sets_won,
+                self.steps,
+                chamber_bits,
+                state_hash.public,
+                state_hash.chamber,
+                state_hash.counts,
+                state_hash.known[0],
+                state_hash.known[1],
+                player._health,
+                player._current_max_health,
+                *_known_bits(player.known_sequence),
+                len(player.inventory.items),
+                *[player_bugged[item_name] for item_name in item_names],
+                dealer._health,
+                dealer._current_max_health,
+                *_known_bits(dealer.known_sequence),
+                len(dealer.inventory.items),
+                *[dealer_bugged[item_name] for item_name in item_names],
+                _dealer_targets.index(dealer.dealer_target),
+                _known_shells.index(dealer.known_shell),
+                _knows_shell.index(dealer.dealer_knows_shell),
+                (1 if dealer.using_medicine else 0) | (2 if dealer.using_handsaw else 0) | (4 if dealer.main_loop_finished else 0),
+                len(dealer.item_array_dealer)
+            ),
+            bytes([item_ids[item_name] for item_name in player.inventory.items]),
+            bytes([item_ids[item_name] for item_name in dealer.inventory.items]),
+            bytes([item_ids[item_name] for item_name in dealer.item_array_dealer])
+        ]
+        
+        if flags & _limits_flag:
+            parts.append(_limits_layout.pack(*[0 if value is None else value for value in self.limits.as_dict().values()]))
+        
+        if flags & _streams_flag:
+            streams = self.streams
+            
+            if not isinstance(streams.seed, int):
+                raise ValueError("only runs with int stream seeds can be turned into bytes, not " + repr(streams.seed))
+            
+            # counts belong to the position they were made at.  if the game has moved on since, they'd be cleared on the next draw anyways
+            if streams.position != (self.matches_won, self.current_round, self.current_set):
+                counts = [0] * len(RandomStreams.events)
+            else:
+                counts = [streams.counts.get(event, 0) for event in RandomStreams.events]
+            
+            parts.append(_streams_layout.pack(streams.seed, *counts))
+        
+        return b"".join(parts)
+    
+    # rebuild a run from the bytes made by to_bytes.  rules must be the rules the run was played with (default_rules if None).
+    # raises InvalidStateException if data isn't a run in this layout version or was made with other rules.
+    @classmethod
+    def from_bytes(cls, data, rules=None, logging=False):
+        if rules is None:
+            rules = default_rules
+        
+        item_names = rules.item_names
+        num_item_types = len(item_names)
+        layout = _fixed_layout(num_item_types)
+        
+        try:
+            fields = layout.unpack_from(data, 0)
+        except struct.error:
+            raise InvalidStateException("not enough bytes for a run")
+        
+        (
+            version,
+            fingerprint,
+            flags,
+            whose_turn_id,
+            who_handcuffed_id,
+            current_round,
+            last_shell,
+            steal_item,
+            truncation_reason,
+            num_shells,
+            matches_won,
+            current_set,
+            sets_won,
+            steps,
+            chamber_bits,
+            public_hash,
+            chamber_hash,
+            counts_hash,
+            player_known_hash,
+            dealer_known_hash
+        ) = fields[:20]
+        
+        if version != run_bytes_version:
+            raise InvalidStateException("can't read run bytes version " + str(version) + ", expected " + str(run_bytes_version))
+        
+        if fingerprint.hex() != rules.fingerprint():
+            raise InvalidStateException("the run was made with different rules (fingerprint " + fingerprint.hex() + ", expected " + rules.fingerprint() + ")")
+        
+        run = cls._copy_blank_run(rules)
+        
+        # everything below is written straight into the fields, the state hash comes from the bytes instead of being kept up to date along the way
+        state_hash = run.state_hash
+        state_hash.public = public_hash
+        state_hash.chamber = chamber_hash
+        state_hash.counts = counts_hash
+        state_hash.known = [player_known_hash, dealer_known_hash]
+        
+        index = 20
+        offset = layout.size
+        
+        try:
+            item_counts = []
+            
+            for participant in (run.player, run.dealer):
+                participant._health, participant._current_max_health, known_mask, known_values, num_items = fields[index:index + 5]
+                
+                participant.item_counts_for_bugged_limits = dict(zip(item_names, fields[index + 5:index + 5 + num_item_types]))
+                participant.known_sequence = [(live_token if known_values >> i & 1 else blank_token) if known_mask >> i & 1 else None for i in range(num_shells)]
+                
+                item_counts.append(num_items)
+                index += 5 + num_item_types
+            
+            dealer = run.dealer
+            dealer_target, known_shell, knows_shell, dealer_flags, array_length = fields[index:index + 5]
+            
+            dealer._dealer_target = _dealer_targets[dealer_target]
+            dealer._known_shell = _known_shells[known_shell]
+            dealer._dealer_knows_shell = _knows_shell[knows_shell]
+            dealer.using_medicine = bool(dealer_flags & 1)
+            dealer.using_handsaw = bool(dealer_flags & 2)
+            dealer.main_loop_finished = bool(dealer_flags & 4)
+            
+            player_items_end = offset + item_counts[0]
+            dealer_items_end = player_items_end + item_counts[1]
+            array_end = dealer_items_end + array_length
+            
+            if array_end > len(data):
+                raise InvalidStateException("run bytes are cut short")
+            
+            run.player.inventory.items = [item_names[item_id] for item_id in data[offset:player_items_end]]
+            run.dealer.inventory.items = [item_names[item_id] for item_id in data[player_items_end:dealer_items_end]]
+            dealer._item_array_dealer = [item_names[item_id] for item_id in data[dealer_items_end:array_end]]
+            dealer._item_array_cigs = dealer._item_array_dealer.count("cigs")
+            
+            offset = array_end
+            
+            if flags & _limits_flag:
+                run.limits = RunLimits(*[None if value == 0 else value for value in _limits_layout.unpack_from(data, offset)])
+                offset += _limits_layout.size
+            
+            if flags & _streams_flag:
+                stream_seed, *counts = _streams_layout.unpack_from(data, offset)
+                offset += _streams_layout.size
+                
+                run.streams = RandomStreams(stream_seed)
+                run.streams.position = (matches_won, current_round, current_set)
+                run.streams.counts = {event: count for event, count in zip(RandomStreams.events, counts) if count > 0}
+            
+            run.desired_steal_item = None if steal_item == 255 else item_names[steal_item]
+            run.last_shell_fired = _last_shells[last_shell]
+            run.truncation_reason = _truncation_reasons[truncation_reason]
+        except (struct.error, IndexError):
+            raise InvalidStateException("run bytes are cut short or corrupted")
+        
+        if offset != len(data):
+            raise InvalidStateException("run bytes have " + str(len(data) - offset) + " extra bytes at the end")
+        
+        run.chamber = [live_token if chamber_bits >> i & 1 else blank_token for i in range(num_shells)]
+        
+        run._whose_turn_id = whose_turn_id
+        run._who_handcuffed_id = who_handcuffed_id
+        run._is_sawed_off = bool(flags & _sawed_off_flag)
+        
+        run._current_round = current_round
+        run._current_set = current_set
+        run._matches_won = matches_won
+        run.sets_won = sets_won
+        run.steps = steps
+        
+        run.game_over = bool(flags & _game_over_flag)
+        run.truncated = bool(flags & _truncated_flag)
+        
+        if logging:
+            run.logging = True
+            run.subscribe(print_event)
+        
+        return run
+    
+    # a copy of a run fresh out of setup (no health, shells or items) for rules.  the run that's copied is only set up once per rule set.
+    # every mutable part of the run is replaced with its own copy here, so runs made this way never share anything but the rules
+    @classmethod
+    def _copy_blank_run(cls, rules):
+        blank = _blank_runs.get(rules.fingerprint())
+        
+        if blank is None:
+            blank = cls.__new__(cls)
+            blank.setup(False, rules)
+            
+            _blank_runs[rules.fingerprint()] = blank
+        
+        run = cls.__new__(cls)
+        run.__dict__.update(blank.__dict__)
+        
+        run.state_hash = StateHash()
+        run.chamber = []
+        run.subscribers = []
+        
+        for name in ("player", "dealer"):
+            blank_participant = getattr(blank, name)
+            
+            participant = blank_participant.__class__.__new__(blank_participant.__class__)
+            participant.__dict__.update(blank_participant.__dict__)
+            
+            participant.state_hash = run.state_hash
+            participant.known_sequence = []
+            participant.item_counts_for_bugged_limits = dict(blank_participant.item_counts_for_bugged_limits)
+            
+            inventory = Inventory.__new__(Inventory)
+            inventory.__dict__.update(blank_participant.inventory.__dict__)
+            inventory.items = []
+            inventory.count_listener = participant.on_item_count_change
+            
+            participant.inventory = inventory
+            
+            setattr(run, name, participant)
+        
+        run.dealer._item_array_dealer = []
+        run.dealer._item_array_cigs = 0
+        
+        return run
+    
+    # where the random numbers for event come from: the global random module, or the event's own stream if the run has streams
+    def rng(self, event):
+        if self.streams is None:
+            return random
+        
+        return self.streams.get(self, event)
     
     def rounds_won(self):
-        return self.matches_won * rounds_per_match + (self.current_round - 1)
+        return self.matches_won * self.rules.rounds_per_match + (self.current_round - 1)
+    
+    # subscribe callback to every event this run emits.  returns callback so that it can be unsubscribed later.
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+        
+        return callback
+    
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+    
+    # only call this if there are subscribers, so that the event doesn't get created for nothing
+    def emit(self, event):
+        for callback in self.subscribers:
+            callback(event)
+    
+    # turn, handcuff, sawed off state and the position in the run are properties so that the state hash sees every change to them
+    @property
+    def whose_turn_id(self):
+        return self._whose_turn_id
+    
+    @whose_turn_id.setter
+    def whose_turn_id(self, new_id):
+        self.state_hash.replace("turn", None, self._whose_turn_id, new_id)
+        self._whose_turn_id = new_id
+    
+    @property
+    def who_handcuffed_id(self):
+        return self._who_handcuffed_id
+    
+    @who_handcuffed_id.setter
+    def who_handcuffed_id(self, new_id):
+        self.state_hash.replace("handcuffed", None, self._who_handcuffed_id, new_id)
+        self._who_handcuffed_id = new_id
+    
+    @property
+    def is_sawed_off(self):
+        return self._is_sawed_off
+    
+    @is_sawed_off.setter
+    def is_sawed_off(self, sawed_off):
+        self.state_hash.replace("sawed_off", None, self._is_sawed_off, sawed_off)
+        self._is_sawed_off = sawed_off
+    
+    # whether items reset at the end of a round depends on the match and round, and the first set of a round has its own item rules
+    @property
+    def matches_won(self):
+        return self._matches_won
+    
+    @matches_won.setter
+    def matches_won(self, matches_won):
+        self.state_hash.replace("match", None, self._matches_won, matches_won)
+        self._matches_won = matches_won
+    
+    @property
+    def current_round(self):
+        return self._current_round
+    
+    @current_round.setter
+    def current_round(self, current_round):
+        self.state_hash.replace("round", None, self._current_round, current_round)
+        self._current_round = current_round
+    
+    @property
+    def current_set(self):
+        return self._current_set
+    
+    @current_set.setter
+    def current_set(self, current_set):
+        self.state_hash.replace("set", None, self._current_set, current_set)
+        self._current_set = current_set
+    
+    # O(1) zobrist hash of the current game state.  if seat_id is given, the hash only covers what that seat can see (shell counts instead of the chamber order, and only its own known shells).
+    def get_state_hash(self, seat_id=None):
+        if seat_id is None:
+            return self.state_hash.full()
+        else:
+            return self.state_hash.seat_view(seat_id)
         
     # check integer ids
     def is_player(self, int_id):
@@ -709,31 +1761,55 @@ class BuckshotRun():
         self.player.pop_known_sequence()
         self.dealer.pop_known_sequence()
         
-        return self.chamber.pop(0)
+        shell = self.chamber.pop(0)
+        
+        self.state_hash.toggle_shell(len(self.chamber), shell)
+        self.state_hash.set_counts(self.num_live(), self.num_blank())
+        
+        return shell
     
     def invert_next_shell(self):
+        pos = len(self.chamber) - 1
+        
+        self.state_hash.toggle_shell(pos, self.chamber[0])
+        
         if self.chamber[0] == live_token:
             self.chamber[0] = blank_token
         else:
             self.chamber[0] = live_token
         
+        self.state_hash.toggle_shell(pos, self.chamber[0])
+        self.state_hash.set_counts(self.num_live(), self.num_blank())
+        
     def chamber_is_empty(self):
         return len(self.chamber) == 0
     
+    # replace the whole chamber, keeping the state hash up to date
+    def set_chamber(self, sequence):
+        for i, shell in enumerate(self.chamber):
+            self.state_hash.toggle_shell(len(self.chamber) - 1 - i, shell)
+        
+        self.chamber = sequence
+        
+        for i, shell in enumerate(self.chamber):
+            self.state_hash.toggle_shell(len(self.chamber) - 1 - i, shell)
+        
+        self.state_hash.set_counts(self.num_live(), self.num_blank())
+    
     def empty_chamber(self):
-        self.chamber = []
+        self.set_chamber([])
     
     def load_chamber(self):
-        self.chamber = get_random_chamber_sequence()
+        self.set_chamber(get_random_chamber_sequence(self.rules, self.rng("chamber")))
     
     def get_last_shell_fired(self):
         return self.last_shell_fired
     
     def is_match_over(self):
-        return self.current_round > rounds_per_match
+        return self.current_round > self.rules.rounds_per_match
     
     def give_both_random_health(self):
-        health = get_random_health()
+        health = get_random_health(self.rules, self.rng("health"))
         
         self.player.set_health(health)
         self.dealer.set_health(health)
@@ -743,9 +1819,9 @@ class BuckshotRun():
         if shell_is_blank(shell):
             return 0
         elif self.is_sawed_off:
-            return sawedoff_live_damage
+            return self.rules.sawedoff_live_damage
         else:
-            return base_live_damage
+            return self.rules.base_live_damage
     
     def swap_turn(self):
         if self.is_player(self.whose_turn_id):
@@ -784,7 +1860,7 @@ class BuckshotRun():
         user, opposite = self.whose_turn()
         
         if user.has_item(item_name):
-            if self.logging: print(user.name + " used " + item_name)
+            if self.subscribers: self.emit(ItemUsedEvent(user.name, item_name))
             
             # use item
             self.call_item_behavior(item_name, user, opposite)
@@ -799,6 +1875,31 @@ class BuckshotRun():
         
         self.use_item("adrenaline")
         
+    # applies a decision in the format returned by BuckshotPredictor_CrossEntropy.make_decision_from_game_state for whomever has this turn:
+    # ("use", item_name), ("use", "adrenaline", steal_item_name), ("shoot", "self") or ("shoot", "dealer")
+    # returns True if the decision ended the participant's sequence of actions (a shot was fired or the round got reset) and False if they should decide again.
+    # NoItemException and InvalidItemException are passed on to the caller.
+    def apply_decision(self, decision):
+        action = decision[0]
+        
+        if action == "use":
+            try:
+                if decision[1] == "adrenaline":
+                    self.use_adrenaline(decision[2])
+                else:
+                    self.use_item(decision[1])
+            except RoundResetException:
+                # turn ends early
+                return True
+            
+            return False
+        elif action == "shoot":
+            self.shoot(shooting_self=decision[1] == "self")
+            
+            return True
+        else:
+            raise ValueError("unknown action " + str(action))
+    
     # whomever has this turn fires the gun.  because shooting the gun tends to be the last action before switching turns, sets, etc., this also handles most of the state transition logic
     def shoot(self, shooting_self):
         shell = self.pop_next_shell()
@@ -806,15 +1907,17 @@ class BuckshotRun():
         
         shooter, opposite = self.whose_turn()
         
+        self.steps += 1
+        
         if not shooting_self:
-            if self.logging: print(shooter.name + " shot " + opposite.name)
+            if self.subscribers: self.emit(ShotFiredEvent(shooter.name, opposite.name, shell, damage))
             
             opposite.take_damage(damage)
             
             if not self.is_handcuffed(opposite, uncuff=True):
                 self.swap_turn()
         else:
-            if self.logging: print(shooter.name + " shot themselves")
+            if self.subscribers: self.emit(ShotFiredEvent(shooter.name, shooter.name, shell, damage))
             
             shooter.take_damage(damage)
             
@@ -842,6 +1945,8 @@ class BuckshotRun():
             if self.chamber_is_empty():
                 self.on_set_end()
         
+        self.check_limits()
+        
         # return fired shell
         return shell
     
@@ -864,30 +1969,38 @@ class BuckshotRun():
         self.whose_turn_id = self.player_id
         
         # give each items
-        num_items = random.randint(min_items_per_set, max_items_per_set)
+        items_rng = self.rng("items")
+        num_items = items_rng.randint(self.rules.min_items_per_set, self.rules.max_items_per_set)
         
         # calculate limits
-        player_limit_inventory = self.player.get_limit_inventory()
-        dealer_limit_inventory = self.dealer.get_limit_inventory()
+        player_limits = self.player.get_limit_array()
+        dealer_limits = self.dealer.get_limit_array()
         
         # don't allow handsaw on very first set if health is 2=
-        if self.current_set == 0 and self.player.current_max_health == 2:
-            player_limit_inventory.consume_item("handsaw", consume_all=True)
-            dealer_limit_inventory.consume_item("handsaw", consume_all=True)
+        handsaw_id = self.rules.item_ids.get("handsaw")
+        
+        if self.current_set == 0 and self.player.current_max_health == 2 and not handsaw_id is None:
+            player_limits[handsaw_id] = 0
+            dealer_limits[handsaw_id] = 0
         
-        player_items = Inventory.get_random_items(num_items, limits=player_limit_inventory)
-        dealer_items = Inventory.get_random_items(num_items, limits=dealer_limit_inventory)
+        player_items, dealer_items = draw_set_items(num_items, (player_limits, dealer_limits), self.rules, items_rng)
         
-        self.player.give_items(player_items)
-        self.dealer.give_items(dealer_items)
+        self.player.give_item_list(player_items)
+        self.dealer.give_item_list(dealer_items)
+        
+        if self.subscribers: self.emit(SetEndedEvent(self.sets_won, self.num_live(), self.num_blank(), player_items, dealer_items))
         
         self.current_set += 1
         
+        self.check_limits()
+        
     def on_round_end(self):
         # advance to next round
         self.current_round += 1
         
-        if self.is_match_over():
+        match_won = self.is_match_over()
+        
+        if match_won:
             self.matches_won += 1
             
             self.current_round = 1
@@ -896,10 +2009,13 @@ class BuckshotRun():
             self.player.reset_items()
             self.dealer.reset_items()
         
-        self.give_both_random_health()
+        if self.subscribers: self.emit(RoundEndedEvent(self.rounds_won(), self.matches_won, match_won))
         
+        # the set is reset before health is drawn, so the new round's health stream is keyed on the round alone and not on how many sets the last round took (see RandomStreams)
         self.current_set = 0
         
+        self.give_both_random_health()
+        
         self.on_set_end()
         
     # if it's the dealer's turn, run the dealer ai until the dealer finishes his turn.
@@ -907,28 +2023,71 @@ class BuckshotRun():
         if not self.is_player_turn():
             self.dealer.take_turn(self)
         
+    # run dealer turns (swallowing the RoundResetException that ends some of them) until the player has to decide or the game is over.
+    # returns True if the player has to decide and False if the game is over, so a whole game is just: while run.advance_to_player_decision(): (player actions)
+    def advance_to_player_decision(self):
+        while not self.is_over() and self.whose_turn_id != self.player_id:
+            try:
+                self.dealer.take_turn(self)
+            except RoundResetException:
+                pass
+        
+        return not self.is_over()
+    
+    # truncate the run if it has reached one of its limits.  limits are only checked after shots and new sets, so a run is never cut off in the middle of a shot
+    def check_limits(self):
+        if self.truncated or self.game_over:
+            return
+        
+        reason = self.limits.reached(self)
+        
+        if not reason is None:
+            self.truncated = True
+            self.truncation_reason = reason
+            
+            if self.subscribers: self.emit(RunTruncatedEvent(reason, self.rounds_won(), self.sets_won))
+    
+    # True once the player died or the run was truncated
     def is_over(self):
-        return self.game_over
+        return self.game_over or self.truncated
+    
+    # "playing", "dead" (game over) or "truncated" (stopped at a limit with the player alive)
+    def status(self):
+        if self.game_over:
+            return "dead"
+        elif self.truncated:
+            return "truncated"
+        else:
+            return "playing"
     
     def call_item_behavior(self, item_name, user, opposite):
-        return all_item_behaviors[item_name](self, user, opposite)
+        return self.rules.item_behaviors[item_name](self, user, opposite)
 
 # simple wrapper around single run.  mostly for debugging, not really intended to be fun gameplay.
 def main(argc, argv):
+    # python -m buckshot simulate [options] plays games headless instead, see simulate.py
+    if argc > 1 and argv[1] == "simulate":
+        import simulate
+        
+        return simulate.main(argc - 1, argv[1:])
+    
     def get_user_input(prompt):
         return input(prompt + ": ").strip().lower()
     
     run = BuckshotRun()
     
-    # debugging lines for giving player items to test at start
-    # test_inventory = Inventory()
+    # debugging lines for starting in a specific state
+    # run = BuckshotRun.from_state([live_token, blank_token], player_health=2, dealer_health=1, dealer_max_health=2, dealer_items=["medicine"])
     
-    # test_inventory.add_item("medicine", 1)
-    # run.dealer.health = 1
+    # the dealer's shots happen inside advance_to_player_decision, so they're reported as they happen
+    def print_dealer_shot(event):
+        if isinstance(event, ShotFiredEvent) and event.shooter == run.dealer.name:
+            print("shell was live" if shell_is_live(event.shell) else "shell was blank")
+            print("")
     
-    # run.dealer.give_items(test_inventory)
+    run.subscribe(print_dealer_shot)
     
-    while not run.is_over():
+    while run.advance_to_player_decision():
         # print(run.chamber)
         print("round " + str(run.current_round))
         print("set " + str(run.current_set))
@@ -948,80 +2107,73 @@ def main(argc, argv):
         print("known sequence: "  + str(run.player.known_sequence))
         print("")
         
-        if run.is_player_turn():
-            dont_shoot = False
+        dont_shoot = False
+        
+        while True:
+            use_item = get_user_input("use an item?  enter name or press enter for no")
             
-            while True:
-                use_item = get_user_input("use an item?  enter name or press enter for no")
-                
-                if use_item == "":
-                    break
+            if use_item == "":
+                break
+            
+            try:
+                used_adrenaline = False
                 
-                try:
-                    used_adrenaline = False
-                    
-                    if use_item == "adrenaline":
-                        # run special adrenaline behavior
-                        use_item = get_user_input("what are you stealing?")
-                        
-                        run.use_adrenaline(use_item)
-                        
-                        used_adrenaline = True
-                        
-                        # print("used adrenaline to steal " + use_item)
-                    else:
-                        run.use_item(use_item)
-                        
-                        # print("used " + use_item)
+                if use_item == "adrenaline":
+                    # run special adrenaline behavior
+                    use_item = get_user_input("what are you stealing?")
                     
-                    print("")
+                    run.use_adrenaline(use_item)
                     
-                    if use_item == "cigs" or use_item == "medicine":
-                        print("player health: " + str(run.player.health))
-                    elif use_item == "magnifier" or use_item == "phone" or use_item == "beer":
-                        if use_item == "beer":
-                            print("num live: " + str(run.num_live()))
-                            print("num blank: " + str(run.num_blank()))
-                        
-                        print("known sequence: "  + str(run.player.known_sequence))
+                    used_adrenaline = True
                     
-                    print("player items: " + str(run.player.inventory))
+                    # print("used adrenaline to steal " + use_item)
+                else:
+                    run.use_item(use_item)
                     
-                    if used_adrenaline:
-                        print("dealer items: " + str(run.dealer.inventory))
+                    # print("used " + use_item)
+                
+                print("")
+                
+                if use_item == "cigs" or use_item == "medicine":
+                    print("player health: " + str(run.player.health))
+                elif use_item == "magnifier" or use_item == "phone" or use_item == "beer":
+                    if use_item == "beer":
+                        print("num live: " + str(run.num_live()))
+                        print("num blank: " + str(run.num_blank()))
                     
-                    print("")
-                except NoItemException as e:
-                    print(e)
-                except InvalidItemException as e:
-                    print(e)
-                except RoundResetException as e:
-                    # skip item usage and gunshot
-                    dont_shoot = True
-                    break
-
-            while not dont_shoot:
-                who_to_shoot = get_user_input("who to shoot?  type \"dealer\" or \"self\"")
+                    print("known sequence: "  + str(run.player.known_sequence))
                 
-                if who_to_shoot == "dealer":
-                    fired = run.shoot(shooting_self=False)
-                    break
-                elif who_to_shoot == "self":
-                    fired = run.shoot(shooting_self=True)
-                    break
-                else:
-                    print("pick!")
-            
-            # print("taking player turn")
-            # run.shoot(shell_is_blank(run.peek_next_shell()))
-            # run.shoot(bool(random.randint(0, 1)))
-        else:
-            print("taking dealer turn")
-            try:
-                run.dealer_ai_turn()
-            except RoundResetException:
+                print("player items: " + str(run.player.inventory))
+                
+                if used_adrenaline:
+                    print("dealer items: " + str(run.dealer.inventory))
+                
+                print("")
+            except NoItemException as e:
+                print(e)
+            except InvalidItemException as e:
+                print(e)
+            except RoundResetException as e:
+                # skip item usage and gunshot
                 dont_shoot = True
+                break
+
+        while not dont_shoot:
+            who_to_shoot = get_user_input("who to shoot?  type \"dealer\" or \"self\"")
+            
+            if who_to_shoot == "dealer":
+                fired = run.shoot(shooting_self=False)
+                break
+            elif who_to_shoot == "self":
+                fired = run.shoot(shooting_self=True)
+                break
+            else:
+                print("pick!")
         
+        # print("taking player turn")
+        # run.shoot(shell_is_blank(run.peek_next_shell()))
+        # run.shoot(bool(random.randint(0, 1)))
+
         fired = run.get_last_shell_fired()
         
         if not dont_shoot:
@@ -1036,4 +2188,4 @@ def main(argc, argv):
     print("Game over!")
 
 if __name__ == "__main__":
-    main(len(sys.argv), sys.argv)
\ No newline at end of file
+    sys.exit(main(len(sys.argv), sys.argv))
\ No newline at end of file
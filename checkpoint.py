@@ -0,0 +1,276 @@
+### checkpoints ###
+# a checkpoint is one flat file that holds any nested structure of dicts, lists, tensors and plain json values, like the weights of a predictor together with its optimizer state, sampling distribution and rng states.
+# the file layout is:
+    # 8 bytes of magic (b"BSHOTCKP"), then the format version and the header length as little endian uint32 and uint64
+    # the header, utf-8 json: {"tree": the structure with every tensor replaced by {"__tensor__": index}, "tensors": [{"dtype", "shape", "offset", "nbytes"}, ...]}
+    # padding up to a multiple of 64 bytes, then the raw bytes of every tensor.  tensor offsets in the header are counted from there, and each is a multiple of 64 bytes
+# reading maps the file into memory and makes tensors directly on top of the mapping (copy on write), so loading a checkpoint doesn't copy or even read any weights until they're used, and many worker processes loading the same file share its pages.
+# writing goes to a temporary file that is renamed over the old checkpoint once it's complete, so a crash mid-save never leaves a broken checkpoint behind.
+
+import os
+import sys
+import json
+import ctypes
+import mmap
+import time
+import pickle
+import random
+import struct
+import concurrent.futures
+
+import torch
+
+import buckshot
+
+magic = b"BSHOTCKP"
+checkpoint_version = 1
+
+# every tensor's data starts on a multiple of this
+alignment = 64
+
+_preamble = struct.Struct("<8sIQ")
+
+class CheckpointFormatException(Exception):
+    pass
+
+def _align(offset):
+    return (offset + alignment - 1) // alignment * alignment
+
+# split tree into a json-able structure and a list of the tensors it contains
+def _flatten(tree, tensors):
+    if isinstance(tree, torch.Tensor):
+        tensors.append(tree.detach().cpu().contiguous())
+        
+        return {"__tensor__": len(tensors) - 1}
+    elif isinstance(tree, dict):
+        # json only has string keys, so keys are stored as [key, value] pairs to keep ints (like optimizer parameter ids) as ints
+        return {"__dict__": [[key, _flatten(value, tensors)] for key, value in tree.items()]}
+    elif isinstance(tree, (list, tuple)):
+        return {"__tuple__" if isinstance(tree, tuple) else "__list__": [_flatten(value, tensors) for value in tree]}
+    else:
+        return tree
+
+def _unflatten(tree, tensors):
+    if isinstance(tree, dict):
+        if "__tensor__" in tree:
+            return tensors[tree["__tensor__"]]
+        elif "__dict__" in tree:
+            return {key if not isinstance(key, list) else tuple(key): _unflatten(value, tensors) for key, value in tree["__dict__"]}
+        elif "__tuple__" in tree:
+            return tuple(_unflatten(value, tensors) for value in tree["__tuple__"])
+        else:
+            return [_unflatten(value, tensors) for value in tree["__list__"]]
+    else:
+        return tree
+
+def save_checkpoint(path, tree):
+    tensors = []
+    flat_tree = _flatten(tree, tensors)
+    
+    # offsets are counted from the start of the data, which is right after the header
+    entries = []
+    offset = 0
+    
+    for tensor in tensors:
+        entries.append({"dtype": str(tensor.dtype).replace("torch.", ""), "shape": list(tensor.shape), "offset": offset, "nbytes": tensor.numel() * tensor.element_size()})
+        
+        offset = _align(offset + entries[-1]["nbytes"])
+    
+    header = json.dumps({"tree": flat_tree, "tensors": entries}).encode()
+    data_start = _align(_preamble.size + len(header))
+    
+    temp_path = path + ".tmp"
+    
+    with open(temp_path, "wb") as f:
+        f.write(_preamble.pack(magic, checkpoint_version, len(header)))
+        f.write(header)
+        
+        for tensor, entry in zip(tensors, entries):
+            f.seek(data_start + entry["offset"])
+            
+            # the tensor's memory as raw bytes, so every dtype (including bfloat16) is written the same way
+            f.write((ctypes.c_char * entry["nbytes"]).from_address(tensor.data_ptr()))
+        
+        f.truncate(data_start + offset)
+        
+        f.flush()
+        os.fsync(f.fileno())
+    
+    os.replace(temp_path, path)
+
+# load a checkpoint written by save_checkpoint.  tensors are copy on write views of the mapped file: writing to one only ever changes this process's copy, never the file.
+def load_checkpoint(path):
+    with open(path, "rb") as f:
+        preamble = f.read(_preamble.size)
+        
+        if len(preamble) < _preamble.size:
+            raise CheckpointFormatException(path + " is too short to be a checkpoint")
+        
+        file_magic, version, header_length = _preamble.unpack(preamble)
+        
+        if file_magic != magic:
+            raise CheckpointFormatException(path + " isn't a checkpoint")
+        
+        if version != checkpoint_version:
+            raise CheckpointFormatException(path + " is checkpoint version " + str(version) + ", expected " + str(checkpoint_version))
+        
+        header = json.loads(f.read(header_length))
+        data_start = _align(_preamble.size + header_length)
+        
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY) if len(header["tensors"]) > 0 else None
+    
+    tensors = []
+    
+    for entry in header["tensors"]:
+        dtype = getattr(torch, entry["dtype"])
+        
+        if entry["nbytes"] == 0:
+            tensor = torch.empty(entry["shape"], dtype=dtype)
+        else:
+            # the tensors keep the mapping alive
+            tensor = torch.frombuffer(mapping, dtype=torch.uint8, count=entry["nbytes"], offset=data_start + entry["offset"]).view(dtype).view(entry["shape"])
+        
+        tensors.append(tensor)
+    
+    return _unflatten(header["tree"], tensors)
+
+## predictors ##
+
+_predictor_modules = ("core_model", "who_to_shoot_or_use_item", "which_item_to_use", "which_item_to_steal")
+
+# everything about a predictor worth saving.  optimizer is a torch optimizer training its weights, and extra is any other training state (like the mean and deviation of a cross entropy method's sampling distribution).
+def predictor_state(predictor, optimizer=None, extra=None):
+    return {
+        "rules_fingerprint": predictor.rules.fingerprint(),
+        "input_size": predictor.input_size,
+        "weights": {module_name: getattr(predictor, module_name).state_dict() for module_name in _predictor_modules},
+        "optimizer": None if optimizer is None else optimizer.state_dict(),
+        "extra": extra,
+        "rng": {
+            "predictor": predictor.generator.get_state(),
+            "torch": torch.get_rng_state(),
+            "python": random.getstate()
+        }
+    }
+
+def save_predictor(path, predictor, optimizer=None, extra=None):
+    save_checkpoint(path, predictor_state(predictor, optimizer, extra))
+
+# load a checkpoint saved with save_predictor into a new predictor for rules (default_rules if None).  the weights are used in place from the mapped file when the predictor lives on the cpu.
+# if optimizer is given, its state is restored too.  if restore_rng, the global torch and python rng states are restored along with the predictor's own generator.
+# returns (predictor, extra)
+def load_predictor(path, rules=None, optimizer=None, restore_rng=False):
+    from cross_entropy import BuckshotPredictor_CrossEntropy, FusedPredictor
+    
+    if rules is None:
+        rules = buckshot.default_rules
+    
+    state = load_checkpoint(path)
+    
+    if state["rules_fingerprint"] != rules.fingerprint():
+        raise CheckpointFormatException(path + " was saved for rules " + state["rules_fingerprint"] + ", not " + rules.fingerprint())
+    
+    predictor = BuckshotPredictor_CrossEntropy(rules)
+    
+    for module_name in _predictor_modules:
+        module = getattr(predictor, module_name)
+        
+        if next(module.parameters()).device.type == "cpu":
+            module.load_state_dict(state["weights"][module_name], assign=True)
+        else:
+            module.load_state_dict(state["weights"][module_name])
+    
+    # assigning replaced the layers' parameters, so the fused module has to be rebuilt on top of them
+    predictor.fused = FusedPredictor(predictor)
+    
+    predictor.generator.set_state(state["rng"]["predictor"].clone())
+    
+    if not optimizer is None and not state["optimizer"] is None:
+        optimizer.load_state_dict(state["optimizer"])
+    
+    if restore_rng:
+        torch.set_rng_state(state["rng"]["torch"].clone())
+        random.setstate(state["rng"]["python"])
+    
+    return predictor, state["extra"]
+
+# load a checkpoint saved with save_predictor into an existing predictor, copying the weights in place so that an optimizer made for the predictor's parameters keeps training them.  this is how a training job picks up where it left off, see jobs.run_training.
+# optimizer and restore_rng are the same as for load_predictor.  returns extra
+def restore_predictor(path, predictor, optimizer=None, restore_rng=False):
+    state = load_checkpoint(path)
+    
+    if state["rules_fingerprint"] != predictor.rules.fingerprint():
+        raise CheckpointFormatException(path + " was saved for rules " + state["rules_fingerprint"] + ", not " + predictor.rules.fingerprint())
+    
+    for module_name in _predictor_modules:
+        getattr(predictor, module_name).load_state_dict(state["weights"][module_name])
+    
+    predictor.generator.set_state(state["rng"]["predictor"].clone())
+    
+    if not optimizer is None and not state["optimizer"] is None:
+        optimizer.load_state_dict(state["optimizer"])
+    
+    if restore_rng:
+        torch.set_rng_state(state["rng"]["torch"].clone())
+        random.setstate(state["rng"]["python"])
+    
+    return state["extra"]
+
+def _load_worker(path, use_pickle):
+    start = time.perf_counter()
+    
+    if use_pickle:
+        with open(path, "rb") as f:
+            predictor = pickle.load(f)
+    else:
+        predictor, extra = load_predictor(path)
+    
+    return time.perf_counter() - start
+
+# python checkpoint.py [path] [workers]
+# saves a predictor with an optimizer, checks that it loads back identically, and compares load times in pool workers against pickle.
+def main(argc, argv):
+    from cross_entropy import BuckshotPredictor_CrossEntropy
+    
+    path = argv[1] if argc > 1 else "predictor.ckpt"
+    workers = int(argv[2]) if argc > 2 else os.cpu_count()
+    
+    predictor = BuckshotPredictor_CrossEntropy()
+    
+    parameters = [parameter for module_name in _predictor_modules for parameter in getattr(predictor, module_name).parameters()]
+    optimizer = torch.optim.Adam(parameters)
+    
+    # one step so the optimizer has state worth saving
+    sum(parameter.sum() for parameter in parameters).backward()
+    optimizer.step()
+    
+    start = time.perf_counter()
+    
+    save_predictor(path, predictor, optimizer, extra={"mean": torch.zeros(len(parameters)), "deviation": torch.ones(len(parameters)), "iteration": 1})
+    
+    print("saved {} ({} bytes) in {:.2f}ms".format(path, os.path.getsize(path), (time.perf_counter() - start) * 1000))
+    
+    loaded, extra = load_predictor(path)
+    
+    matches = all(torch.equal(tensor, getattr(loaded, module_name).state_dict()[name].to(tensor.device)) for module_name in _predictor_modules for name, tensor in getattr(predictor, module_name).state_dict().items())
+    
+    print("weights match: " + str(matches))
+    print("extra state: " + str(extra))
+    
+    pickle_path = path + ".pickle"
+    
+    with open(pickle_path, "wb") as f:
+        pickle.dump(predictor, f)
+    
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for name, use_pickle in (("checkpoint", False), ("pickle", True)):
+            times = list(pool.map(_load_worker, [pickle_path if use_pickle else path] * workers * 4, [use_pickle] * workers * 4))
+            
+            print("{} load: {:.2f}ms mean over {} loads".format(name, sum(times) / len(times) * 1000, len(times)))
+    
+    os.remove(pickle_path)
+    
+    return 0 if matches else 1
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))
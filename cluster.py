@@ -0,0 +1,688 @@
+### multi-node rollouts ###
+# a coordinator hands out blocks of games to workers on any number of hosts over TCP, and adds up what comes back.
+# a job is one policy (a simulate.py policy spec, so "predictor:path" names a checkpoint), some rule overrides and a range of seeds.  it's cut into blocks of block_size seeds, and workers pull one block at a time, play it with policies.play_game and send back only the aggregate (see aggregate), never the games.
+# the protocol is JSON lines like server.py, every request gets one response with the same "id":
+    # {"id": 1, "op": "hello", "name": "host-3"}                  -> "worker" (the id the coordinator gave this connection) and "heartbeat_interval" in seconds
+    # {"id": 2, "op": "pull"}                                     -> "block": {"block", "policy", "rules", "limits", "start_seed", "num_seeds"}, or null and "idle" when no job has unassigned blocks
+    # {"id": 3, "op": "heartbeat"}
+    # {"id": 4, "op": "result", "block": 17, "result": {...}}     -> "accepted" is false if the block was already counted
+    # {"id": 5, "op": "fail", "block": 17, "error": "..."}        -> the block couldn't be played.  it goes back to the queue, and after max_block_failures failures its job fails
+    # {"id": 6, "op": "stats"}
+# a worker that disconnects or isn't heard from for heartbeat_timeout seconds is lost: its connection is closed and its block goes back to the front of the queue.
+# a block is counted exactly once, the first time any worker returns it.  that covers workers that were given up on but finish anyway and send the result after reconnecting, since games are seeded, both results are the same and the late one is dropped.
+# a block that keeps failing (a checkpoint that doesn't exist, say) fails its whole job instead of taking every worker down with it: Coordinator.wait raises JobFailedException with the last error.
+
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import itertools
+import subprocess
+import collections
+
+import buckshot
+import policies
+import simulate
+from server import GameClient, ProtocolError
+
+# the compact result of some games, given as (rounds won, sets won, status) like policies.play_game(..., with_status=True) returns: counts and sums, so blocks can be added together in any order
+def aggregate(results):
+    histogram = collections.Counter(str(rounds) for rounds, sets, status in results)
+    
+    return {
+        "games": len(results),
+        "truncated": sum(1 for rounds, sets, status in results if status == "truncated"),
+        "rounds": sum(rounds for rounds, sets, status in results),
+        "rounds_squared": sum(rounds * rounds for rounds, sets, status in results),
+        "sets": sum(sets for rounds, sets, status in results),
+        "sets_squared": sum(sets * sets for rounds, sets, status in results),
+        "histogram": dict(histogram)
+    }
+
+def merge_aggregates(a, b):
+    histogram = collections.Counter(a["histogram"])
+    histogram.update(b["histogram"])
+    
+    merged = {key: a[key] + b[key] for key in ("games", "truncated", "rounds", "rounds_squared", "sets", "sets_squared")}
+    merged["histogram"] = dict(histogram)
+    
+    return merged
+
+def empty_aggregate():
+    return aggregate([])
+
+# mean and standard deviation from a count, a sum and a sum of squares
+def _mean_stdev(count, total, total_squared):
+    if count == 0:
+        return 0.0, 0.0
+    
+    mean = total / count
+    variance = max(0.0, total_squared - count * mean * mean) / max(1, count - 1)
+    
+    return mean, variance ** 0.5
+
+class Block():
+    def __init__(self, block_id, job, start_seed, num_seeds):
+        self.block_id = block_id
+        self.job = job
+        self.start_seed = start_seed
+        self.num_seeds = num_seeds
+        
+        # the worker holding the lease, None while queued
+        self.worker = None
+        self.done = False
+        self.failures = 0
+    
+    def message(self):
+        return {"block": self.block_id, "policy": self.job.policy, "rules": self.job.rules, "limits": self.job.limits, "start_seed": self.start_seed, "num_seeds": self.num_seeds}
+
+class Job():
+    def __init__(self, job_id, policy, rules, limits, num_games, seed):
+        self.job_id = job_id
+        self.policy = policy
+        self.rules = rules
+        self.limits = limits
+        self.num_games = num_games
+        self.seed = seed
+        
+        self.result = empty_aggregate()
+        self.remaining = 0
+        self.policy_hash = None
+        
+        # the error that failed the job, None unless it did
+        self.error = None
+        
+        self.start = time.perf_counter()
+        self.finished = asyncio.get_running_loop().create_future()
+
+# a job failed because one of its blocks failed max_block_failures times
+class JobFailedException(Exception):
+    pass
+
+class WorkerConnection():
+    def __init__(self, worker_id, writer):
+        self.worker_id = worker_id
+        self.name = "worker-" + str(worker_id)
+        self.writer = writer
+        self.last_seen = time.monotonic()
+        
+        # block ids this worker holds
+        self.leases = set()
+        self.lost = False
+
+class Coordinator():
+    def __init__(self, heartbeat_timeout=5.0, max_block_failures=3):
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_block_failures = max_block_failures
+        
+        self.jobs = dict()
+        self.blocks = dict()
+        self.queue = collections.deque()
+        self.workers = dict()
+        
+        self.job_ids = itertools.count(1)
+        self.block_ids = itertools.count(1)
+        self.worker_ids = itertools.count(1)
+        
+        self.servers = []
+        self.monitor_task = None
+        
+        # accounting, see stats
+        self.requeued = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.failed_blocks = 0
+        self.lost_workers = 0
+    
+    async def start_tcp(self, host="127.0.0.1", port=0):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        
+        self.servers.append(server)
+        
+        if self.monitor_task is None:
+            self.monitor_task = asyncio.get_running_loop().create_task(self.monitor_forever())
+        
+        return server
+    
+    async def close(self):
+        for server in self.servers:
+            server.close()
+        
+        for worker in list(self.workers.values()):
+            worker.writer.close()
+        
+        if not self.monitor_task is None:
+            self.monitor_task.cancel()
+            
+            try:
+                await self.monitor_task
+            except asyncio.CancelledError:
+                pass
+            
+            self.monitor_task = None
+    
+    # queue num_games games (seeds seed to seed + num_games - 1) of policy under the rules with overrides (a dict of rule name -> value), each capped at limits (a dict of buckshot.RunLimits arguments).  returns the job id
+    def submit(self, policy, num_games, seed=0, block_size=100, rules=None, limits=None):
+        rules = dict() if rules is None else dict(rules)
+        limits = dict() if limits is None else dict(limits)
+        
+        # fail here rather than on every worker
+        simulate.check_policy(policy)
+        
+        if num_games < 1 or block_size < 1:
+            raise ValueError("num_games and block_size must be at least 1")
+        
+        buckshot.default_rules.with_overrides(**rules)
+        buckshot.RunLimits(**limits)
+        
+        job = Job(next(self.job_ids), policy, rules, limits, num_games, seed)
+        self.jobs[job.job_id] = job
+        
+        for start in range(seed, seed + num_games, block_size):
+            block = Block(next(self.block_ids), job, start, min(block_size, seed + num_games - start))
+            
+            self.blocks[block.block_id] = block
+            self.queue.append(block.block_id)
+            
+            job.remaining += 1
+        
+        return job.job_id
+    
+    # wait for a job to finish and return its summary.  raises JobFailedException if it failed
+    async def wait(self, job_id):
+        job = self.jobs[job_id]
+        
+        await asyncio.shield(job.finished)
+        
+        return self.summary(job_id)
+    
+    def summary(self, job_id):
+        job = self.jobs[job_id]
+        result = job.result
+        
+        rounds_mean, rounds_stdev = _mean_stdev(result["games"], result["rounds"], result["rounds_squared"])
+        sets_mean, sets_stdev = _mean_stdev(result["games"], result["sets"], result["sets_squared"])
+        
+        elapsed = time.perf_counter() - job.start
+        
+        return {
+            "job": job.job_id,
+            "done": job.remaining == 0,
+            "policy": job.policy,
+            "policy_hash": job.policy_hash,
+            "rules": job.rules,
+            "limits": job.limits,
+            "seed": job.seed,
+            "games": result["games"],
+            "truncated": result["truncated"],
+            "rounds_won": {"mean": rounds_mean, "stdev": rounds_stdev, "histogram": dict(sorted(result["histogram"].items(), key=lambda entry: int(entry[0])))},
+            "sets_won": {"mean": sets_mean, "stdev": sets_stdev},
+            "elapsed_seconds": elapsed,
+            "games_per_second": result["games"] / elapsed
+        }
+    
+    def stats(self):
+        return {
+            "workers": len(self.workers),
+            "queued_blocks": sum(1 for block_id in self.queue if not self.blocks[block_id].done and self.blocks[block_id].job.error is None),
+            "leased_blocks": sum(len(worker.leases) for worker in self.workers.values()),
+            "unfinished_jobs": sum(1 for job in self.jobs.values() if job.remaining > 0 and job.error is None),
+            "failed_jobs": sum(1 for job in self.jobs.values() if not job.error is None),
+            "requeued": self.requeued,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "failed_blocks": self.failed_blocks,
+            "lost_workers": self.lost_workers,
+            "leases": {worker.name: sorted(worker.leases) for worker in self.workers.values()}
+        }
+    
+    # give up on a worker: every block it holds goes back to the front of the queue.  safe to call more than once
+    def lose_worker(self, worker, reason):
+        if worker.lost:
+            return
+        
+        worker.lost = True
+        self.workers.pop(worker.worker_id, None)
+        
+        if reason != "goodbye":
+            self.lost_workers += 1
+        
+        for block_id in sorted(worker.leases, reverse=True):
+            block = self.blocks[block_id]
+            
+            if not block.done and block.worker is worker:
+                block.worker = None
+                self.queue.appendleft(block_id)
+                self.requeued += 1
+        
+        worker.leases.clear()
+        worker.writer.close()
+    
+    async def monitor_forever(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_timeout / 4)
+            
+            now = time.monotonic()
+            
+            for worker in list(self.workers.values()):
+                if now - worker.last_seen > self.heartbeat_timeout:
+                    self.lose_worker(worker, "timeout")
+    
+    async def handle_connection(self, reader, writer):
+        worker = WorkerConnection(next(self.worker_ids), writer)
+        self.workers[worker.worker_id] = worker
+        
+        try:
+            while True:
+                line = await reader.readline()
+                
+                if not line:
+                    break
+                
+                worker.last_seen = time.monotonic()
+                
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    response = {"id": None, "ok": False, "error": "bad json"}
+                else:
+                    response = self.handle_request(worker, request)
+                
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.lose_worker(worker, "goodbye" if len(worker.leases) == 0 else "disconnected")
+    
+    def handle_request(self, worker, request):
+        response = {"id": request.get("id"), "ok": True}
+        op = request.get("op")
+        
+        try:
+            if worker.lost:
+                raise ProtocolError("this connection was given up on, reconnect")
+            
+            if op == "hello":
+                worker.name = str(request.get("name", worker.name))
+                
+                response["worker"] = worker.worker_id
+                response["heartbeat_interval"] = self.heartbeat_timeout / 3
+            elif op == "pull":
+                response["block"] = self.lease(worker)
+                response["idle"] = response["block"] is None
+            elif op == "heartbeat":
+                pass
+            elif op == "result":
+                response["accepted"] = self.accept(worker, request.get("block"), request.get("result"), request.get("policy_hash"))
+            elif op == "fail":
+                self.fail(worker, request.get("block"), str(request.get("error")))
+            elif op == "stats":
+                response["stats"] = self.stats()
+            else:
+                raise ProtocolError("unknown op " + str(op))
+        except (ProtocolError, KeyError, TypeError) as e:
+            response = {"id": request.get("id"), "ok": False, "error": type(e).__name__ + ": " + str(e)}
+        
+        return response
+    
+    def lease(self, worker):
+        while len(self.queue) > 0:
+            block = self.blocks[self.queue.popleft()]
+            
+            # a requeued block can be finished late by the worker that was given up on
+            if block.done or not block.worker is None or not block.job.error is None:
+                continue
+            
+            block.worker = worker
+            worker.leases.add(block.block_id)
+            
+            return block.message()
+        
+        return None
+    
+    # count a block's result if it's the first one.  returns whether it was counted
+    def accept(self, worker, block_id, result, policy_hash):
+        block = self.blocks.get(block_id)
+        
+        if block is None:
+            raise ProtocolError("unknown block " + str(block_id))
+        
+        if block.done:
+            worker.leases.discard(block_id)
+            self.duplicates += 1
+            
+            return False
+        
+        job = block.job
+        
+        # the job already failed, nobody is waiting for this
+        if not job.error is None:
+            worker.leases.discard(block_id)
+            
+            return False
+        
+        try:
+            if result["games"] != block.num_seeds:
+                raise ProtocolError("block {} has {} games, not {}".format(block_id, result["games"], block.num_seeds))
+            
+            if not job.policy_hash is None and job.policy_hash != policy_hash:
+                raise ProtocolError("block {} was played by a different policy ({}, expected {})".format(block_id, policy_hash, job.policy_hash))
+        except (ProtocolError, KeyError, TypeError):
+            # the result is thrown away, but the block isn't: whoever holds it gives it up and it goes back to the front of the queue.  the worker sees the error in the response
+            worker.leases.discard(block_id)
+            self.rejected += 1
+            
+            if block.worker is worker:
+                block.worker = None
+                self.queue.appendleft(block_id)
+                self.requeued += 1
+            
+            raise
+        
+        worker.leases.discard(block_id)
+        
+        if job.policy_hash is None:
+            job.policy_hash = policy_hash
+        
+        block.done = True
+        
+        # somebody else may still be playing it
+        if not block.worker is None:
+            block.worker.leases.discard(block_id)
+            block.worker = None
+        
+        job.result = merge_aggregates(job.result, result)
+        job.remaining -= 1
+        
+        if job.remaining == 0:
+            job.finished.set_result(None)
+        
+        return True
+    
+    # a worker couldn't play a block.  the block goes back to the front of the queue for another try, unless it has failed max_block_failures times, which fails its job
+    def fail(self, worker, block_id, error):
+        block = self.blocks.get(block_id)
+        
+        if block is None:
+            raise ProtocolError("unknown block " + str(block_id))
+        
+        worker.leases.discard(block_id)
+        
+        if block.done or not block.worker is worker:
+            return
+        
+        block.worker = None
+        block.failures += 1
+        self.failed_blocks += 1
+        
+        job = block.job
+        
+        if block.failures < self.max_block_failures:
+            self.queue.appendleft(block_id)
+            self.requeued += 1
+        elif job.error is None:
+            job.error = "block {} failed {} times, last on {}: {}".format(block_id, block.failures, worker.name, error)
+            
+            # the job's other blocks are skipped from now on, see lease
+            job.finished.set_exception(JobFailedException(job.error))
+
+## workers ##
+
+class Worker():
+    # name shows up in the coordinator's stats.  a worker that loses the coordinator keeps trying to reconnect for reconnect_timeout seconds, and sends the result it was holding once it's back
+    def __init__(self, host, port, name=None, reconnect_timeout=30.0, poll_interval=0.5):
+        self.host = host
+        self.port = port
+        self.name = name if not name is None else "{}-{}".format(os.uname().nodename, os.getpid())
+        self.reconnect_timeout = reconnect_timeout
+        self.poll_interval = poll_interval
+        
+        self.client = None
+        self.lock = None
+        
+        # (policy spec, rules as JSON) -> (policy, rules)
+        self.policies = dict()
+        
+        # (block id, result, policy hash) that hasn't been delivered yet
+        self.pending = None
+        
+        self.blocks_played = 0
+        self.blocks_failed = 0
+    
+    def get_policy(self, spec, overrides):
+        key = (spec, json.dumps(overrides, sort_keys=True))
+        
+        if not key in self.policies:
+            rules = buckshot.default_rules.with_overrides(**overrides)
+            
+            self.policies[key] = (simulate.make_policy(spec, rules), rules)
+        
+        return self.policies[key]
+    
+    def play_block(self, block):
+        policy, rules = self.get_policy(block["policy"], block["rules"])
+        limits = buckshot.RunLimits(**block["limits"])
+        
+        results = [policies.play_game(policy, seed, rules, limits, with_status=True) for seed in range(block["start_seed"], block["start_seed"] + block["num_seeds"])]
+        
+        return aggregate(results), policy.policy_hash()
+    
+    # one request at a time on the connection, the heartbeats share it with the work
+    async def request(self, op, **fields):
+        async with self.lock:
+            return await self.client.request(op, **fields)
+    
+    async def heartbeat_forever(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await self.request("heartbeat")
+    
+    # work until the coordinator goes away.  returns when it couldn't be reached for reconnect_timeout seconds
+    async def run(self):
+        self.lock = asyncio.Lock()
+        
+        unreachable_since = None
+        
+        while True:
+            try:
+                self.client = await GameClient.connect_tcp(self.host, self.port)
+            except OSError:
+                if unreachable_since is None:
+                    unreachable_since = time.monotonic()
+                elif time.monotonic() - unreachable_since > self.reconnect_timeout:
+                    return
+                
+                await asyncio.sleep(self.poll_interval)
+                
+                continue
+            
+            unreachable_since = None
+            
+            try:
+                await self.work()
+            except (ConnectionError, ValueError, ProtocolError):
+                pass
+            finally:
+                self.client.writer.close()
+    
+    async def work(self):
+        hello = await self.request("hello", name=self.name)
+        
+        heartbeat = asyncio.get_running_loop().create_task(self.heartbeat_forever(hello["heartbeat_interval"]))
+        
+        try:
+            while True:
+                if not self.pending is None:
+                    block_id, result, policy_hash = self.pending
+                    
+                    await self.request("result", block=block_id, result=result, policy_hash=policy_hash)
+                    
+                    self.pending = None
+                
+                response = await self.request("pull")
+                
+                if response["block"] is None:
+                    await asyncio.sleep(self.poll_interval)
+                    
+                    continue
+                
+                block = response["block"]
+                
+                # played on a thread so the heartbeats keep going.  a block that can't be played (a missing checkpoint, say) is handed back with the error, and the coordinator decides whether anyone tries it again
+                try:
+                    result, policy_hash = await asyncio.get_running_loop().run_in_executor(None, self.play_block, block)
+                except Exception as e:
+                    await self.request("fail", block=block["block"], error=type(e).__name__ + ": " + str(e))
+                    
+                    self.blocks_failed += 1
+                    
+                    continue
+                
+                self.pending = (block["block"], result, policy_hash)
+                self.blocks_played += 1
+        finally:
+            heartbeat.cancel()
+            
+            try:
+                await heartbeat
+            except (asyncio.CancelledError, ConnectionError, ValueError, ProtocolError):
+                pass
+
+def _start_worker_process(port, name):
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), "worker", "127.0.0.1:" + str(port), name])
+
+# runs a coordinator and num_workers worker processes on localhost.  once they're busy, one worker is killed and another is frozen past the heartbeat timeout and then thawed, so both ways of losing a worker (and a late duplicate result) happen.
+# the totals are checked against playing the same seeds in this process.  then a job whose checkpoint doesn't exist is submitted, which has to fail without taking the workers down.
+# returns (summary, stats, whether the totals match, whether the bad job failed cleanly)
+async def local_test(num_workers, num_games, policy="dealer_logic", block_size=50, heartbeat_timeout=1.0):
+    coordinator = Coordinator(heartbeat_timeout=heartbeat_timeout)
+    
+    tcp_server = await coordinator.start_tcp("127.0.0.1", 0)
+    port = tcp_server.sockets[0].getsockname()[1]
+    
+    job_id = coordinator.submit(policy, num_games, block_size=block_size)
+    
+    processes = {"test-worker-" + str(i): _start_worker_process(port, "test-worker-" + str(i)) for i in range(num_workers)}
+    
+    async def wait_for_lease(name):
+        while len(coordinator.stats()["leases"].get(name, [])) == 0:
+            if coordinator.jobs[job_id].finished.done():
+                return False
+            
+            await asyncio.sleep(0.01)
+        
+        return True
+    
+    names = sorted(processes)
+    
+    if await wait_for_lease(names[0]):
+        processes[names[0]].kill()
+    
+    if num_workers > 2 and await wait_for_lease(names[1]):
+        processes[names[1]].send_signal(signal.SIGSTOP)
+        
+        await asyncio.sleep(heartbeat_timeout * 2)
+        
+        processes[names[1]].send_signal(signal.SIGCONT)
+    
+    summary = await coordinator.wait(job_id)
+    stats = coordinator.stats()
+    
+    # give the thawed worker a moment to hand in its late result
+    await asyncio.sleep(heartbeat_timeout)
+    stats["duplicates"] = coordinator.duplicates
+    
+    bad_job_id = coordinator.submit("predictor:/nonexistent.ckpt", block_size * 2, block_size=block_size)
+    
+    try:
+        await asyncio.wait_for(coordinator.wait(bad_job_id), 60)
+        
+        failed_cleanly = False
+    except JobFailedException:
+        failed_cleanly = all(process.poll() is None for name, process in processes.items() if name != names[0])
+    except asyncio.TimeoutError:
+        failed_cleanly = False
+    
+    stats["failed_blocks"] = coordinator.failed_blocks
+    
+    await coordinator.close()
+    
+    for process in processes.values():
+        process.terminate()
+        process.wait()
+    
+    rules = buckshot.default_rules
+    local_policy = simulate.make_policy(policy, rules)
+    expected = aggregate([policies.play_game(local_policy, seed, rules, with_status=True) for seed in range(num_games)])
+    
+    return summary, stats, coordinator.jobs[job_id].result == expected, failed_cleanly
+
+# python cluster.py coordinator [port] [policy] [num_games] [block_size] -> run one job and print its summary
+# python cluster.py worker [host:port] [name]                          -> play blocks until the coordinator goes away
+# python cluster.py test [num_workers] [num_games]                     -> coordinator and workers on localhost, with worker failures and a failing job
+def main(argc, argv):
+    mode = argv[1] if argc > 1 else "test"
+    
+    if mode == "coordinator":
+        port = int(argv[2]) if argc > 2 else 7778
+        policy = argv[3] if argc > 3 else "random"
+        num_games = int(argv[4]) if argc > 4 else 10000
+        block_size = int(argv[5]) if argc > 5 else 100
+        
+        async def coordinate():
+            coordinator = Coordinator()
+            
+            await coordinator.start_tcp("0.0.0.0", port)
+            
+            job_id = coordinator.submit(policy, num_games, block_size=block_size)
+            
+            print("coordinating on port " + str(port), file=sys.stderr)
+            
+            try:
+                summary = await coordinator.wait(job_id)
+            except JobFailedException as e:
+                summary = {"job": job_id, "done": False, "error": str(e)}
+            
+            summary["stats"] = coordinator.stats()
+            
+            await coordinator.close()
+            
+            return summary
+        
+        summary = asyncio.run(coordinate())
+        
+        print(json.dumps(summary))
+        
+        if "error" in summary:
+            return 1
+    elif mode == "worker":
+        address = argv[2] if argc > 2 else "127.0.0.1:7778"
+        host, _, port = address.rpartition(":")
+        
+        worker = Worker(host, int(port), name=argv[3] if argc > 3 else None)
+        
+        asyncio.run(worker.run())
+    elif mode == "test":
+        num_workers = int(argv[2]) if argc > 2 else 4
+        num_games = int(argv[3]) if argc > 3 else 4000
+        
+        summary, stats, matches, failed_cleanly = asyncio.run(local_test(num_workers, num_games))
+        
+        print(json.dumps(summary, indent=4))
+        print("requeued blocks: {}, duplicate results: {}, lost workers: {}, failed blocks: {}".format(stats["requeued"], stats["duplicates"], stats["lost_workers"], stats["failed_blocks"]))
+        print("totals match a local run: " + ("yes" if matches else "NO"))
+        print("a job with a missing checkpoint failed and the workers kept going: " + ("yes" if failed_cleanly else "NO"))
+        
+        return 0 if matches and failed_cleanly else 1
+    else:
+        print("unknown mode " + mode)
+        
+        return 2
+    
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))
@@ -0,0 +1,224 @@
+### sequential policy comparison ###
+# plays two policies on the same seeds in batches and stops as soon as the difference in rounds won is clearly there or clearly not, instead of always playing a fixed number of games.
+# every seed gives one paired difference: a's rounds won minus b's.  the games are played with common random numbers (see buckshot.RandomStreams), so both policies keep facing the same chambers, health and items for as long as their games line up, which makes the differences much less noisy than just starting from the same game.  after every batch, one of two sequential tests looks at the differences so far:
+    # sprt: two of wald's sequential probability ratio tests on the mean difference (normal approximation, with the variance estimated from the games so far), one for "a is at least delta better" and one for "b is at least delta better", each against "no difference".  a stops the comparison when its alternative is accepted, and when both accept no difference, the policies are within delta of each other.
+    # bootstrap: a percentile bootstrap confidence interval of the mean difference.  it's significant once the interval leaves 0 out, and a clear null once it fits inside (-delta, delta).  alpha is split evenly over every look the comparison could take, so looking after every batch doesn't inflate the error rate.
+# the result has the decision ("a_better", "b_better", "no_difference" or "inconclusive" if max_games ran out), the games used and the effect size (the mean difference and the mean difference in standard deviations).
+
+import sys
+import math
+import time
+import random
+import argparse
+
+import buckshot
+import policies
+import simulate
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the decision for the sprt after the differences so far.  returns (decision or None, log likelihood ratio for a better, for b better)
+def sprt_decision(count, total, variance, delta, alpha, beta):
+    # the ratio only depends on the data through the sum, so this is just a few multiplications per look
+    variance = max(variance, 1e-9)
+    
+    llr_a = (delta * total - count * delta * delta / 2) / variance
+    llr_b = (-delta * total - count * delta * delta / 2) / variance
+    
+    accept_alternative = math.log((1 - beta) / alpha)
+    accept_null = math.log(beta / (1 - alpha))
+    
+    if llr_a >= accept_alternative:
+        return "a_better", llr_a, llr_b
+    elif llr_b >= accept_alternative:
+        return "b_better", llr_a, llr_b
+    elif llr_a <= accept_null and llr_b <= accept_null:
+        return "no_difference", llr_a, llr_b
+    else:
+        return None, llr_a, llr_b
+
+# resample means of differences.  the differences are a handful of distinct integers, so with numpy a resample is just a multinomial draw of how often each one comes up
+def _resample_means(differences, resamples, seed):
+    count = len(differences)
+    
+    if not numpy is None:
+        values = sorted(set(differences))
+        frequencies = [differences.count(value) / count for value in values]
+        
+        counts = numpy.random.default_rng(seed).multinomial(count, frequencies, size=resamples)
+        
+        return sorted((counts @ numpy.array(values, dtype=numpy.float64) / count).tolist())
+    
+    rng = random.Random(seed)
+    
+    return sorted(sum(rng.choices(differences, k=count)) / count for i in range(resamples))
+
+# percentile bootstrap confidence interval of the mean of differences at confidence 1 - alpha.  raises ValueError if there are too few resamples to have one beyond either end of the interval, since the ends would then just be the smallest and largest resample
+def bootstrap_interval(differences, alpha, resamples=1000, seed=0):
+    if alpha / 2 * resamples < 1:
+        raise ValueError("{} resamples are too few for a {:.4%} interval, it takes at least {}".format(resamples, 1 - alpha, math.ceil(2 / alpha)))
+    
+    means = _resample_means(differences, resamples, seed)
+    
+    low = means[min(resamples - 1, int(alpha / 2 * resamples))]
+    high = means[max(0, min(resamples - 1, int(math.ceil((1 - alpha / 2) * resamples)) - 1))]
+    
+    return low, high
+
+def bootstrap_decision(differences, delta, alpha, resamples):
+    low, high = bootstrap_interval(differences, alpha, resamples)
+    
+    if low > 0:
+        return "a_better", (low, high)
+    elif high < 0:
+        return "b_better", (low, high)
+    elif -delta < low and high < delta:
+        return "no_difference", (low, high)
+    else:
+        return None, (low, high)
+
+def _mean_variance(values):
+    mean = sum(values) / len(values)
+    variance = sum((value - mean) ** 2 for value in values) / max(1, len(values) - 1)
+    
+    return mean, variance
+
+# compare policy_a and policy_b (policy objects, or simulate.py policy specs like "predictor:a.ckpt") on seeds seed, seed + 1, ...
+# delta is the smallest difference in rounds won per game that matters, alpha the chance of calling a difference that isn't there, and beta (sprt only) the chance of missing a difference of delta.
+# games are played batch_size at a time and the test looks after every batch once there are min_games, up to max_games.  on_look(report) is called after every look if given.
+# resamples is the least number of bootstrap resamples per look.  the small alpha of each look usually takes more, see below
+# returns a report dict, see the top of the file
+def compare(policy_a, policy_b, method="sprt", delta=0.25, alpha=0.05, beta=0.05, batch_size=50, min_games=100, max_games=5000, seed=0, rules=None, limits=None, common_random=True, resamples=1000, on_look=None):
+    if not method in ("sprt", "bootstrap"):
+        raise ValueError("method must be \"sprt\" or \"bootstrap\", not " + repr(method))
+    
+    if delta <= 0 or not 0 < alpha < 1 or not 0 < beta < 1:
+        raise ValueError("delta must be positive and alpha and beta must be between 0 and 1")
+    
+    if batch_size < 1 or min_games < 1 or max_games < min_games:
+        raise ValueError("batch_size and min_games must be at least 1, and max_games at least min_games")
+    
+    if rules is None:
+        rules = buckshot.default_rules
+    
+    if isinstance(policy_a, str):
+        policy_a = simulate.make_policy(policy_a, rules)
+    
+    if isinstance(policy_b, str):
+        policy_b = simulate.make_policy(policy_b, rules)
+    
+    # the bootstrap gets a share of alpha for every look it could take, and enough resamples that at least 10 of them land beyond each end of an interval that wide
+    max_looks = max(1, -(-(max_games - min_games) // batch_size) + 1)
+    look_alpha = alpha / max_looks
+    look_resamples = max(resamples, math.ceil(20 / look_alpha))
+    
+    differences = []
+    decision = None
+    looks = 0
+    report = {"method": method}
+    start = time.perf_counter()
+    
+    while decision is None and len(differences) < max_games:
+        for game_seed in range(seed + len(differences), seed + min(max_games, len(differences) + batch_size)):
+            rounds_a, sets_a = policies.play_game(policy_a, game_seed, rules, limits, common_random=common_random)
+            rounds_b, sets_b = policies.play_game(policy_b, game_seed, rules, limits, common_random=common_random)
+            
+            differences.append(rounds_a - rounds_b)
+        
+        if len(differences) < min_games:
+            continue
+        
+        looks += 1
+        mean, variance = _mean_variance(differences)
+        
+        report = {"method": method, "games": len(differences), "looks": looks, "mean_difference": mean}
+        
+        if method == "sprt":
+            decision, llr_a, llr_b = sprt_decision(len(differences), sum(differences), variance, delta, alpha, beta)
+            
+            report["llr_a_better"] = llr_a
+            report["llr_b_better"] = llr_b
+        else:
+            decision, interval = bootstrap_decision(differences, delta, look_alpha, look_resamples)
+            
+            report["interval"] = list(interval)
+        
+        report["decision"] = decision
+        
+        if not on_look is None:
+            on_look(report)
+    
+    mean, variance = _mean_variance(differences)
+    stdev = variance ** 0.5
+    standard_error = stdev / len(differences) ** 0.5
+    
+    report.update({
+        "decision": "inconclusive" if decision is None else decision,
+        "games": len(differences),
+        "looks": looks,
+        "mean_difference": mean,
+        "stdev": stdev,
+        # cohen's d for paired samples
+        "effect_size": mean / stdev if stdev > 0 else 0.0,
+        # fixed sample normal interval, for reference.  it ignores the looks, so it's a little narrower than it should be
+        "normal_interval_95": [mean - 1.96 * standard_error, mean + 1.96 * standard_error],
+        "policy_a": policy_a.policy_hash(),
+        "policy_b": policy_b.policy_hash(),
+        "elapsed_seconds": time.perf_counter() - start
+    })
+    
+    return report
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(prog="python compare.py", description="compare two policies on paired seeds with a sequential test")
+    
+    parser.add_argument("policy_a", help=simulate.policy_usage)
+    parser.add_argument("policy_b", help=simulate.policy_usage)
+    parser.add_argument("--method", choices=("sprt", "bootstrap"), default="sprt")
+    parser.add_argument("--delta", type=float, default=0.25, help="smallest difference in rounds won per game that matters (default 0.25)")
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--beta", type=float, default=0.05)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--min-games", type=int, default=100)
+    parser.add_argument("--max-games", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-common-random", action="store_true", help="only share the seed between the policies, not the random streams")
+    parser.add_argument("--max-rounds", type=int, default=None, help="cap every game at this many rounds won, see buckshot.RunLimits")
+    
+    return parser.parse_args(argv)
+
+# python compare.py policy_a policy_b [options], eg python compare.py predictor:new.ckpt predictor:old.ckpt
+# prints every look and the final report
+def main(argc, argv):
+    arguments = parse_arguments(argv[1:argc])
+    
+    def print_look(report):
+        print("{games:5d} games: mean difference {mean_difference:+.3f}".format(**report) + ("" if report["decision"] is None else ", " + report["decision"]))
+    
+    report = compare(
+        arguments.policy_a,
+        arguments.policy_b,
+        method=arguments.method,
+        delta=arguments.delta,
+        alpha=arguments.alpha,
+        beta=arguments.beta,
+        batch_size=arguments.batch_size,
+        min_games=arguments.min_games,
+        max_games=arguments.max_games,
+        seed=arguments.seed,
+        limits=buckshot.RunLimits(max_rounds=arguments.max_rounds),
+        common_random=not arguments.no_common_random,
+        on_look=print_look
+    )
+    
+    print("")
+    print("decision: {} after {} games ({} looks, {:.1f}s)".format(report["decision"], report["games"], report["looks"], report["elapsed_seconds"]))
+    print("mean difference in rounds won: {:+.3f} (95% interval {:+.3f} to {:+.3f}), effect size {:+.3f} standard deviations".format(report["mean_difference"], report["normal_interval_95"][0], report["normal_interval_95"][1], report["effect_size"]))
+    
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))
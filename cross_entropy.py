@@ -1,14 +1,16 @@
 import sys
-import random
+import collections
 
 import buckshot
-from buckshot import BuckshotRun, RoundResetException
+from events import DecisionMadeEvent, print_event
 
 import torch
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-num_total_items = len(buckshot.all_item_names)
+# the device above, for code where device is the name of an argument
+def default_device():
+    return device
 
 # runs before the softmax layer to set any items that the predictor doesn't have to zero in the softmax layer
 # this just sets the output of that layer to a very large negative number
@@ -42,7 +44,7 @@ class ZeroOutBadItems(torch.nn.Module):
             if self.run.dealer.inventory.num_items() < 1:
                 do_adrenaline = True
         
-        for i, item_name in enumerate(buckshot.all_item_names):
+        for i, item_name in enumerate(self.run.rules.item_names):
             if not self.inventory.has_item(item_name) or (do_adrenaline and item_name == "adrenaline") or (do_handcuffs and item_name == "handcuffs") or (do_handsaw and item_name == "handsaw"):
                 out[i] = self.zero_value
                 non_zeroed_count -= 1
@@ -51,48 +53,150 @@ class ZeroOutBadItems(torch.nn.Module):
         
         return out
 
+# masks of which items the player is allowed to use and steal in the current state of run, following the same rules as ZeroOutBadItems.
+# returns two lists of booleans in the order of the run's item names.
+# unlike ZeroOutBadItems, adrenaline is only allowed if there's something in the dealer's inventory that can actually be stolen.
+def get_legal_item_masks(run):
+    do_handcuffs = run.is_handcuffed(run.dealer)
+    do_handsaw = run.is_sawed_off
+    
+    player_items = run.player.inventory.items
+    dealer_items = run.dealer.inventory.items
+    
+    use_mask = []
+    steal_mask = []
+    
+    for item_name in run.rules.item_names:
+        bad = (do_handcuffs and item_name == "handcuffs") or (do_handsaw and item_name == "handsaw")
+        
+        use_mask.append(item_name in player_items and not bad)
+        steal_mask.append(item_name in dealer_items and not bad and item_name != "adrenaline")
+    
+    if not any(steal_mask):
+        use_mask[run.rules.item_ids["adrenaline"]] = False
+    
+    return use_mask, steal_mask
+
+# one sampled action per row of a batch, in the same encoding as the action fields of replay.ReplayBuffer:
+    # use_item: True if an item was used
+    # shoot_dealer: 1 if the dealer was shot, 0 if the player shot themselves, -1 if an item was used instead
+    # item, steal: the item id used and the item id stolen with adrenaline, or -1 if that head wasn't used
+    # log_prob: log probability of the whole action under the confidences it was sampled from.  this keeps the graph of the confidences, so it can be used for policy gradients.
+SampledActions = collections.namedtuple("SampledActions", ["use_item", "shoot_dealer", "item", "steal", "log_prob"])
+
+# every head of a BuckshotPredictor_CrossEntropy in one module that only works on tensors.
+# the legal item masks are inputs instead of being read from a run like ZeroOutBadItems does, so this can be scripted with torch.jit.script and compiled with torch.compile (see inference.py).
+# forward takes a batch of input lists and the matching use and steal masks (see get_legal_item_masks) and returns:
+    # confidences: (batch, 2) use item and shoot dealer confidences, like who_to_shoot_or_use_item
+    # item_confidences, steal_item_confidences: (batch, num items) softmax confidences, like which_item_to_use and which_item_to_steal
+# the layers are shared with the predictor, not copied, so training the predictor also changes this module.
+class FusedPredictor(torch.nn.Module):
+    def __init__(self, predictor):
+        super().__init__()
+        
+        self.core_model = predictor.core_model
+        self.who_to_shoot_or_use_item = predictor.who_to_shoot_or_use_item
+        
+        # only the linear layers, the masking and softmax are done in forward
+        self.which_item_to_use = predictor.which_item_to_use[0]
+        self.which_item_to_steal = predictor.which_item_to_steal[0]
+        
+        self.zero_value = float(ZeroOutBadItems.zero_value)
+    
+    def forward(self, input_tensor, use_mask, steal_mask):
+        features = self.core_model(input_tensor)
+        
+        confidences = self.who_to_shoot_or_use_item(features)
+        
+        item_logits = self.which_item_to_use(features).masked_fill(~use_mask, self.zero_value)
+        steal_logits = self.which_item_to_steal(features).masked_fill(~steal_mask, self.zero_value)
+        
+        return confidences, torch.softmax(item_logits, dim=-1), torch.softmax(steal_logits, dim=-1)
+
 class BuckshotPredictor_CrossEntropy():
     live_int = 1
     blank_int = -1
     dont_know_int = 0
     
-    def __init__(self):
+    # rules is the RuleSet of the runs this predictor will play, which decides the size of the input and item layers.  default_rules if None
+    # device is where the modules live and where inputs are sent, default_device() (cuda if there is one) if None
+    def __init__(self, rules=None, device=None):
+        if rules is None:
+            rules = buckshot.default_rules
+        
+        self.rules = rules
+        self.device = default_device() if device is None else torch.device(device)
+        self.num_total_items = len(rules.item_names)
+        
         # 2 numbers for num live and num blank
         # 2 numbers for health (player and dealer)
         # 9*2 numbers for player and dealer item amounts
         # 8 numbers for known sequence
-        self.input_size = 2 + 2 + num_total_items*2 + buckshot.max_shells_per_set
+        self.input_size = rules.observation_size
         
         self.feature_size = 16
         
         self.core_model = torch.nn.Sequential(
             torch.nn.Linear(self.input_size, self.feature_size)
-        ).to(device)
+        ).to(self.device)
         
         # first number = % confidence in using an item
         # second number = % confidence in shooting dealer (if not using an item)
         self.who_to_shoot_or_use_item = torch.nn.Sequential(
             torch.nn.Linear(self.feature_size, 2),
             torch.nn.Sigmoid()
-        ).to(device)
+        ).to(self.device)
         
         self.zero_out_bad_items_player = ZeroOutBadItems(is_dealer=False)
         self.zero_out_bad_items_dealer = ZeroOutBadItems(is_dealer=True)
         
         # each number = % confidence in picking that item
         self.which_item_to_use = torch.nn.Sequential(
-            torch.nn.Linear(self.feature_size, num_total_items),
+            torch.nn.Linear(self.feature_size, self.num_total_items),
             
             self.zero_out_bad_items_player,
             torch.nn.Softmax(dim=0)
-        ).to(device)
+        ).to(self.device)
         
         self.which_item_to_steal = torch.nn.Sequential(
-            torch.nn.Linear(self.feature_size, num_total_items),
+            torch.nn.Linear(self.feature_size, self.num_total_items),
             
             self.zero_out_bad_items_dealer,
             torch.nn.Softmax(dim=0)
-        ).to(device)
+        ).to(self.device)
+        
+        # all of the above in one module, used for batched decisions
+        self.fused = FusedPredictor(self)
+        
+        # every decision is sampled from this instead of the global random module, see seed
+        self.generator = torch.Generator(device=self.device)
+        self.generator.seed()
+        
+        # callbacks that get a DecisionMadeEvent for every decision, see events.py
+        self.subscribers = []
+    
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+        
+        return callback
+    
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+    
+    # send event to every subscriber, and print it too if logging
+    def emit(self, event, logging=False):
+        for callback in self.subscribers:
+            callback(event)
+        
+        if logging:
+            print_event(event)
+    
+    # item confidences as a dict of item name -> confidence, or None if confidences is None
+    def confidences_as_dict(self, confidences):
+        if confidences is None:
+            return None
+        
+        return dict(zip(self.rules.item_names, confidences.tolist()))
     
     def set_run(self, run):
         self.run = run
@@ -100,30 +204,97 @@ class BuckshotPredictor_CrossEntropy():
         self.zero_out_bad_items_player.set_run(run)
         self.zero_out_bad_items_dealer.set_run(run)
     
+    # reseed the generator decisions are sampled from.  None picks a nondeterministic seed
+    def seed(self, seed=None):
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+    
     def weighted_coin_flip(self, success_weight):
-        return random.random() < success_weight
+        return bool(torch.bernoulli(success_weight.detach(), generator=self.generator))
     
     def weighted_decision(self, weights):
-        return random.choices(range(len(weights)), weights)[0]
+        return torch.multinomial(weights.detach(), 1, generator=self.generator).item()
+    
+    # sample one action for every row of a batch of head outputs (see FusedPredictor) with a few batched calls on the generator, instead of one call per decision.
+    # use_mask is the use item mask the confidences were computed with.  rows that can't use any item always shoot.
+    # returns SampledActions
+    def sample_actions(self, confidences, item_confidences, steal_confidences, use_mask):
+        use_item_confidence = confidences[:, 0]
+        shoot_dealer_confidence = confidences[:, 1]
+        
+        can_use = use_mask.any(dim=1)
+        
+        use_item = torch.bernoulli(use_item_confidence.detach(), generator=self.generator).bool() & can_use
+        shoot_dealer = torch.bernoulli(shoot_dealer_confidence.detach(), generator=self.generator).bool()
+        
+        item = torch.multinomial(item_confidences.detach(), 1, generator=self.generator)
+        steal = torch.multinomial(steal_confidences.detach(), 1, generator=self.generator)
+        
+        stealing = use_item & (item.squeeze(1) == self.rules.item_ids["adrenaline"])
+        
+        none = torch.full_like(item.squeeze(1), -1)
+        
+        shoot_dealer = torch.where(use_item, none, shoot_dealer.long())
+        item = torch.where(use_item, item.squeeze(1), none)
+        steal = torch.where(stealing, steal.squeeze(1), none)
+        
+        return SampledActions(use_item, shoot_dealer, item, steal, self.action_log_probs(confidences, item_confidences, steal_confidences, use_mask, use_item, shoot_dealer, item, steal))
+    
+    # log probability of whole actions under a batch of head outputs computed with use_mask.  the actions are in the encoding of SampledActions (and replay.ReplayBuffer), with use_item as booleans.
+    # this keeps the graph of the confidences, so actions sampled earlier without gradients can be scored again in one batch for policy gradients
+    def action_log_probs(self, confidences, item_confidences, steal_confidences, use_mask, use_item, shoot_dealer, item, steal):
+        use_item_confidence = confidences[:, 0]
+        shoot_dealer_confidence = confidences[:, 1]
+        
+        can_use = use_mask.any(dim=1)
+        stealing = steal >= 0
+        
+        # clamped so that a probability that rounded to exactly 0 or 1 can't give an infinite log (and nan gradients)
+        def log(probability):
+            return torch.log(probability.clamp_min(1e-12))
+        
+        zero = torch.zeros_like(use_item_confidence)
+        
+        log_prob = torch.where(can_use, log(torch.where(use_item, use_item_confidence, 1 - use_item_confidence)), zero)
+        log_prob = log_prob + torch.where(use_item, zero, log(torch.where(shoot_dealer == 1, shoot_dealer_confidence, 1 - shoot_dealer_confidence)))
+        log_prob = log_prob + torch.where(use_item, log(item_confidences.gather(1, item.clamp_min(0).unsqueeze(1)).squeeze(1)), zero)
+        log_prob = log_prob + torch.where(stealing, log(steal_confidences.gather(1, steal.clamp_min(0).unsqueeze(1)).squeeze(1)), zero)
+        
+        return log_prob
+    
+    # turn SampledActions into a list of decisions in the format of BuckshotRun.apply_decision
+    def actions_to_decisions(self, actions):
+        decisions = []
+        
+        for use_item, shoot_dealer, item, steal in zip(actions.use_item.tolist(), actions.shoot_dealer.tolist(), actions.item.tolist(), actions.steal.tolist()):
+            if use_item:
+                if steal >= 0:
+                    decisions.append(("use", self.rules.item_names[item], self.rules.item_names[steal]))
+                else:
+                    decisions.append(("use", self.rules.item_names[item]))
+            elif shoot_dealer == 1:
+                decisions.append(("shoot", "dealer"))
+            else:
+                decisions.append(("shoot", "self"))
+        
+        return decisions
     
     def pretty_print_item_confidences(self, confidences): 
-        for item_name, confidence in zip(buckshot.all_item_names, confidences):
+        for item_name, confidence in zip(self.rules.item_names, confidences):
             print(item_name.rjust(10, " ") + ":" + "{:.2%}".format(confidence.item()).rjust(8, " "))
             # print("{}: {:.2%}".format(item_name, confidence.item()).rjust(20, " "))
-        
-    # makes a decision from the pure game state it cares about.  not a very pretty signature
-    # item_counts should be an ordered list of numbers, order depending on the order of all_item_names (inventory.as_dict().values() should do it)
-    # known sequence is the known sequence of the player, not the dealer.
-    # this doesn't take a complete turn; any "decision" is just something that changes the game state.
-    def make_decision_from_game_state(self, num_live, num_blank, player_health, dealer_health, player_item_counts, dealer_item_counts, known_sequence, logging=False):
-        # format input to list of integers
+    
+    # format the game state into the list of numbers the core model takes as input
+    def game_state_to_input_list(self, num_live, num_blank, player_health, dealer_health, player_item_counts, dealer_item_counts, known_sequence):
         input_list = [num_live, num_blank, player_health, dealer_health]
         
-        if len(player_item_counts) != num_total_items:
-            raise Exception("bad number of item counts for player: " + str(len(player_item_counts)) + " (should be " + str(num_total_items) + ")")
+        if len(player_item_counts) != self.num_total_items:
+            raise Exception("bad number of item counts for player: " + str(len(player_item_counts)) + " (should be " + str(self.num_total_items) + ")")
         
-        if len(dealer_item_counts) != num_total_items:
-            raise Exception("bad number of item counts for dealer: " + str(len(player_item_counts)) + " (should be " + str(num_total_items) + ")")
+        if len(dealer_item_counts) != self.num_total_items:
+            raise Exception("bad number of item counts for dealer: " + str(len(player_item_counts)) + " (should be " + str(self.num_total_items) + ")")
         
         input_list += player_item_counts
         input_list += dealer_item_counts
@@ -139,12 +310,34 @@ class BuckshotPredictor_CrossEntropy():
                 known_sequence_as_ints.append(self.dont_know_int)
         
         # extend to 8
-        known_sequence_as_ints = known_sequence_as_ints + [self.dont_know_int] * (buckshot.max_shells_per_set - len(known_sequence_as_ints))
+        known_sequence_as_ints = known_sequence_as_ints + [self.dont_know_int] * (self.rules.max_shells_per_set - len(known_sequence_as_ints))
         
         input_list += known_sequence_as_ints
         
+        return input_list
+    
+    # input list for the player's side of run
+    def get_input_list(self, run):
+        return self.game_state_to_input_list(
+            run.num_live(),
+            run.num_blank(),
+            run.player.health,
+            run.dealer.health,
+            list(run.player.inventory.as_dict().values()),
+            list(run.dealer.inventory.as_dict().values()),
+            run.player.known_sequence
+        )
+    
+    # makes a decision from the pure game state it cares about.  not a very pretty signature
+    # item_counts should be an ordered list of numbers, order depending on the order of the rules' item_names (inventory.as_dict().values() should do it)
+    # known sequence is the known sequence of the player, not the dealer.
+    # this doesn't take a complete turn; any "decision" is just something that changes the game state.
+    def make_decision_from_game_state(self, num_live, num_blank, player_health, dealer_health, player_item_counts, dealer_item_counts, known_sequence, logging=False):
+        # format input to list of integers
+        input_list = self.game_state_to_input_list(num_live, num_blank, player_health, dealer_health, list(player_item_counts), list(dealer_item_counts), known_sequence)
+        
         # create tensor
-        input_tensor = torch.tensor(input_list).float().to(device)
+        input_tensor = torch.tensor(input_list).float().to(self.device)
         
         # decision time!
         
@@ -159,10 +352,8 @@ class BuckshotPredictor_CrossEntropy():
         else:
             use_item = self.weighted_coin_flip(use_item_confidence)
         
-        if logging:
-            print("{:.2f}% sure about using an item".format(use_item_confidence.item() * 100))
-            print("{:.2f}% sure about shooting the dealer".format(shoot_dealer_confidence.item() * 100))
-            print("")
+        item_confidences = None
+        steal_item_confidences = None
         
         if use_item:
             # figure out which item to use
@@ -170,36 +361,73 @@ class BuckshotPredictor_CrossEntropy():
             
             item_index = self.weighted_decision(item_confidences)
             
-            if logging:
-                print("item confidences:")
-                self.pretty_print_item_confidences(item_confidences)
-                print("")
-            
-            item_name = buckshot.all_item_names[item_index]
+            item_name = self.rules.item_names[item_index]
             
             if item_name == "adrenaline":
                 # also choose which item to steal
                 steal_item_confidences = self.which_item_to_steal(features)
                 
-                if logging:
-                    print("steal item confidences:")
-                    self.pretty_print_item_confidences(steal_item_confidences)
-                    print("")
-            
                 steal_item_index = self.weighted_decision(steal_item_confidences)
                 
-                steal_item_name = buckshot.all_item_names[steal_item_index]
+                steal_item_name = self.rules.item_names[steal_item_index]
                 
-                return "use", item_name, steal_item_name
+                decision = ("use", item_name, steal_item_name)
             else:
-                return "use", item_name
+                decision = ("use", item_name)
         else:
             shoot_dealer = self.weighted_coin_flip(shoot_dealer_confidence)
             
             if shoot_dealer:
-                return "shoot", "dealer"
+                decision = ("shoot", "dealer")
             else:
-                return "shoot", "self"
+                decision = ("shoot", "self")
+        
+        if logging or self.subscribers:
+            self.emit(DecisionMadeEvent(
+                use_item_confidence.item(),
+                shoot_dealer_confidence.item(),
+                self.confidences_as_dict(item_confidences),
+                self.confidences_as_dict(steal_item_confidences),
+                decision
+            ), logging)
+        
+        return decision
+    
+    # makes one decision for each run in runs with a single forward pass through every head.  this is the same decision as make_decision_from_game_state, except that the item masks are computed from each run directly instead of going through ZeroOutBadItems.
+    # returns a list of decisions in the same format as make_decision_from_game_state.
+    def make_decisions_batch(self, runs):
+        if len(runs) == 0:
+            return []
+        
+        input_tensor = torch.tensor([self.get_input_list(run) for run in runs]).float().to(self.device)
+        
+        masks = [get_legal_item_masks(run) for run in runs]
+        
+        use_mask = torch.tensor([use for use, steal in masks], device=self.device)
+        steal_mask = torch.tensor([steal for use, steal in masks], device=self.device)
+        
+        with torch.no_grad():
+            confidences, item_confidences, steal_confidences = self.fused(input_tensor, use_mask, steal_mask)
+            
+            decisions = self.actions_to_decisions(self.sample_actions(confidences, item_confidences, steal_confidences, use_mask))
+        
+        if self.subscribers:
+            confidences = confidences.cpu()
+            item_confidences = item_confidences.cpu()
+            steal_confidences = steal_confidences.cpu()
+            
+            for i, decision in enumerate(decisions):
+                used_item = decision[0] == "use"
+                
+                self.emit(DecisionMadeEvent(
+                    confidences[i][0].item(),
+                    confidences[i][1].item(),
+                    self.confidences_as_dict(item_confidences[i]) if used_item else None,
+                    self.confidences_as_dict(steal_confidences[i]) if used_item and decision[1] == "adrenaline" else None,
+                    decision
+                ))
+        
+        return decisions
     
     def take_turn(self, logging=False):
         while True:
@@ -215,33 +443,15 @@ class BuckshotPredictor_CrossEntropy():
                 logging=logging
             )
             
-            action = decision[0]
-            
-            if action == "use":
-                item = decision[1]
-                
-                try:
-                    if item == "adrenaline":
-                        steal_item = decision[2]
-                        
-                        self.run.use_adrenaline(steal_item)
-                    else:
-                        self.run.use_item(item)
-                except RoundResetException as e:
-                    # turn ends early
-                    break
-            elif action == "shoot":
-                who = decision[1]
-                
-                shooting_self = who == "self"
-                self.run.shoot(shooting_self=shooting_self)
-                
-                # done with turn
+            # done with turn once a shot was fired or the round reset
+            if self.run.apply_decision(decision):
                 break
 
 import datetime
 
 def main(argc, argv):
+    from policies import PredictorPolicy, play_many
+    
     ai_player = BuckshotPredictor_CrossEntropy()
     
     total_rounds_won = 0
@@ -252,29 +462,16 @@ def main(argc, argv):
     
     total_games = 1000
     
-    logging=False
-    
     start = datetime.datetime.now()
     
-    for i in range(total_games):
-        run = BuckshotRun(logging=logging)
-        ai_player.set_run(run)
-        
-        while not run.is_over():
-            if run.is_player_turn():
-                ai_player.take_turn(logging=logging)
-            else:
-                try:
-                    run.dealer_ai_turn()
-                except RoundResetException:
-                    pass
-        
-        total_rounds_won += run.rounds_won()
-        total_sets_survived += run.sets_won
-        
-        most_rounds_won = max(run.rounds_won(), most_rounds_won)
-        most_sets_survived = max(run.sets_won, most_sets_survived)
-        # print("ai won " + str(run.rounds_won()) + " rounds and survived " + str(run.sets_won) + " sets")
+    # every game's decisions are made in batches, see policies.play_many
+    for rounds_won, sets_won in play_many(PredictorPolicy(ai_player), total_games):
+        total_rounds_won += rounds_won
+        total_sets_survived += sets_won
+        
+        most_rounds_won = max(rounds_won, most_rounds_won)
+        most_sets_survived = max(sets_won, most_sets_survived)
+        # print("ai won " + str(rounds_won) + " rounds and survived " + str(sets_won) + " sets")
     
     end = datetime.datetime.now()
     
@@ -0,0 +1,429 @@
+### dealer decision datasets ###
+# builds datasets of the authentic dealer's decisions (Dealer.take_turn) for pretraining a BuckshotPredictor_CrossEntropy by imitation.
+# games are played in worker processes with some policy in the player's seat, and every item the dealer uses and every shot he fires is recorded from his side of the table just before it happens.
+# every record has the same fields as replay.ReplayBuffer, in the same encodings, but from the dealer's perspective:
+    # obs: the predictor's input list as if the dealer were the player (his health and items first, his known shells), see BuckshotPredictor_CrossEntropy.game_state_to_input_list
+    # use_mask, steal_mask: the legal item masks as bit masks (bit i is item i of rules.item_names), see cross_entropy.get_legal_item_masks
+    # use_item: 1 if an item was used, 0 if a shot was fired
+    # shoot_dealer: 1 if the dealer shot the player (his opponent), 0 if he shot himself, -1 if an item was used instead
+    # item, steal: the item id used and the item id stolen with adrenaline, or -1 if that head wasn't used
+# records are deduplicated on (what the dealer can see, the action he took) with a bloom filter, so memory stays fixed however big the dataset gets.  a few unseen records are dropped as false positives, at most error_rate of them.
+# records are written in shards of fixed width records (shard-00000.bin, ...) and index.json describes the layout, the shards and how the dataset was made.  a record is shard number record_index // records_per_shard, so any record can be read without scanning.
+# nothing here needs torch, so building datasets can run on machines without it.  read_shard maps a shard as a numpy structured array for training.
+
+import os
+import sys
+import json
+import math
+import time
+import array
+import random
+import struct
+import concurrent.futures
+
+import buckshot
+from buckshot import BuckshotRun
+import simulate
+
+dataset_version = 1
+
+# same ints as BuckshotPredictor_CrossEntropy uses for known shells
+_live_int = 1
+_blank_int = -1
+_dont_know_int = 0
+
+# the record layout for rules: a struct and a matching numpy dtype description
+def record_layout(rules):
+    if len(rules.item_names) > 16:
+        raise ValueError("item masks are 16 bits wide, rules with more than 16 items can't be stored")
+    
+    layout = struct.Struct("<{}bHHbbbb".format(rules.observation_size))
+    
+    fields = [
+        ["obs", "i1", [rules.observation_size]],
+        ["use_mask", "<u2", []],
+        ["steal_mask", "<u2", []],
+        ["use_item", "i1", []],
+        ["shoot_dealer", "i1", []],
+        ["item", "i1", []],
+        ["steal", "i1", []]
+    ]
+    
+    return layout, fields
+
+# the predictor's input list for the dealer's side of run
+def dealer_observation(run):
+    rules = run.rules
+    dealer = run.dealer
+    player = run.player
+    
+    known = [_live_int if buckshot.shell_is_live(shell) else (_blank_int if buckshot.shell_is_blank(shell) else _dont_know_int) for shell in dealer.known_sequence]
+    
+    return (
+        [run.num_live(), run.num_blank(), dealer.health, player.health]
+        + [dealer.inventory.items.count(item_name) for item_name in rules.item_names]
+        + [player.inventory.items.count(item_name) for item_name in rules.item_names]
+        + known + [_dont_know_int] * (rules.max_shells_per_set - len(known))
+    )
+
+# the legal item masks for user as bit masks, with opposite across the table.  same rules as cross_entropy.get_legal_item_masks, which is this for the player
+def item_mask_bits(run, user, opposite):
+    rules = run.rules
+    
+    do_handcuffs = run.is_handcuffed(opposite)
+    do_handsaw = run.is_sawed_off
+    
+    user_items = user.inventory.items
+    opposite_items = opposite.inventory.items
+    
+    use_mask = 0
+    steal_mask = 0
+    
+    for item_id, item_name in enumerate(rules.item_names):
+        bad = (do_handcuffs and item_name == "handcuffs") or (do_handsaw and item_name == "handsaw")
+        
+        if item_name in user_items and not bad:
+            use_mask |= 1 << item_id
+        
+        if item_name in opposite_items and not bad and item_name != "adrenaline":
+            steal_mask |= 1 << item_id
+    
+    if steal_mask == 0:
+        use_mask &= ~(1 << rules.item_ids["adrenaline"])
+    
+    return use_mask, steal_mask
+
+def dealer_item_masks(run):
+    return item_mask_bits(run, run.dealer, run.player)
+
+# mixes a 64 bit number (splitmix64's finalizer), so keys built from related numbers still spread over the whole filter
+def _mix64(x):
+    x &= 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    
+    return x ^ (x >> 31)
+
+# fixed size set of 64 bit keys that can have false positives but never false negatives.  sized for capacity keys at error_rate false positives
+class BloomFilter():
+    def __init__(self, capacity, error_rate=0.001):
+        if capacity < 1 or not 0 < error_rate < 1:
+            raise ValueError("capacity must be at least 1 and error_rate between 0 and 1")
+        
+        self.capacity = capacity
+        self.error_rate = error_rate
+        
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+    
+    # add key.  returns False if it was (probably) already there
+    def add(self, key):
+        key = _mix64(key)
+        
+        # double hashing: the k positions are h1 + i * h2
+        h1 = key & 0xFFFFFFFF
+        h2 = (key >> 32) | 1
+        
+        bits = self.bits
+        num_bits = self.num_bits
+        new = False
+        
+        for i in range(self.num_hashes):
+            position = (h1 + i * h2) % num_bits
+            mask = 1 << (position & 7)
+            
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                new = True
+        
+        if new:
+            self.count += 1
+        
+        return new
+    
+    def __contains__(self, key):
+        key = _mix64(key)
+        
+        h1 = key & 0xFFFFFFFF
+        h2 = (key >> 32) | 1
+        
+        return all(self.bits[((h1 + i * h2) % self.num_bits) >> 3] & (1 << (((h1 + i * h2) % self.num_bits) & 7)) for i in range(self.num_hashes))
+    
+    def memory_bytes(self):
+        return len(self.bits)
+
+# a run that writes down every action the dealer takes just before taking it
+class _RecordingRun(BuckshotRun):
+    def __init__(self, rules, layout):
+        self.layout = layout
+        
+        # packed records and their dedup keys
+        self.records = []
+        self.keys = []
+        
+        self.recording = True
+        
+        super().__init__(logging=False, rules=rules)
+    
+    def record(self, use_item, shoot_dealer, item, steal):
+        if not self.recording or self.whose_turn_id != self.dealer_id:
+            return
+        
+        use_mask, steal_mask = dealer_item_masks(self)
+        
+        self.records.append(self.layout.pack(*dealer_observation(self), use_mask, steal_mask, use_item, shoot_dealer, item, steal))
+        
+        # what the dealer sees (his seat's hash) and what he did
+        action = ((use_item * 3 + shoot_dealer + 1) * 64 + item + 1) * 64 + steal + 1
+        
+        self.keys.append(self.get_state_hash(self.dealer_id) ^ _mix64(action))
+    
+    def use_item(self, item_name):
+        if item_name != "adrenaline":
+            self.record(1, -1, self.rules.item_ids[item_name], -1)
+        
+        super().use_item(item_name)
+    
+    def use_adrenaline(self, steal_item_name):
+        self.record(1, -1, self.rules.item_ids["adrenaline"], self.rules.item_ids[steal_item_name])
+        
+        # the stolen item is used right away through use_item, which is part of this action rather than one of its own
+        self.recording = False
+        
+        try:
+            super().use_adrenaline(steal_item_name)
+        finally:
+            self.recording = True
+    
+    def shoot(self, shooting_self):
+        self.record(0, 0 if shooting_self else 1, -1, -1)
+        
+        return super().shoot(shooting_self)
+
+## worker processes ##
+
+_worker_policy = None
+_worker_rules = None
+_worker_layout = None
+
+def _init_worker(spec, rules):
+    global _worker_policy, _worker_rules, _worker_layout
+    
+    _worker_rules = rules
+    _worker_layout = record_layout(rules)[0]
+    _worker_policy = make_player_policy(spec, rules)
+
+def make_player_policy(spec, rules):
+    return simulate.make_policy(spec, rules)
+
+# play the games with seeds start_seed to start_seed + num_seeds - 1.  returns (records as one bytes object, their keys as an array of uint64)
+def _play_block(start_seed, num_seeds):
+    records = []
+    keys = array.array("Q")
+    
+    for seed in range(start_seed, start_seed + num_seeds):
+        random.seed(seed)
+        _worker_policy.seed(seed)
+        
+        run = _RecordingRun(_worker_rules, _worker_layout)
+        
+        while run.advance_to_player_decision():
+            _worker_policy.take_turn(run)
+        
+        records += run.records
+        keys.extend(run.keys)
+    
+    return b"".join(records), keys
+
+## writing ##
+
+class _ShardWriter():
+    def __init__(self, directory, record_size, records_per_shard):
+        self.directory = directory
+        self.record_size = record_size
+        self.records_per_shard = records_per_shard
+        
+        self.shards = []
+        self.buffer = bytearray()
+    
+    def add(self, record):
+        self.buffer += record
+        
+        if len(self.buffer) >= self.record_size * self.records_per_shard:
+            self.flush()
+    
+    # write the buffered records as the next shard, through a temporary file so a shard is either complete or not there
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        
+        name = "shard-{:05d}.bin".format(len(self.shards))
+        path = os.path.join(self.directory, name)
+        
+        with open(path + ".tmp", "wb") as f:
+            f.write(self.buffer)
+        
+        os.replace(path + ".tmp", path)
+        
+        self.shards.append({"file": name, "records": len(self.buffer) // self.record_size})
+        self.buffer = bytearray()
+
+# play num_games games (seeds seed to seed + num_games - 1) with the player_policy spec (see simulate.make_policy) in the player's seat, and write the dealer's decisions to directory.
+# the output doesn't depend on the number of workers.  records_per_shard is the number of records in every shard but the last, and dedup_capacity and dedup_error_rate size the bloom filter.
+# returns the index, which is also written to directory/index.json
+def build_dataset(directory, num_games, workers=1, seed=0, player_policy="random", rules=None, records_per_shard=1 << 20, block_size=200, dedup=True, dedup_capacity=10000000, dedup_error_rate=0.001, progress=None):
+    if rules is None:
+        rules = buckshot.default_rules
+    
+    layout, fields = record_layout(rules)
+    
+    os.makedirs(directory, exist_ok=True)
+    
+    writer = _ShardWriter(directory, layout.size, records_per_shard)
+    seen = BloomFilter(dedup_capacity, dedup_error_rate) if dedup else None
+    
+    recorded = 0
+    duplicates = 0
+    
+    starts = list(range(seed, seed + num_games, block_size))
+    sizes = [min(block_size, seed + num_games - start) for start in starts]
+    
+    start_time = time.perf_counter()
+    
+    def take(block):
+        nonlocal recorded, duplicates
+        
+        records, keys = block
+        
+        for i, key in enumerate(keys):
+            recorded += 1
+            
+            if not seen is None and not seen.add(key):
+                duplicates += 1
+                
+                continue
+            
+            writer.add(records[i * layout.size:(i + 1) * layout.size])
+        
+        if not progress is None:
+            progress(recorded, recorded - duplicates)
+    
+    if workers <= 1:
+        _init_worker(player_policy, rules)
+        
+        for start, size in zip(starts, sizes):
+            take(_play_block(start, size))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(player_policy, rules)) as pool:
+            # map hands the blocks back in order, so the output is the same with any number of workers
+            for block in pool.map(_play_block, starts, sizes):
+                take(block)
+    
+    writer.flush()
+    
+    elapsed = time.perf_counter() - start_time
+    
+    index = {
+        "version": dataset_version,
+        "record_size": layout.size,
+        "struct_format": layout.format if isinstance(layout.format, str) else layout.format.decode(),
+        "fields": fields,
+        "records_per_shard": records_per_shard,
+        "records": recorded - duplicates,
+        "shards": writer.shards,
+        "item_names": list(rules.item_names),
+        "rules_fingerprint": rules.fingerprint(),
+        "games": num_games,
+        "seed": seed,
+        "player_policy": player_policy,
+        "decisions_seen": recorded,
+        "duplicates_dropped": duplicates,
+        "dedup": None if seen is None else {"capacity": seen.capacity, "error_rate": seen.error_rate, "bits": seen.num_bits, "hashes": seen.num_hashes},
+        "elapsed_seconds": elapsed
+    }
+    
+    path = os.path.join(directory, "index.json")
+    
+    with open(path + ".tmp", "w") as f:
+        json.dump(index, f, indent=4)
+    
+    os.replace(path + ".tmp", path)
+    
+    return index
+
+## reading ##
+
+def load_index(directory):
+    with open(os.path.join(directory, "index.json")) as f:
+        index = json.load(f)
+    
+    if index["version"] != dataset_version:
+        raise ValueError("can't read dataset version " + str(index["version"]) + ", expected " + str(dataset_version))
+    
+    return index
+
+# every record of one shard as tuples of (obs, use_mask, steal_mask, use_item, shoot_dealer, item, steal), without numpy
+def iterate_shard(directory, index, shard_number):
+    layout = struct.Struct(index["struct_format"])
+    observation_size = index["fields"][0][2][0]
+    
+    with open(os.path.join(directory, index["shards"][shard_number]["file"]), "rb") as f:
+        data = f.read()
+    
+    for values in layout.iter_unpack(data):
+        yield (list(values[:observation_size]),) + values[observation_size:]
+
+# one shard mapped as a read only numpy structured array, with the fields named as in the index
+def read_shard(directory, index, shard_number):
+    import numpy
+    
+    dtype = numpy.dtype([(name, kind, tuple(shape)) for name, kind, shape in index["fields"]])
+    
+    if dtype.itemsize != index["record_size"]:
+        raise ValueError("record size in the index doesn't match its fields")
+    
+    return numpy.memmap(os.path.join(directory, index["shards"][shard_number]["file"]), dtype=dtype, mode="r")
+
+# python dataset.py [directory] [num_games] [workers]
+# builds a dataset, then reads it back and checks that every recorded action was legal under its masks
+def main(argc, argv):
+    directory = argv[1] if argc > 1 else "dealer_dataset"
+    num_games = int(argv[2]) if argc > 2 else 20000
+    workers = int(argv[3]) if argc > 3 else os.cpu_count()
+    
+    def progress(seen, kept):
+        print("\r{} decisions, {} kept".format(seen, kept), end="")
+    
+    index = build_dataset(directory, num_games, workers=workers, records_per_shard=100000, progress=progress)
+    
+    print("")
+    print("{} records in {} shards of {} bytes per record, {} duplicates dropped, {:.0f} decisions/s".format(index["records"], len(index["shards"]), index["record_size"], index["duplicates_dropped"], index["decisions_seen"] / index["elapsed_seconds"]))
+    
+    item_names = index["item_names"]
+    adrenaline_id = item_names.index("adrenaline")
+    
+    illegal = 0
+    actions = {"item": 0, "shoot player": 0, "shoot self": 0}
+    
+    for shard_number in range(len(index["shards"])):
+        for obs, use_mask, steal_mask, use_item, shoot_dealer, item, steal in iterate_shard(directory, index, shard_number):
+            if use_item:
+                actions["item"] += 1
+                
+                if item != adrenaline_id and not use_mask >> item & 1:
+                    illegal += 1
+                elif item == adrenaline_id and (not use_mask >> adrenaline_id & 1 or not steal_mask >> steal & 1):
+                    illegal += 1
+            else:
+                actions["shoot player" if shoot_dealer == 1 else "shoot self"] += 1
+    
+    print("actions: " + ", ".join("{} {}".format(name, count) for name, count in actions.items()))
+    print("actions outside their masks: {}".format(illegal))
+    
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))
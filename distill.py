@@ -0,0 +1,500 @@
+### lookup table policies ###
+# distills a BuckshotPredictor_CrossEntropy into a table that decides in microseconds without torch.
+# the table is keyed on the part of the predictor's input that matters most for the player's decision:
+    # lives and blanks left, player and dealer health, which items the player holds (not how many), and what the player knows about the next shell (unknown, live or blank)
+# the dealer's items, item counts above one and shells known further down the chamber are left out of the key, since keeping them makes the key space so big that games almost never revisit a key.  every entry holds the predictor's outputs averaged over the states it covers, weighted by how often they came up:
+    # the use item and shoot dealer confidences, and the logits of which_item_to_use and which_item_to_steal before masking
+# the item masks are applied when deciding, from the actual run, so a table policy never makes an illegal decision even though the key doesn't say what the dealer holds.
+# keys are sampled by playing games with the predictor itself and querying it in batches, so the table covers the states it actually plays.  the key space is indexed with a flat array of entry numbers (-1 for keys that weren't sampled), and TablePolicy falls back to another policy (normally the predictor) for those.
+# agreement measures how close the table is on held out games: how many decisions it covers, how often its most likely decision is the predictor's, and the total variation between their decision distributions.
+
+import os
+import sys
+import json
+import math
+import time
+import array
+import random
+import struct
+
+import buckshot
+import policies
+from policies import DecisionPolicy
+import dataset
+
+magic = b"BSHOTLUT"
+table_version = 1
+
+_preamble = struct.Struct("<8sIQ")
+
+# what the player knows about the next shell
+UNKNOWN = 0
+LIVE = 1
+BLANK = 2
+
+class LookupTable():
+    # an empty table for rules (default_rules if None), see distill and load
+    def __init__(self, rules=None):
+        if rules is None:
+            rules = buckshot.default_rules
+        
+        self.rules = rules
+        self.num_items = len(rules.item_names)
+        
+        max_shells = rules.max_shells_per_set
+        max_health = rules.max_health
+        
+        # sizes of the key dimensions, in the order of index's arguments
+        self.shape = (max_shells + 1, max_shells + 1, max_health + 1, max_health + 1, 1 << self.num_items, 3)
+        
+        self.strides = []
+        stride = 1
+        
+        for size in reversed(self.shape):
+            self.strides.insert(0, stride)
+            stride *= size
+        
+        self.size = stride
+        
+        # entry number of every key, and the entries: use item confidence, shoot dealer confidence, item logits, steal logits
+        self.entry_size = 2 + 2 * self.num_items
+        self.entries = array.array("i", [-1]) * self.size
+        self.values = array.array("f")
+        
+        # policy_hash of the predictor the table was distilled from, and how many decisions were sampled
+        self.source = None
+        self.samples = 0
+    
+    def num_entries(self):
+        return len(self.values) // self.entry_size
+    
+    # flat index of a key.  items is a bit mask of the items the player holds and known is UNKNOWN, LIVE or BLANK
+    def index(self, lives, blanks, player_health, dealer_health, items, known):
+        strides = self.strides
+        
+        return lives * strides[0] + blanks * strides[1] + player_health * strides[2] + dealer_health * strides[3] + items * strides[4] + known
+    
+    # index of the player's decision in run, or -1 if it's outside the key space
+    def run_index(self, run):
+        lives = run.num_live()
+        blanks = run.num_blank()
+        player_health = run.player.health
+        dealer_health = run.dealer.health
+        
+        if lives > self.shape[0] - 1 or blanks > self.shape[1] - 1 or not 0 <= player_health < self.shape[2] or not 0 <= dealer_health < self.shape[3]:
+            return -1
+        
+        item_ids = self.rules.item_ids
+        items = 0
+        
+        for item_name in run.player.inventory.items:
+            items |= 1 << item_ids[item_name]
+        
+        known_sequence = run.player.known_sequence
+        
+        if len(known_sequence) == 0 or known_sequence[0] is None:
+            known = UNKNOWN
+        else:
+            known = LIVE if buckshot.shell_is_live(known_sequence[0]) else BLANK
+        
+        return self.index(lives, blanks, player_health, dealer_health, items, known)
+    
+    # the same index from a predictor input list (see BuckshotPredictor_CrossEntropy.game_state_to_input_list)
+    def input_index(self, input_list):
+        num_items = self.num_items
+        
+        lives, blanks, player_health, dealer_health = input_list[:4]
+        
+        if lives > self.shape[0] - 1 or blanks > self.shape[1] - 1 or not 0 <= player_health < self.shape[2] or not 0 <= dealer_health < self.shape[3]:
+            return -1
+        
+        items = 0
+        
+        for item_id, count in enumerate(input_list[4:4 + num_items]):
+            if count > 0:
+                items |= 1 << item_id
+        
+        # the predictor's ints for known shells: live 1, blank -1, unknown 0
+        known = (UNKNOWN, LIVE, BLANK)[input_list[4 + 2 * num_items]]
+        
+        return self.index(lives, blanks, player_health, dealer_health, items, known)
+    
+    # the entry for index as a list, or None if the table doesn't cover it
+    def entry(self, index):
+        if index < 0:
+            return None
+        
+        entry = self.entries[index]
+        
+        if entry < 0:
+            return None
+        
+        return self.values[entry * self.entry_size:(entry + 1) * self.entry_size]
+    
+    # fraction of the key space that has an entry
+    def coverage(self):
+        return self.num_entries() / self.size
+    
+    ## files ##
+    
+    # only the covered keys and their entries are written, the index array is rebuilt on load
+    def save(self, path):
+        header = json.dumps({"rules_fingerprint": self.rules.fingerprint(), "shape": self.shape, "source": self.source, "samples": self.samples, "entries": self.num_entries()}).encode()
+        
+        keys = array.array("i", [-1]) * self.num_entries()
+        
+        for index, entry in enumerate(self.entries):
+            if entry >= 0:
+                keys[entry] = index
+        
+        temp_path = path + ".tmp"
+        
+        with open(temp_path, "wb") as f:
+            f.write(_preamble.pack(magic, table_version, len(header)))
+            f.write(header)
+            f.write(keys.tobytes())
+            f.write(self.values.tobytes())
+            
+            f.flush()
+            os.fsync(f.fileno())
+        
+        os.replace(temp_path, path)
+    
+    # load a table saved for rules.  raises ValueError if the file isn't a table for these rules
+    @classmethod
+    def load(cls, path, rules=None):
+        table = cls(rules)
+        
+        with open(path, "rb") as f:
+            data = f.read()
+        
+        if len(data) < _preamble.size:
+            raise ValueError(path + " is too short to be a lookup table")
+        
+        file_magic, version, header_length = _preamble.unpack_from(data)
+        
+        if file_magic != magic or version != table_version:
+            raise ValueError(path + " isn't a version " + str(table_version) + " lookup table")
+        
+        header = json.loads(data[_preamble.size:_preamble.size + header_length])
+        
+        if header["rules_fingerprint"] != table.rules.fingerprint() or tuple(header["shape"]) != table.shape:
+            raise ValueError(path + " was built for different rules")
+        
+        num_entries = header["entries"]
+        start = _preamble.size + header_length
+        values_start = start + 4 * num_entries
+        
+        if len(data) != values_start + 4 * num_entries * table.entry_size:
+            raise ValueError(path + " is truncated")
+        
+        keys = array.array("i")
+        keys.frombytes(data[start:values_start])
+        
+        table.values = array.array("f")
+        table.values.frombytes(data[values_start:])
+        
+        for entry, index in enumerate(keys):
+            if not 0 <= index < table.size:
+                raise ValueError(path + " has a key outside the table")
+            
+            table.entries[index] = entry
+        
+        table.source = header["source"]
+        table.samples = header["samples"]
+        
+        return table
+
+# every legal decision's probability under a table entry (or the predictor's own outputs in the same layout), with the item masks of the player in run.
+# this follows BuckshotPredictor_CrossEntropy.sample_actions: use an item with the use item confidence if any item is legal, then pick it from the masked item softmax (and the steal from the masked steal softmax for adrenaline), otherwise shoot the dealer with the shoot dealer confidence.
+# returns a dict of decision -> probability, in the format of BuckshotRun.apply_decision
+def decision_distribution(entry, run, num_items):
+    item_names = run.rules.item_names
+    use_mask, steal_mask = dataset.item_mask_bits(run, run.player, run.dealer)
+    
+    use_item = entry[0] if use_mask else 0.0
+    shoot_dealer = entry[1]
+    
+    distribution = {("shoot", "dealer"): (1 - use_item) * shoot_dealer, ("shoot", "self"): (1 - use_item) * (1 - shoot_dealer)}
+    
+    if use_item > 0:
+        items = _masked_softmax(entry[2:2 + num_items], use_mask)
+        steals = _masked_softmax(entry[2 + num_items:], steal_mask)
+        
+        for item_id, item_probability in items:
+            if item_names[item_id] == "adrenaline":
+                for steal_id, steal_probability in steals:
+                    distribution[("use", "adrenaline", item_names[steal_id])] = use_item * item_probability * steal_probability
+            else:
+                distribution[("use", item_names[item_id])] = use_item * item_probability
+    
+    return distribution
+
+# (id, probability) of every id in mask, from logits
+def _masked_softmax(logits, mask):
+    ids = [i for i in range(len(logits)) if mask >> i & 1]
+    
+    if len(ids) == 0:
+        return []
+    
+    highest = max(logits[i] for i in ids)
+    weights = [math.exp(logits[i] - highest) for i in ids]
+    total = sum(weights)
+    
+    return [(i, weight / total) for i, weight in zip(ids, weights)]
+
+# plays from a LookupTable, and with fallback (any DecisionPolicy, normally a PredictorPolicy for the predictor the table came from) for keys the table doesn't cover.  if a key isn't covered and fallback is None, the decision is picked uniformly from the legal ones.
+class TablePolicy(DecisionPolicy):
+    def __init__(self, table, fallback=None):
+        self.table = table
+        self.fallback = fallback
+        
+        self.random = random.Random()
+        
+        # decisions made from the table and by the fallback
+        self.hits = 0
+        self.misses = 0
+    
+    def decide(self, run):
+        entry = self.table.entry(self.table.run_index(run))
+        
+        if entry is None:
+            self.misses += 1
+            
+            if self.fallback is None:
+                return self.random.choice(policies.legal_decisions(run))
+            
+            return self.fallback.decide(run)
+        
+        self.hits += 1
+        
+        rng = self.random
+        rules = run.rules
+        num_items = self.table.num_items
+        
+        use_mask, steal_mask = dataset.item_mask_bits(run, run.player, run.dealer)
+        
+        if use_mask and rng.random() < entry[0]:
+            item_id = _sample_masked(entry[2:2 + num_items], use_mask, rng)
+            
+            if rules.item_names[item_id] == "adrenaline":
+                return ("use", "adrenaline", rules.item_names[_sample_masked(entry[2 + num_items:], steal_mask, rng)])
+            
+            return ("use", rules.item_names[item_id])
+        
+        return ("shoot", "dealer") if rng.random() < entry[1] else ("shoot", "self")
+    
+    # seeded from a string for the same reason as RandomPolicy
+    def seed(self, seed):
+        self.random.seed("TablePolicy:" + str(seed))
+        
+        if not self.fallback is None:
+            self.fallback.seed(seed)
+    
+    def policy_hash(self):
+        return "table:1:" + str(self.table.source) + ":" + str(self.table.samples) + ":" + ("random" if self.fallback is None else self.fallback.policy_hash())
+
+def _sample_masked(logits, mask, rng):
+    ids_and_probabilities = _masked_softmax(logits, mask)
+    
+    pick = rng.random()
+    
+    for i, probability in ids_and_probabilities:
+        pick -= probability
+        
+        if pick < 0:
+            return i
+    
+    return ids_and_probabilities[-1][0]
+
+# every player input list seen while the predictor plays num_games games from seed, with how many times it came up.  returns a dict of input tuple -> count and the number of decisions
+def sample_inputs(predictor, num_games, seed=0, rules=None, batch_size=256):
+    predictor_policy = policies.PredictorPolicy(predictor)
+    
+    counts = dict()
+    decisions = 0
+    
+    def record_and_decide(runs):
+        nonlocal decisions
+        
+        for run in runs:
+            key = tuple(predictor.get_input_list(run))
+            counts[key] = counts.get(key, 0) + 1
+        
+        decisions += len(runs)
+        
+        return predictor_policy.decide_batch(runs)
+    
+    policies.play_many(record_and_decide, num_games, batch_size=batch_size, rules=rules, seed=seed)
+    
+    return counts, decisions
+
+# the predictor's outputs for a batch of input lists, as rows in the layout of a table entry
+def predictor_outputs(predictor, input_lists):
+    import torch
+    
+    fused = predictor.fused
+    
+    with torch.no_grad():
+        features = fused.core_model(torch.tensor(input_lists, dtype=torch.float32, device=predictor.device))
+        
+        return torch.cat([fused.who_to_shoot_or_use_item(features), fused.which_item_to_use(features), fused.which_item_to_steal(features)], dim=1).cpu()
+
+# distill predictor into a LookupTable from the states it reaches in num_games games from seed.  progress(message) is called between the stages if given
+def distill(predictor, num_games, seed=0, rules=None, query_batch_size=65536, progress=None):
+    import torch
+    
+    table = LookupTable(rules if not rules is None else predictor.rules)
+    
+    counts, decisions = sample_inputs(predictor, num_games, seed, table.rules)
+    
+    if not progress is None:
+        progress("{} decisions, {} distinct inputs".format(decisions, len(counts)))
+    
+    input_lists = list(counts)
+    
+    # every key's entry is the average of the predictor's outputs for its inputs, weighted by how often they came up
+    indices = [table.input_index(input_list) for input_list in input_lists]
+    covered = [i for i, index in enumerate(indices) if index >= 0]
+    
+    keys = sorted(set(indices[i] for i in covered))
+    entry_of_key = {index: entry for entry, index in enumerate(keys)}
+    
+    sums = torch.zeros((len(keys), table.entry_size), dtype=torch.float64)
+    weights = torch.zeros(len(keys), dtype=torch.float64)
+    
+    for start in range(0, len(covered), query_batch_size):
+        batch = covered[start:start + query_batch_size]
+        
+        outputs = predictor_outputs(predictor, [input_lists[i] for i in batch]).double()
+        batch_entries = torch.tensor([entry_of_key[indices[i]] for i in batch])
+        batch_weights = torch.tensor([counts[input_lists[i]] for i in batch], dtype=torch.float64)
+        
+        sums.index_add_(0, batch_entries, outputs * batch_weights.unsqueeze(1))
+        weights.index_add_(0, batch_entries, batch_weights)
+    
+    table.values = array.array("f", (sums / weights.unsqueeze(1)).flatten().tolist())
+    
+    for entry, index in enumerate(keys):
+        table.entries[index] = entry
+    
+    table.source = policies.PredictorPolicy(predictor).policy_hash()
+    table.samples = decisions
+    
+    return table
+
+# compare table with predictor over the decisions the predictor makes in num_games games from seed (use seeds the table wasn't sampled from).  returns a dict of:
+    # decisions, coverage: how many decisions there were and the fraction the table had an entry for
+    # agreement: the fraction of covered decisions where the table's most likely decision is the predictor's
+    # total_variation: the mean total variation distance between the two decision distributions on covered decisions
+def agreement(table, predictor, num_games, seed=0, batch_size=256):
+    predictor_policy = policies.PredictorPolicy(predictor)
+    num_items = table.num_items
+    
+    decisions = 0
+    covered = 0
+    agreed = 0
+    total_variation = 0.0
+    
+    def compare_and_decide(runs):
+        nonlocal decisions, covered, agreed, total_variation
+        
+        entries = [table.entry(table.run_index(run)) for run in runs]
+        outputs = predictor_outputs(predictor, [predictor.get_input_list(run) for run in runs]).tolist()
+        
+        for run, entry, output in zip(runs, entries, outputs):
+            decisions += 1
+            
+            if entry is None:
+                continue
+            
+            covered += 1
+            
+            expected = decision_distribution(output, run, num_items)
+            got = decision_distribution(entry, run, num_items)
+            
+            agreed += max(expected, key=expected.get) == max(got, key=got.get)
+            total_variation += sum(abs(probability - got.get(decision, 0.0)) for decision, probability in expected.items()) / 2
+        
+        return predictor_policy.decide_batch(runs)
+    
+    policies.play_many(compare_and_decide, num_games, batch_size=batch_size, rules=table.rules, seed=seed)
+    
+    return {
+        "decisions": decisions,
+        "coverage": covered / max(1, decisions),
+        "agreement": agreed / max(1, covered),
+        "total_variation": total_variation / max(1, covered)
+    }
+
+# microseconds per decision for policy over the player decisions of num_games games with seeds from seed
+def time_decisions(policy, num_games, seed=0, rules=None):
+    runs = []
+    
+    for game_seed in range(seed, seed + num_games):
+        random.seed(game_seed)
+        
+        run = buckshot.BuckshotRun(logging=False, rules=rules)
+        
+        if run.advance_to_player_decision():
+            runs.append(run)
+    
+    start = time.perf_counter()
+    
+    for run in runs:
+        policy.decide(run)
+    
+    return (time.perf_counter() - start) / max(1, len(runs)) * 1e6
+
+# python distill.py [checkpoint path or "untrained"] [num_games] [table path]
+# distills the predictor into a table, then measures its agreement on held out games, how fast it decides and how it plays compared to the predictor
+def main(argc, argv):
+    import torch
+    
+    source = argv[1] if argc > 1 else "untrained"
+    num_games = int(argv[2]) if argc > 2 else 20000
+    path = argv[3] if argc > 3 else "predictor.lut"
+    
+    rules = buckshot.default_rules
+    
+    if source == "untrained":
+        from cross_entropy import BuckshotPredictor_CrossEntropy
+        
+        torch.manual_seed(0)
+        predictor = BuckshotPredictor_CrossEntropy(rules)
+    else:
+        from checkpoint import load_predictor
+        
+        predictor, extra = load_predictor(source, rules)
+    
+    torch.set_num_threads(1)
+    
+    start = time.perf_counter()
+    
+    table = distill(predictor, num_games, seed=0, progress=print)
+    table.save(path)
+    
+    print("{} entries ({:.2%} of the key space, {} KiB on disk) in {:.1f}s".format(table.num_entries(), table.coverage(), os.path.getsize(path) // 1024, time.perf_counter() - start))
+    
+    table = LookupTable.load(path, rules)
+    
+    report = agreement(table, predictor, 1000, seed=1000000)
+    
+    print("held out: {decisions} decisions, {coverage:.2%} covered, {agreement:.2%} same most likely decision, mean total variation {total_variation:.4f}".format(**report))
+    
+    predictor_policy = policies.PredictorPolicy(predictor)
+    table_policy = TablePolicy(table, fallback=predictor_policy)
+    
+    print("table: {:.1f} us per decision, predictor: {:.1f} us per decision".format(time_decisions(TablePolicy(table), 2000, seed=2000000), time_decisions(predictor_policy, 2000, seed=2000000)))
+    
+    for name, policy in (("predictor", predictor_policy), ("table with fallback", table_policy)):
+        results = [policies.play_game(policy, seed) for seed in range(3000000, 3002000)]
+        
+        print("{}: {:.3f} rounds won per game".format(name, sum(rounds for rounds, sets in results) / len(results)))
+    
+    print("table decisions: {} from the table, {} from the fallback".format(table_policy.hits, table_policy.misses))
+    
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))
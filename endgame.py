@@ -0,0 +1,399 @@
+### shoot-only endgame table ###
+# once neither seat has any items left, all that's left of a round is shooting, which is a small markov game over:
+    # lives and blanks left, player and dealer health, whose turn it is, who is handcuffed, whether the shotgun is sawed off
+    # what the player knows about the next shell (unknown, live or blank), and whether the dealer knows the next shell
+# EndgameTable solves that game exactly by dynamic programming: for every state, the probability that the player wins the round when they play perfectly and the dealer shoots the way Dealer.take_turn does without items.
+# when a set runs out of shells, the next set starts with a chamber from rules.chamber_compositions (every size equally likely) and, since this is the shoot-only game, no new items.
+# only the next shell is tracked, so shells further down the chamber that either seat found with the phone are treated as unknown.
+# a table depends only on the rules, so it's built once per rule set and cached on disk under the rules' fingerprint, see EndgameTable.cached.
+
+import os
+import sys
+import time
+import json
+import array
+import random
+import struct
+
+import buckshot
+from buckshot import BuckshotRun
+import policies
+from policies import DecisionPolicy
+
+magic = b"BSHOTEND"
+table_version = 1
+
+_preamble = struct.Struct("<8sIQ")
+
+# what a seat knows about the next shell
+UNKNOWN = 0
+LIVE = 1
+BLANK = 2
+
+# best decisions
+SHOOT_DEALER = 0
+SHOOT_SELF = 1
+
+# what participant knows about the next shell, or None
+def _next_known(participant):
+    return participant.known_sequence[0] if len(participant.known_sequence) > 0 else None
+
+class EndgameTable():
+    # an empty table for rules (default_rules if None), see build and cached
+    def __init__(self, rules=None):
+        if rules is None:
+            rules = buckshot.default_rules
+        
+        self.rules = rules
+        
+        max_shells = rules.max_shells_per_set
+        max_health = rules.max_health
+        
+        # sizes of the state dimensions, in the order of index's arguments
+        self.shape = (max_shells + 1, max_shells + 1, max_health + 1, max_health + 1, 2, 3, 2, 3, 2)
+        
+        self.strides = []
+        stride = 1
+        
+        for size in reversed(self.shape):
+            self.strides.insert(0, stride)
+            stride *= size
+        
+        self.size = stride
+        
+        # win probability for every state, and the best decision for the player in states where it's their turn
+        self.values = array.array("d", bytes(8 * self.size))
+        self.decisions = bytearray(self.size)
+    
+    # flat index of a state.  turn is 0 for the player and 1 for the dealer, handcuffed is BuckshotRun.who_handcuffed_id, sawed_off and dealer_knows are bools and player_knows is UNKNOWN, LIVE or BLANK
+    def index(self, lives, blanks, player_health, dealer_health, turn, handcuffed, sawed_off, player_knows, dealer_knows):
+        strides = self.strides
+        
+        return lives * strides[0] + blanks * strides[1] + player_health * strides[2] + dealer_health * strides[3] + turn * strides[4] + (handcuffed + 1) * strides[5] + int(sawed_off) * strides[6] + player_knows * strides[7] + int(dealer_knows) * strides[8]
+    
+    # fill the table.  every state is solved once, from the end of the round backwards
+    def build(self):
+        rules = self.rules
+        solved = dict()
+        
+        # the start of a new set with these healths and cuffs
+        def new_set(player_health, dealer_health, handcuffed):
+            total = 0.0
+            
+            for lives, blanks in rules.chamber_compositions.values():
+                total += solve(lives, blanks, player_health, dealer_health, BuckshotRun.player_id, handcuffed, False, UNKNOWN, False)
+            
+            return total / len(rules.chamber_compositions)
+        
+        # the value right after a shell was fired.  same as BuckshotRun.shoot
+        def after_shot(lives, blanks, player_health, dealer_health, turn, handcuffed, sawed_off, live, shooting_self):
+            healths = [player_health, dealer_health]
+            opponent = 1 - turn
+            
+            damage = (rules.sawedoff_live_damage if sawed_off else rules.base_live_damage) if live else 0
+            
+            if live:
+                lives -= 1
+            else:
+                blanks -= 1
+            
+            if not shooting_self:
+                healths[opponent] -= damage
+                
+                if handcuffed == opponent:
+                    handcuffed = BuckshotRun.nobody_id
+                else:
+                    turn = opponent
+            else:
+                healths[turn] -= damage
+                
+                if live:
+                    if handcuffed == opponent:
+                        handcuffed = BuckshotRun.nobody_id
+                    else:
+                        turn = opponent
+            
+            if healths[0] < 1:
+                return 0.0
+            elif healths[1] < 1:
+                return 1.0
+            elif lives + blanks == 0:
+                return new_set(healths[0], healths[1], handcuffed)
+            else:
+                return solve(lives, blanks, healths[0], healths[1], turn, handcuffed, False, UNKNOWN, False)
+        
+        def solve(*state):
+            if state in solved:
+                return solved[state]
+            
+            lives, blanks, player_health, dealer_health, turn, handcuffed, sawed_off, player_knows, dealer_knows = state
+            
+            if player_knows == LIVE:
+                live_probability = 1.0
+            elif player_knows == BLANK:
+                live_probability = 0.0
+            else:
+                live_probability = lives / (lives + blanks)
+            
+            # (probability, shell is live) for every shell it could be
+            shells = [(probability, live) for probability, live in ((live_probability, True), (1 - live_probability, False)) if probability > 0]
+            
+            def expected(shooting_self):
+                return sum(probability * after_shot(lives, blanks, player_health, dealer_health, turn, handcuffed, sawed_off, live, shooting_self) for probability, live in shells)
+            
+            if turn == BuckshotRun.player_id:
+                shoot_dealer = expected(False)
+                shoot_self = expected(True)
+                
+                # ties go to shooting the dealer
+                if shoot_self > shoot_dealer:
+                    value = shoot_self
+                    self.decisions[self.index(*state)] = SHOOT_SELF
+                else:
+                    value = shoot_dealer
+                    self.decisions[self.index(*state)] = SHOOT_DEALER
+            else:
+                # see Dealer.can_peek_next_shell, and the one shell check right after it in Dealer.take_turn
+                if dealer_knows or lives == 0 or blanks == 0 or lives + blanks == 1:
+                    # he shoots the player with a live and himself with a blank
+                    value = sum(probability * after_shot(lives, blanks, player_health, dealer_health, turn, handcuffed, sawed_off, live, not live) for probability, live in shells)
+                elif lives > blanks:
+                    value = expected(False)
+                elif lives < blanks:
+                    value = expected(True)
+                else:
+                    # Dealer.coin_flip
+                    value = 0.5 * expected(False) + 0.5 * expected(True)
+            
+            solved[state] = value
+            self.values[self.index(*state)] = value
+            
+            return value
+        
+        max_shells = rules.max_shells_per_set
+        
+        for lives in range(max_shells + 1):
+            for blanks in range(max_shells + 1 - lives):
+                if lives + blanks == 0:
+                    continue
+                
+                for player_health in range(1, rules.max_health + 1):
+                    for dealer_health in range(1, rules.max_health + 1):
+                        for turn in (BuckshotRun.player_id, BuckshotRun.dealer_id):
+                            for handcuffed in (BuckshotRun.nobody_id, BuckshotRun.player_id, BuckshotRun.dealer_id):
+                                for sawed_off in (False, True):
+                                    for player_knows in (UNKNOWN, LIVE, BLANK):
+                                        # knowing a shell there's none of isn't possible
+                                        if (player_knows == LIVE and lives == 0) or (player_knows == BLANK and blanks == 0):
+                                            continue
+                                        
+                                        for dealer_knows in (False, True):
+                                            solve(lives, blanks, player_health, dealer_health, turn, handcuffed, sawed_off, player_knows, dealer_knows)
+        
+        return self
+    
+    ## queries ##
+    
+    # index of run's current state.  run's items are ignored, the table is only exact when nobody has any left (see is_endgame)
+    def run_index(self, run):
+        player_known = _next_known(run.player)
+        
+        if player_known is None:
+            player_knows = UNKNOWN
+        else:
+            player_knows = LIVE if buckshot.shell_is_live(player_known) else BLANK
+        
+        dealer_knows = run.dealer.dealer_knows_shell or not _next_known(run.dealer) is None
+        
+        return self.index(run.num_live(), run.num_blank(), max(run.player.health, 0), max(run.dealer.health, 0), run.whose_turn_id, run.who_handcuffed_id, run.is_sawed_off, player_knows, dealer_knows)
+    
+    # probability that the player wins the current round of run from here
+    def value(self, run):
+        return self.values[self.run_index(run)]
+    
+    # the best decision for the player in run, in the format of BuckshotRun.apply_decision
+    def best_decision(self, run):
+        return ("shoot", "self") if self.decisions[self.run_index(run)] == SHOOT_SELF else ("shoot", "dealer")
+    
+    # the same queries on a kernel state (see kernel.py), for search code working on the kernel
+    def kernel_index(self, s):
+        import kernel
+        
+        player_known = s[kernel.KNOWN]
+        player_knows = UNKNOWN if player_known == kernel.UNKNOWN else (LIVE if player_known == kernel.LIVE else BLANK)
+        
+        dealer_knows = s[kernel.DEALER_KNOWS_SHELL] or s[kernel.KNOWN + kernel.shell_capacity] != kernel.UNKNOWN
+        
+        lives = kernel.num_live(s)
+        
+        return self.index(lives, s[kernel.NUM_SHELLS] - lives, max(s[kernel.HEALTH], 0), max(s[kernel.HEALTH + 1], 0), s[kernel.TURN], s[kernel.CUFFED], s[kernel.SAWED_OFF], player_knows, dealer_knows)
+    
+    def kernel_value(self, s):
+        return self.values[self.kernel_index(s)]
+    
+    ## files ##
+    
+    def save(self, path):
+        header = json.dumps({"rules_fingerprint": self.rules.fingerprint(), "shape": self.shape}).encode()
+        
+        temp_path = path + ".tmp"
+        
+        with open(temp_path, "wb") as f:
+            f.write(_preamble.pack(magic, table_version, len(header)))
+            f.write(header)
+            f.write(self.values.tobytes())
+            f.write(self.decisions)
+            
+            f.flush()
+            os.fsync(f.fileno())
+        
+        os.replace(temp_path, path)
+    
+    # load a table saved for rules.  raises ValueError if the file isn't a table for these rules
+    @classmethod
+    def load(cls, path, rules=None):
+        table = cls(rules)
+        
+        with open(path, "rb") as f:
+            data = f.read()
+        
+        if len(data) < _preamble.size:
+            raise ValueError(path + " is too short to be an endgame table")
+        
+        file_magic, version, header_length = _preamble.unpack_from(data)
+        
+        if file_magic != magic or version != table_version:
+            raise ValueError(path + " isn't a version " + str(table_version) + " endgame table")
+        
+        header = json.loads(data[_preamble.size:_preamble.size + header_length])
+        
+        if header["rules_fingerprint"] != table.rules.fingerprint() or tuple(header["shape"]) != table.shape:
+            raise ValueError(path + " was built for different rules")
+        
+        start = _preamble.size + header_length
+        
+        if len(data) != start + 9 * table.size:
+            raise ValueError(path + " is truncated")
+        
+        table.values = array.array("d")
+        table.values.frombytes(data[start:start + 8 * table.size])
+        table.decisions = bytearray(data[start + 8 * table.size:])
+        
+        return table
+    
+    # the table for rules from cache_dir, built and saved there first if it isn't cached yet
+    @classmethod
+    def cached(cls, rules=None, cache_dir="endgame_cache"):
+        if rules is None:
+            rules = buckshot.default_rules
+        
+        path = os.path.join(cache_dir, "endgame_" + rules.fingerprint() + ".bin")
+        
+        if os.path.exists(path):
+            try:
+                return cls.load(path, rules)
+            except ValueError:
+                pass
+        
+        table = cls(rules).build()
+        
+        os.makedirs(cache_dir, exist_ok=True)
+        table.save(path)
+        
+        return table
+
+# true if neither seat has any items left, which is when EndgameTable is exact
+def is_endgame(run):
+    return len(run.player.inventory.items) == 0 and len(run.dealer.inventory.items) == 0
+
+# shoots the way the endgame table says is best and never uses items.  a baseline to compare other policies against
+class EndgamePolicy(DecisionPolicy):
+    def __init__(self, table=None):
+        self.table = EndgameTable.cached() if table is None else table
+    
+    def decide(self, run):
+        return self.table.best_decision(run)
+    
+    def policy_hash(self):
+        return "endgame:1:" + self.table.rules.fingerprint()
+
+# play the rest of the round in run with policy and the dealer's ai.  returns 1 if the player won it and 0 if they died
+def _play_round(run, policy):
+    rounds = run.rounds_won()
+    
+    # a new round always starts with the player's turn, so advancing never goes past the end of this one
+    while run.advance_to_player_decision() and run.rounds_won() == rounds:
+        policy.take_turn(run)
+    
+    return 0 if run.is_over() else 1
+
+# python endgame.py [num_games]
+# builds the table for rules without items (so that every set is a shoot-only endgame), then checks its values against games played out with BuckshotRun from a few states, and compares it as a policy against the dealer's logic.
+def main(argc, argv):
+    num_games = int(argv[1]) if argc > 1 else 20000
+    
+    rules = buckshot.default_rules.with_overrides(min_items_per_set=0, max_items_per_set=0)
+    
+    start = time.perf_counter()
+    table = EndgameTable(rules).build()
+    
+    print("built {} states in {:.2f}s".format(table.size, time.perf_counter() - start))
+    
+    cache_dir = "endgame_cache"
+    
+    EndgameTable.cached(rules, cache_dir)
+    
+    start = time.perf_counter()
+    EndgameTable.cached(rules, cache_dir)
+    
+    print("loaded from cache in {:.2f}ms".format((time.perf_counter() - start) * 1000))
+    
+    policy = EndgamePolicy(table)
+    
+    live = buckshot.live_token
+    blank = buckshot.blank_token
+    
+    # (chamber, player health, dealer health, whether the player knows the first shell, player turn)
+    starts = [
+        ([live, blank, blank], 2, 2, False, True),
+        ([live, live, blank, blank, live], 3, 1, False, True),
+        ([blank, live, blank, live], 1, 3, True, True),
+        ([live, blank, live, blank, blank, blank], 4, 4, False, False)
+    ]
+    
+    random.seed(0)
+    
+    print("table".rjust(8) + "played".rjust(8) + "   state")
+    
+    for chamber, player_health, dealer_health, player_known, player_turn in starts:
+        def make_run():
+            shuffled = list(chamber)
+            
+            # the player's knowledge is about the first shell, so only the rest is shuffled
+            if not player_known:
+                random.shuffle(shuffled)
+                
+                known = None
+            else:
+                rest = shuffled[1:]
+                random.shuffle(rest)
+                shuffled = shuffled[:1] + rest
+                
+                known = shuffled[:1] + [None] * len(rest)
+            
+            return BuckshotRun.from_state(shuffled, player_health, dealer_health, player_known=known, player_turn=player_turn, rules=rules)
+        
+        expected = table.value(make_run())
+        wins = sum(_play_round(make_run(), policy) for game in range(num_games))
+        
+        print("{:.4f}".format(expected).rjust(8) + "{:.4f}".format(wins / num_games).rjust(8) + "   {} lives, {} blanks, health {}/{}, {}".format(chamber.count(live), chamber.count(blank), player_health, dealer_health, "player's turn" if player_turn else "dealer's turn"))
+    
+    for name, contender in (("endgame table", policy), ("dealer logic", policies.DealerLogicPolicy())):
+        results = [policies.play_game(contender, seed, rules) for seed in range(num_games // 10)]
+        
+        print("{}: {:.3f} rounds/game".format(name, sum(rounds for rounds, sets in results) / len(results)))
+    
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))
@@ -0,0 +1,115 @@
+### structured game events ###
+# BuckshotRun and BuckshotPredictor_CrossEntropy emit these events to whoever subscribed to them with subscribe(callback).
+# events are only ever created if something is subscribed, so the game runs exactly as fast with no subscribers as it did without any logging at all.
+# the text output you get with logging=True is just print_event subscribed to the run.
+
+import json
+import queue
+import threading
+import collections
+
+# user used item_name.  for adrenaline, this is emitted for the adrenaline and then again for the stolen item.
+ItemUsedEvent = collections.namedtuple("ItemUsedEvent", ["user", "item_name"])
+
+# shooter shot target (which is the shooter if they shot themselves).  shell is the live or blank token.
+ShotFiredEvent = collections.namedtuple("ShotFiredEvent", ["shooter", "target", "shell", "damage"])
+
+# the chamber was emptied and reloaded with num_live and num_blank shells, and both participants got new items.  this also happens once when a run starts and at the start of every round.
+SetEndedEvent = collections.namedtuple("SetEndedEvent", ["sets_won", "num_live", "num_blank", "player_items", "dealer_items"])
+
+# the dealer died, so the player won a round.  match_won is True if that was the last round of the match.
+RoundEndedEvent = collections.namedtuple("RoundEndedEvent", ["rounds_won", "matches_won", "match_won"])
+
+# the run stopped at one of its limits (see buckshot.RunLimits) with the player still alive.  reason is "matches", "rounds", "sets" or "steps".
+RunTruncatedEvent = collections.namedtuple("RunTruncatedEvent", ["reason", "rounds_won", "sets_won"])
+
+# the predictor made a decision.  the confidences are plain numbers, and item confidences are dicts of item name -> confidence or None if that head wasn't used.
+DecisionMadeEvent = collections.namedtuple("DecisionMadeEvent", ["use_item_confidence", "shoot_dealer_confidence", "item_confidences", "steal_item_confidences", "decision"])
+
+def event_as_dict(event):
+    event_dict = {"event": type(event).__name__}
+    event_dict.update(event._asdict())
+    
+    return event_dict
+
+## subscribers ##
+
+# prints events as human readable text.  this is the same output that logging used to print inline.
+def print_event(event):
+    if isinstance(event, ItemUsedEvent):
+        print(event.user + " used " + event.item_name)
+    elif isinstance(event, ShotFiredEvent):
+        if event.shooter == event.target:
+            print(event.shooter + " shot themselves")
+        else:
+            print(event.shooter + " shot " + event.target)
+    elif isinstance(event, RunTruncatedEvent):
+        print("run stopped at its " + event.reason + " limit after winning " + str(event.rounds_won) + " rounds and " + str(event.sets_won) + " sets")
+    elif isinstance(event, DecisionMadeEvent):
+        print("{:.2f}% sure about using an item".format(event.use_item_confidence * 100))
+        print("{:.2f}% sure about shooting the dealer".format(event.shoot_dealer_confidence * 100))
+        print("")
+        
+        for title, confidences in (("item confidences:", event.item_confidences), ("steal item confidences:", event.steal_item_confidences)):
+            if confidences is None:
+                continue
+            
+            print(title)
+            
+            for item_name, confidence in confidences.items():
+                print(item_name.rjust(10, " ") + ":" + "{:.2%}".format(confidence).rjust(8, " "))
+            
+            print("")
+
+# collects events and writes them as JSON lines from a background thread, a batch at a time.
+# target is either a path (opened for appending) or any object with a write method, like an io.StringIO buffer.
+# call close() when done to write whatever is left and stop the thread.
+class BatchingEventSink():
+    def __init__(self, target, batch_size=4096):
+        self.batch_size = batch_size
+        self.batch = []
+        
+        if isinstance(target, str):
+            self.file = open(target, "a")
+            self.owns_file = True
+        else:
+            self.file = target
+            self.owns_file = False
+        
+        self.batches = queue.Queue()
+        
+        self.thread = threading.Thread(target=self.write_batches, daemon=True)
+        self.thread.start()
+    
+    # subscribe the sink itself
+    def __call__(self, event):
+        self.batch.append(event)
+        
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+    
+    # hand the current batch to the writer thread
+    def flush(self):
+        if len(self.batch) > 0:
+            self.batches.put(self.batch)
+            self.batch = []
+    
+    def write_batches(self):
+        while True:
+            batch = self.batches.get()
+            
+            if batch is None:
+                break
+            
+            self.file.write("".join(json.dumps(event_as_dict(event)) + "\n" for event in batch))
+    
+    def close(self):
+        self.flush()
+        
+        self.batches.put(None)
+        self.thread.join()
+        
+        self.file.flush()
+        
+        if self.owns_file:
+            self.file.close()
@@ -0,0 +1,111 @@
+### exported predictors for fast inference ###
+# a BuckshotPredictor_CrossEntropy's FusedPredictor can be exported two ways:
+    # export_torchscript(predictor, path) saves a TorchScript file, which load_torchscript(path) (or plain torch.jit.load) loads back without needing cross_entropy.py or any other python class
+    # compile_predictor(predictor) compiles the module in this process with torch.compile
+# both take (input_tensor, use_mask, steal_mask) and return (confidences, item_confidences, steal_item_confidences), see FusedPredictor.
+# the exported modules are a snapshot of the predictor's weights at export time.  the compiled module shares the weights, like the FusedPredictor it was compiled from.
+
+import sys
+import time
+
+import torch
+
+from buckshot import BuckshotRun
+import cross_entropy
+from cross_entropy import BuckshotPredictor_CrossEntropy, get_legal_item_masks
+
+def script_predictor(predictor):
+    return torch.jit.script(predictor.fused.eval())
+
+def export_torchscript(predictor, path):
+    torch.jit.save(script_predictor(predictor), path)
+
+def load_torchscript(path, device=None):
+    return torch.jit.load(path, map_location=cross_entropy.device if device is None else device)
+
+# extra keyword arguments are passed on to torch.compile, eg mode="reduce-overhead"
+def compile_predictor(predictor, **kwargs):
+    return torch.compile(predictor.fused.eval(), **kwargs)
+
+# input tensor and masks for a batch of runs, ready to pass to any of the modules above.  they're put on device, or the predictor's device if None
+def runs_to_tensors(predictor, runs, device=None):
+    device = predictor.device if device is None else device
+    
+    input_tensor = torch.tensor([predictor.get_input_list(run) for run in runs]).float().to(device)
+    
+    masks = [get_legal_item_masks(run) for run in runs]
+    
+    use_mask = torch.tensor([use for use, steal in masks], device=device)
+    steal_mask = torch.tensor([steal for use, steal in masks], device=device)
+    
+    return input_tensor, use_mask, steal_mask
+
+# seconds per call of module on inputs, after warmup calls
+def time_module(module, inputs, num_calls, warmup=20):
+    with torch.no_grad():
+        for i in range(warmup):
+            module(*inputs)
+        
+        start = time.perf_counter()
+        
+        for i in range(num_calls):
+            module(*inputs)
+        
+        return (time.perf_counter() - start) / num_calls
+
+# python inference.py [batch_size] [path]
+# exports the predictor to path, loads it back, checks every version agrees with eager mode, and compares single decision latency and batched throughput on the cpu.
+def main(argc, argv):
+    batch_size = int(argv[1]) if argc > 1 else 1024
+    path = argv[2] if argc > 2 else "predictor_fused.pt"
+    
+    # the benchmark is about the cpu, so everything stays there regardless of cuda
+    device = torch.device("cpu")
+    
+    # single threaded, since that's how tournament and server workers run
+    torch.set_num_threads(1)
+    
+    predictor = BuckshotPredictor_CrossEntropy(device=device)
+    
+    export_torchscript(predictor, path)
+    
+    modules = {
+        "eager": predictor.fused.eval(),
+        "torchscript": load_torchscript(path, device)
+    }
+    
+    try:
+        modules["torch.compile"] = compile_predictor(predictor)
+    except Exception as e:
+        print("torch.compile unavailable: " + str(e))
+    
+    runs = [BuckshotRun(logging=False) for i in range(batch_size)]
+    
+    single_inputs = runs_to_tensors(predictor, runs[:1])
+    batch_inputs = runs_to_tensors(predictor, runs)
+    
+    with torch.no_grad():
+        expected = modules["eager"](*batch_inputs)
+    
+    print("module".ljust(16) + "max diff".rjust(12) + "latency".rjust(12) + "decisions/s".rjust(16))
+    
+    for name, module in list(modules.items()):
+        try:
+            with torch.no_grad():
+                outputs = module(*batch_inputs)
+        except Exception as e:
+            print(name.ljust(16) + " failed: " + str(e).splitlines()[0])
+            
+            continue
+        
+        max_diff = max((output - expected_output).abs().max().item() for output, expected_output in zip(outputs, expected))
+        
+        latency = time_module(module, single_inputs, 2000)
+        throughput = batch_size / time_module(module, batch_inputs, 200)
+        
+        print(name.ljust(16) + "{:.2e}".format(max_diff).rjust(12) + "{:.1f}us".format(latency * 1e6).rjust(12) + "{:.0f}".format(throughput).rjust(16))
+    
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))
@@ -0,0 +1,297 @@
+### information set monte carlo tree search ###
+# a search based player that doesn't need any training.  the tree is built over what the player can see (their information sets), and every iteration plays through it in a different determinization: a guess at the hidden chamber that is consistent with everything the player knows.
+# determinizations keep every shell the player knows (player.known_sequence) in place and shuffle the rest among the unknown positions, which keeps the live/blank counts right.  the dealer's knowledge is then read off the guessed chamber.
+# the game itself, the dealer's responses (Dealer.take_turn) included, is played out with the fast kernel (kernel.py), so this needs the standard items.
+# every node is one information set of the player deciding.  below each decision, the dealer's turn and any luck (medicine, the phone, new sets) is played out in the determinization, and whatever the player sees afterwards picks the child node.
+# the value of a decision is the chance of winning the current round.  new nodes are valued with leaf_rollouts rollouts at once (leaf parallelism), on numba's threads if parallel is set.
+# the tree is kept between decisions, so when the game continues into a part of the tree that was already searched, the search picks up from there instead of starting over.
+
+import sys
+import math
+import time
+import random
+
+from buckshot import BuckshotRun
+import kernel
+import policies
+from policies import DecisionPolicy
+
+# everything in a kernel state that the player can see
+_visible = (
+    [kernel.GAME_OVER, kernel.TURN, kernel.CUFFED, kernel.SAWED_OFF, kernel.CURRENT_ROUND, kernel.CURRENT_SET, kernel.SETS_WON, kernel.MATCHES_WON, kernel.NUM_SHELLS]
+    + [kernel.HEALTH + seat for seat in range(2)]
+    + [kernel.MAX_HEALTH + seat for seat in range(2)]
+    + list(range(kernel.KNOWN, kernel.KNOWN + kernel.shell_capacity))
+    + list(range(kernel.ITEM_COUNTS, kernel.ITEM_COUNTS + 2 * kernel.NUM_ITEMS))
+)
+
+if kernel.have_numba:
+    import numpy
+    
+    _visible = numpy.array(_visible)
+
+# key of the player's information set in kernel state s.  the number of live shells left is included since the player can count them
+def information_key(s):
+    if kernel.have_numba:
+        return s[_visible].tobytes() + bytes([kernel.num_live(s)])
+    else:
+        return tuple(s[i] for i in _visible) + (kernel.num_live(s),)
+
+# a copy of kernel state s with the shells the player doesn't know shuffled with rng
+def determinize(s, rng):
+    s = s.copy()
+    
+    unknown = [i for i in range(s[kernel.NUM_SHELLS]) if s[kernel.KNOWN + i] == kernel.UNKNOWN]
+    shells = [s[kernel.CHAMBER + i] for i in unknown]
+    
+    rng.shuffle(shells)
+    
+    for i, shell in zip(unknown, shells):
+        s[kernel.CHAMBER + i] = shell
+    
+    # the dealer knows the same positions as before, but of the guessed chamber
+    dealer_known = kernel.KNOWN + kernel.shell_capacity
+    
+    for i in range(s[kernel.NUM_SHELLS]):
+        if s[dealer_known + i] != kernel.UNKNOWN:
+            s[dealer_known + i] = s[kernel.CHAMBER + i]
+    
+    if s[kernel.DEALER_KNOWS_SHELL] and s[kernel.NUM_SHELLS] > 0:
+        s[kernel.DEALER_KNOWN_SHELL] = s[kernel.CHAMBER]
+    
+    return s
+
+class _Node():
+    __slots__ = ("visits", "decisions", "untried", "edge_visits", "edge_values", "children")
+    
+    def __init__(self, s, rng):
+        decisions = kernel.new_array(kernel.NUM_DECISIONS)
+        count = kernel.legal_decisions(s, decisions)
+        
+        self.visits = 0
+        self.decisions = [int(decision) for decision in decisions[:count]]
+        
+        # indices of decisions that haven't been tried yet, in random order
+        self.untried = list(range(count))
+        rng.shuffle(self.untried)
+        
+        self.edge_visits = [0] * count
+        self.edge_values = [0.0] * count
+        
+        # information key -> _Node, for every decision
+        self.children = [dict() for i in range(count)]
+    
+    def select(self, exploration):
+        if len(self.untried) > 0:
+            return self.untried.pop()
+        
+        log_visits = math.log(self.visits)
+        
+        best_index = 0
+        best_score = -1.0
+        
+        for index, (visits, value) in enumerate(zip(self.edge_visits, self.edge_values)):
+            score = value / visits + exploration * math.sqrt(log_visits / visits)
+            
+            if score > best_score:
+                best_index = index
+                best_score = score
+        
+        return best_index
+
+class ISMCTSPolicy(DecisionPolicy):
+    # deadline_ms is the default time budget for each decision, see decide.  max_iterations caps the iterations of a decision as well, which makes searches repeatable when the deadline is never hit.
+    # exploration is the ucb1 constant, leaf_rollouts is how many rollouts value a new node, and parallel spreads those rollouts over numba's threads.
+    # endgame is an endgame.EndgameTable for the rules being played.  if given, new nodes where neither seat has items left are valued from the table instead of with rollouts.
+    def __init__(self, deadline_ms=100, exploration=0.7, leaf_rollouts=8, max_iterations=None, parallel=False, reuse_tree=True, endgame=None, seed=None):
+        self.deadline_ms = deadline_ms
+        self.exploration = exploration
+        self.leaf_rollouts = leaf_rollouts
+        self.max_iterations = max_iterations
+        self.parallel = parallel
+        self.reuse_tree = reuse_tree
+        self.endgame = endgame
+        
+        self.random = random.Random()
+        
+        self.rules = None
+        self.params = None
+        
+        # the root of the last search and the index of the decision that was taken there
+        self.last_root = None
+        self.last_index = None
+        
+        # stats of the last decision
+        self.iterations = 0
+        self.reused_visits = 0
+        
+        self.seed(seed)
+    
+    def seed(self, seed):
+        # seeded from a string for the same reason as RandomPolicy
+        self.random.seed("ISMCTSPolicy:" + str(seed))
+        
+        kernel.seed(self.random.getrandbits(32))
+        
+        self.last_root = None
+        self.last_index = None
+    
+    def policy_hash(self):
+        return "ismcts:1:{}:{}:{}:{}:{}".format(self.deadline_ms, self.exploration, self.leaf_rollouts, self.max_iterations, "rollouts" if self.endgame is None else "endgame")
+    
+    # the value of a new node
+    def evaluate(self, s):
+        if not self.endgame is None and s[kernel.INVENTORY_SIZE] == 0 and s[kernel.INVENTORY_SIZE + 1] == 0:
+            return self.endgame.kernel_value(s)
+        
+        if self.parallel:
+            return kernel.rollout_many_parallel(s, self.params, self.leaf_rollouts) / self.leaf_rollouts
+        else:
+            return kernel.rollout_many(s, self.params, self.leaf_rollouts) / self.leaf_rollouts
+    
+    # one pass down the tree in a fresh determinization of root_state, then back up with the value found
+    def iterate(self, root, root_state):
+        s = determinize(root_state, self.random)
+        
+        node = root
+        path = []
+        
+        while True:
+            index = node.select(self.exploration)
+            path.append((node, index))
+            
+            start_rounds = kernel.rounds_won(s, self.params)
+            
+            kernel.apply_decision(s, self.params, node.decisions[index])
+            
+            while not s[kernel.GAME_OVER] and s[kernel.TURN] == kernel.dealer_seat and kernel.rounds_won(s, self.params) == start_rounds:
+                kernel.dealer_take_turn(s, self.params)
+            
+            if s[kernel.GAME_OVER]:
+                value = 0.0
+                
+                break
+            
+            if kernel.rounds_won(s, self.params) > start_rounds:
+                value = 1.0
+                
+                break
+            
+            key = information_key(s)
+            child = node.children[index].get(key)
+            
+            if child is None:
+                node.children[index][key] = _Node(s, self.random)
+                
+                value = self.evaluate(s)
+                
+                break
+            
+            node = child
+        
+        for node, index in path:
+            node.visits += 1
+            node.edge_visits[index] += 1
+            node.edge_values[index] += value
+    
+    # the root for run: the subtree the game has moved into since the last decision if there is one, otherwise a new tree
+    def find_root(self, s):
+        if self.reuse_tree and not self.last_root is None:
+            root = self.last_root.children[self.last_index].get(information_key(s))
+            
+            if not root is None:
+                return root
+        
+        return _Node(s, self.random)
+    
+    # search for the best decision for the player in run within deadline_ms milliseconds of wall clock time (self.deadline_ms if None).  at least one iteration is always done.
+    # returns the decision that was searched the most, in the format of BuckshotRun.apply_decision
+    def decide(self, run, deadline_ms=None):
+        if not run.is_player_turn() or run.is_over():
+            raise ValueError("ISMCTSPolicy can only decide on the player's turn")
+        
+        deadline = time.perf_counter() + (self.deadline_ms if deadline_ms is None else deadline_ms) / 1000
+        
+        if not run.rules is self.rules:
+            self.rules = run.rules
+            self.params = kernel.rules_to_params(run.rules)
+            self.last_root = None
+        
+        root_state = kernel.encode_run(run)
+        root = self.find_root(root_state)
+        
+        self.reused_visits = root.visits
+        self.iterations = 0
+        
+        while self.max_iterations is None or self.iterations < self.max_iterations:
+            self.iterate(root, root_state)
+            self.iterations += 1
+            
+            if time.perf_counter() >= deadline:
+                break
+        
+        index = max(range(len(root.decisions)), key=root.edge_visits.__getitem__)
+        
+        self.last_root = root
+        self.last_index = index
+        
+        return kernel.decision_to_tuple(root_state, root.decisions[index])
+
+# python ismcts.py [num_games] [deadline_ms]
+# plays the same games with the random and dealer logic policies and with ismcts at a few time budgets (and with the endgame table for leaves), to show how playing strength scales with time.
+def main(argc, argv):
+    from endgame import EndgameTable
+    
+    num_games = int(argv[1]) if argc > 1 else 40
+    deadline_ms = float(argv[2]) if argc > 2 else 10
+    
+    print("numba: " + ("yes" if kernel.have_numba else "no, running the pure python fallback"))
+    
+    contenders = [
+        ("random", policies.RandomPolicy()),
+        ("dealer logic", policies.DealerLogicPolicy())
+    ]
+    
+    for budget in (deadline_ms / 4, deadline_ms):
+        contenders.append(("ismcts {:g}ms".format(budget), ISMCTSPolicy(deadline_ms=budget)))
+    
+    contenders.append(("ismcts {:g}ms parallel".format(deadline_ms), ISMCTSPolicy(deadline_ms=deadline_ms, parallel=True)))
+    contenders.append(("ismcts {:g}ms endgame".format(deadline_ms), ISMCTSPolicy(deadline_ms=deadline_ms, endgame=EndgameTable.cached())))
+    
+    # compile the kernel before timing anything
+    ISMCTSPolicy(max_iterations=2, parallel=True).decide(BuckshotRun(logging=False))
+    
+    for name, policy in contenders:
+        iterations = []
+        reused = []
+        
+        if isinstance(policy, ISMCTSPolicy):
+            decide = policy.decide
+            
+            def record(run, decide=decide):
+                decision = decide(run)
+                
+                iterations.append(policy.iterations)
+                reused.append(policy.reused_visits)
+                
+                return decision
+            
+            policy.decide = record
+        
+        start = time.perf_counter()
+        
+        results = [policies.play_game(policy, seed) for seed in range(num_games)]
+        
+        elapsed = time.perf_counter() - start
+        
+        line = "{}: {:.3f} rounds/game, {:.3f} sets/game, {:.1f}s".format(name.ljust(24), sum(rounds for rounds, sets in results) / num_games, sum(sets for rounds, sets in results) / num_games, elapsed)
+        
+        if len(iterations) > 0:
+            line += ", {:.0f} iterations/decision, {:.0f} visits reused/decision".format(sum(iterations) / len(iterations), sum(reused) / len(reused))
+        
+        print(line)
+    
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))
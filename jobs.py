@@ -0,0 +1,383 @@
+### resumable jobs ###
+# long simulations and training runs save their progress every so often, so a job that gets preempted or killed picks up where it left off instead of starting over, and finishes with exactly the results it would have had without the interruption.
+# every save writes a temporary file and renames it over the old one, so a job killed mid-save still has its previous checkpoint.
+# Checkpointer decides when to save: every interval seconds, but never so often that saving takes more than max_overhead of the time (a save that took 0.5s with max_overhead 0.02 means the next one waits at least 25s).
+# simulations (see simulate.simulate's checkpoint argument) save SimulationProgress: which blocks of seeds are done and the result of every game in them.  every game is seeded on its own, so there's no rng state to save, and blocks can finish in any order.
+# training (see run_training) saves the predictor's weights, the optimizer, the python, torch and predictor rng states, the iteration and the learning curve with checkpoint.save_predictor, so the resumed run makes exactly the same updates.
+
+import os
+import sys
+import json
+import time
+import array
+import struct
+import signal
+import subprocess
+
+magic = b"BSHOTJOB"
+progress_version = 1
+
+_preamble = struct.Struct("<8sIQ")
+
+# game statuses as stored in SimulationProgress, 0 is a game that wasn't played yet
+_status_codes = {"dead": 1, "truncated": 2}
+_status_names = {code: name for name, code in _status_codes.items()}
+
+class Checkpointer():
+    def __init__(self, interval=60.0, max_overhead=0.02):
+        if interval < 0 or not 0 < max_overhead <= 1:
+            raise ValueError("interval can't be negative and max_overhead must be between 0 and 1")
+        
+        self.interval = interval
+        self.max_overhead = max_overhead
+        
+        self.start = time.perf_counter()
+        self.last_save = self.start
+        self.last_duration = 0.0
+        
+        self.saves = 0
+        self.save_seconds = 0.0
+    
+    # True if it's time to save again
+    def due(self):
+        return time.perf_counter() - self.last_save >= max(self.interval, self.last_duration / self.max_overhead)
+    
+    # save by calling write(), and time it
+    def save(self, write):
+        start = time.perf_counter()
+        
+        write()
+        
+        self.last_save = time.perf_counter()
+        self.last_duration = self.last_save - start
+        
+        self.saves += 1
+        self.save_seconds += self.last_duration
+    
+    # fraction of the time since this checkpointer was made that went into saving
+    def overhead(self):
+        return self.save_seconds / max(1e-9, time.perf_counter() - self.start)
+
+## simulations ##
+
+# the state of a simulation of num_games games played in blocks of block_size seeds.  description is a dict of json values saying what the job is (policy, seeds, rules, ...), and a saved progress only resumes a job with the same description
+class SimulationProgress():
+    def __init__(self, description, num_games, block_size):
+        if num_games < 1 or block_size < 1:
+            raise ValueError("num_games and block_size must be at least 1")
+        
+        self.description = description
+        self.num_games = num_games
+        self.block_size = block_size
+        self.num_blocks = -(-num_games // block_size)
+        
+        self.rounds = array.array("i", bytes(4 * num_games))
+        self.sets = array.array("i", bytes(4 * num_games))
+        self.statuses = bytearray(num_games)
+        
+        self.done = bytearray(self.num_blocks)
+    
+    # the first game (counted from 0) and the number of games of block
+    def block_range(self, block):
+        start = block * self.block_size
+        
+        return start, min(self.block_size, self.num_games - start)
+    
+    def remaining_blocks(self):
+        return [block for block in range(self.num_blocks) if not self.done[block]]
+    
+    def games_done(self):
+        return sum(self.block_range(block)[1] for block in range(self.num_blocks) if self.done[block])
+    
+    # store the (rounds won, sets won, status) of every game in block
+    def record_block(self, block, results):
+        start, size = self.block_range(block)
+        
+        if len(results) != size:
+            raise ValueError("block " + str(block) + " has " + str(size) + " games, got " + str(len(results)) + " results")
+        
+        for i, (rounds, sets, status) in enumerate(results):
+            self.rounds[start + i] = rounds
+            self.sets[start + i] = sets
+            self.statuses[start + i] = _status_codes[status]
+        
+        self.done[block] = 1
+    
+    # (rounds won, sets won, status) of every game, in seed order.  only complete once every block is done
+    def results(self):
+        return [(rounds, sets, _status_names[status]) for rounds, sets, status in zip(self.rounds, self.sets, self.statuses) if status != 0]
+    
+    def save(self, path):
+        header = json.dumps({"description": self.description, "num_games": self.num_games, "block_size": self.block_size}).encode()
+        
+        temp_path = path + ".tmp"
+        
+        with open(temp_path, "wb") as f:
+            f.write(_preamble.pack(magic, progress_version, len(header)))
+            f.write(header)
+            f.write(self.done)
+            f.write(self.rounds.tobytes())
+            f.write(self.sets.tobytes())
+            f.write(self.statuses)
+            
+            f.flush()
+            os.fsync(f.fileno())
+        
+        os.replace(temp_path, path)
+    
+    # the progress saved at path, or a new one if there's nothing there.  raises ValueError if path holds the progress of a different job
+    @classmethod
+    def load_or_new(cls, path, description, num_games, block_size):
+        progress = cls(description, num_games, block_size)
+        
+        if not os.path.exists(path):
+            return progress
+        
+        with open(path, "rb") as f:
+            data = f.read()
+        
+        if len(data) < _preamble.size:
+            raise ValueError(path + " is too short to be a simulation checkpoint")
+        
+        file_magic, version, header_length = _preamble.unpack_from(data)
+        
+        if file_magic != magic or version != progress_version:
+            raise ValueError(path + " isn't a version " + str(progress_version) + " simulation checkpoint")
+        
+        header = json.loads(data[_preamble.size:_preamble.size + header_length])
+        
+        # compared through json so tuples and lists in the description match
+        if header["description"] != json.loads(json.dumps(description)) or header["num_games"] != num_games or header["block_size"] != block_size:
+            raise ValueError(path + " is the checkpoint of a different simulation: " + json.dumps(header["description"]))
+        
+        start = _preamble.size + header_length
+        sizes = [progress.num_blocks, 4 * num_games, 4 * num_games, num_games]
+        
+        if len(data) != start + sum(sizes):
+            raise ValueError(path + " is truncated")
+        
+        progress.done = bytearray(data[start:start + sizes[0]])
+        start += sizes[0]
+        
+        progress.rounds = array.array("i")
+        progress.rounds.frombytes(data[start:start + sizes[1]])
+        start += sizes[1]
+        
+        progress.sets = array.array("i")
+        progress.sets.frombytes(data[start:start + sizes[2]])
+        start += sizes[2]
+        
+        progress.statuses = bytearray(data[start:])
+        
+        return progress
+
+## training ##
+
+# train predictor with optimizer for num_steps steps, saving to path as it goes, and resume from path if a run was already under way there.
+# step(iteration, state) does one step of training and returns a dict of json values for the learning curve.  state is a dict for anything else the training needs to carry between steps (tensors are fine), and is saved with everything else.  torch modules in state (like a value head trained alongside the predictor) are saved by their state_dict and loaded back into the same module objects, so an optimizer over their parameters keeps working.  the step must only use the python, torch and predictor rngs for its randomness, since those are the ones that are saved.
+# on_step(iteration, metrics) is called after every step if given.  checkpointer is the Checkpointer to save with, a new one with interval and max_overhead if None.
+# returns (learning curve, state)
+def run_training(path, predictor, optimizer, step, num_steps, state=None, interval=60.0, max_overhead=0.02, on_step=None, checkpointer=None):
+    from checkpoint import save_predictor, restore_predictor
+    
+    import torch
+    
+    state = dict() if state is None else state
+    extra = {"iteration": 0, "curve": [], "state": state}
+    
+    if os.path.exists(path):
+        extra = restore_predictor(path, predictor, optimizer, restore_rng=True)
+        
+        for key, value in extra["state"].items():
+            if isinstance(state.get(key), torch.nn.Module):
+                state[key].load_state_dict(value["__module__"])
+            else:
+                state[key] = value
+        
+        extra["state"] = state
+    
+    if checkpointer is None:
+        checkpointer = Checkpointer(interval, max_overhead)
+    
+    def write():
+        saved_state = {key: {"__module__": value.state_dict()} if isinstance(value, torch.nn.Module) else value for key, value in state.items()}
+        
+        save_predictor(path, predictor, optimizer, dict(extra, state=saved_state))
+    
+    for iteration in range(extra["iteration"], num_steps):
+        metrics = step(iteration, extra["state"])
+        
+        extra["curve"].append(metrics)
+        extra["iteration"] = iteration + 1
+        
+        if not on_step is None:
+            on_step(iteration, metrics)
+        
+        if checkpointer.due():
+            checkpointer.save(write)
+    
+    checkpointer.save(write)
+    
+    return extra["curve"], extra["state"]
+
+# a stand-in training step for the test below: plays a few games with the predictor (python and predictor rngs), then fits the use item and shoot dealer confidences of the states it saw to random targets (torch rng)
+def _demo_training_step(predictor, optimizer):
+    import torch
+    import policies
+    
+    policy = policies.PredictorPolicy(predictor)
+    
+    def step(iteration, state):
+        inputs = []
+        
+        def record_and_decide(runs):
+            inputs.extend(predictor.get_input_list(run) for run in runs)
+            
+            return policy.decide_batch(runs)
+        
+        results = policies.play_many(record_and_decide, 8, rules=predictor.rules)
+        
+        confidences = predictor.who_to_shoot_or_use_item(predictor.core_model(torch.tensor(inputs, dtype=torch.float32, device=predictor.device)))
+        loss = torch.nn.functional.binary_cross_entropy(confidences, torch.rand(confidences.shape).to(predictor.device))
+        
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        
+        state["games"] = state.get("games", 0) + len(results)
+        
+        return {"loss": loss.item(), "rounds_won": sum(rounds for rounds, sets in results) / len(results)}
+    
+    return step
+
+def _train_demo(path, num_steps, interval):
+    import torch
+    import random
+    from cross_entropy import BuckshotPredictor_CrossEntropy
+    
+    torch.set_num_threads(1)
+    
+    random.seed(0)
+    torch.manual_seed(0)
+    
+    predictor = BuckshotPredictor_CrossEntropy()
+    predictor.seed(0)
+    
+    optimizer = torch.optim.Adam([parameter for module in (predictor.core_model, predictor.who_to_shoot_or_use_item) for parameter in module.parameters()], lr=0.01)
+    
+    checkpointer = Checkpointer(interval, max_overhead=0.05)
+    
+    run_training(path, predictor, optimizer, _demo_training_step(predictor, optimizer), num_steps, checkpointer=checkpointer)
+    
+    print("{:.6f}".format(checkpointer.overhead()))
+    
+    return 0
+
+# run command until path exists and has been replaced at least once more, then kill it without warning.  returns False if the command finished first
+def _kill_after_checkpoint(command, path):
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    
+    first = None
+    
+    while process.poll() is None:
+        if os.path.exists(path):
+            modified = os.stat(path).st_mtime_ns
+            
+            if first is None:
+                first = modified
+            elif modified != first:
+                process.send_signal(signal.SIGKILL)
+                process.wait()
+                
+                return True
+        
+        time.sleep(0.02)
+    
+    return False
+
+# run command and return what it printed
+def _run(command):
+    return subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+
+# python jobs.py [directory]
+# kills a simulation and a training run partway through, resumes them, and checks that they end up with exactly the same results as runs that were never interrupted
+def main(argc, argv):
+    if argc > 1 and argv[1] == "train":
+        return _train_demo(argv[2], int(argv[3]), float(argv[4]))
+    
+    directory = argv[1] if argc > 1 else "jobs_test"
+    
+    os.makedirs(directory, exist_ok=True)
+    
+    here = os.path.dirname(os.path.abspath(__file__))
+    python = sys.executable
+    
+    all_match = True
+    
+    # simulation
+    simulation_checkpoint = os.path.join(directory, "simulation.job")
+    interrupted_output = os.path.join(directory, "interrupted.json")
+    uninterrupted_output = os.path.join(directory, "uninterrupted.json")
+    
+    for path in (simulation_checkpoint, interrupted_output):
+        if os.path.exists(path):
+            os.remove(path)
+    
+    arguments = ["--policy", "random", "--games", "20000", "--seed", "5", "--max-rounds", "20"]
+    
+    _run([python, os.path.join(here, "simulate.py")] + arguments + ["--output", uninterrupted_output])
+    
+    command = [python, os.path.join(here, "simulate.py")] + arguments + ["--output", interrupted_output, "--checkpoint", simulation_checkpoint, "--checkpoint-interval", "0.1"]
+    
+    killed = _kill_after_checkpoint(command, simulation_checkpoint)
+    
+    _run(command)
+    
+    with open(uninterrupted_output) as f:
+        expected = json.load(f)
+    
+    with open(interrupted_output) as f:
+        got = json.load(f)
+    
+    match = expected["results"] == got["results"] and expected["rounds_won"] == got["rounds_won"] and expected["sets_won"] == got["sets_won"]
+    all_match = all_match and match
+    
+    print("simulation: killed partway {}, resumed with {} of 20000 games done, results match: {}, {:.2%} of the resumed run spent saving".format(killed, got["resumed_games"], match, got["checkpoint_overhead"]))
+    
+    # training
+    import torch
+    from checkpoint import load_checkpoint
+    
+    training_checkpoint = os.path.join(directory, "training.ckpt")
+    uninterrupted_checkpoint = os.path.join(directory, "training_uninterrupted.ckpt")
+    
+    for path in (training_checkpoint, uninterrupted_checkpoint):
+        if os.path.exists(path):
+            os.remove(path)
+    
+    start = time.perf_counter()
+    
+    _run([python, os.path.abspath(__file__), "train", uninterrupted_checkpoint, "150", "1000"])
+    
+    uninterrupted_seconds = time.perf_counter() - start
+    
+    command = [python, os.path.abspath(__file__), "train", training_checkpoint, "150", "0.2"]
+    
+    killed = _kill_after_checkpoint(command, training_checkpoint)
+    iteration = load_checkpoint(training_checkpoint)["extra"]["iteration"]
+    
+    overhead = float(_run(command))
+    
+    expected = load_checkpoint(uninterrupted_checkpoint)
+    got = load_checkpoint(training_checkpoint)
+    
+    weights_match = all(torch.equal(expected["weights"][module][name], got["weights"][module][name]) for module in expected["weights"] for name in expected["weights"][module])
+    match = weights_match and expected["extra"]["curve"] == got["extra"]["curve"] and expected["extra"]["state"] == got["extra"]["state"]
+    all_match = all_match and match
+    
+    print("training: killed partway {} at step {} of 150, weights and learning curve match: {}, {:.2%} of the resumed run spent saving ({:.1f}s uninterrupted)".format(killed, iteration, match, overhead, uninterrupted_seconds))
+    
+    return 0 if all_match else 1
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))
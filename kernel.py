@@ -0,0 +1,1020 @@
+### fast game kernel ###
+# the whole game (shooting, items, set/round transitions and the dealer's ai) reimplemented over a flat array of ints, so that it can be compiled with numba for fast rollouts in search and monte carlo code.
+# without numba (or with the BUCKSHOT_DISABLE_NUMBA environment variable set) the exact same functions run as plain python on lists, so nothing here needs numba to work, it's just much slower.
+# the kernel only supports the standard items (all_item_behaviors, in their usual order), but every number in the RuleSet is respected.  see rules_to_params.
+# the kernel plays the same game as BuckshotRun, but not with the same random numbers, so the same seed gives a different game.  main() checks that the distributions of outcomes match instead.
+# one difference: actions that BuckshotRun would reject with an exception (like using an item you don't have) return ILLEGAL here without changing anything, even in the few cases where BuckshotRun changes some state before raising.
+
+import os
+import sys
+import time
+import random
+
+import buckshot
+
+try:
+    if os.environ.get("BUCKSHOT_DISABLE_NUMBA"):
+        raise ImportError("numba disabled by BUCKSHOT_DISABLE_NUMBA")
+    
+    import numba
+    import numpy
+    
+    have_numba = True
+except ImportError:
+    have_numba = False
+
+def _jit(function):
+    if have_numba:
+        return numba.njit(cache=True)(function)
+    else:
+        return function
+
+## layout ##
+
+# capacities of the variable length parts of the state.  rules with more shells or items than this can't be used with the kernel
+shell_capacity = 16
+inventory_capacity = 24
+
+player_seat = 0
+dealer_seat = 1
+nobody = -1
+
+# shells and known shells
+LIVE = 1
+BLANK = 0
+UNKNOWN = -1
+
+# dealer targets
+TARGET_NONE = 0
+TARGET_SELF = 1
+TARGET_OPPONENT = 2
+
+# item ids, in the order of all_item_behaviors
+HANDSAW = 0
+CIGS = 1
+MEDICINE = 2
+MAGNIFIER = 3
+INVERTER = 4
+PHONE = 5
+BEER = 6
+ADRENALINE = 7
+HANDCUFFS = 8
+
+NUM_ITEMS = 9
+
+# return values of the actions
+OK = 0 # the same participant keeps deciding
+TURN_OVER = 1 # a shot was fired or the round reset (RoundResetException in BuckshotRun)
+ILLEGAL = -1 # nothing happened
+
+# decisions, see apply_decision
+SHOOT_OPPONENT = 0
+SHOOT_SELF = 1
+USE_ITEM = 2 # + item id
+STEAL_ITEM = USE_ITEM + NUM_ITEMS # + id of the item to steal with adrenaline
+NUM_DECISIONS = STEAL_ITEM + NUM_ITEMS
+
+# state offsets.  everything indexed by seat has the player's value first and the dealer's second
+GAME_OVER = 0
+TURN = 1
+CUFFED = 2
+SAWED_OFF = 3
+CURRENT_ROUND = 4
+CURRENT_SET = 5
+SETS_WON = 6
+MATCHES_WON = 7
+NUM_SHELLS = 8
+HEALTH = 9
+MAX_HEALTH = 11
+
+# the dealer's decision state, see Dealer.take_turn
+DEALER_TARGET = 13
+DEALER_KNOWN_SHELL = 14
+DEALER_KNOWS_SHELL = 15
+DEALER_USING_MEDICINE = 16
+DEALER_USING_HANDSAW = 17
+# the dealer only ever checks his item_array_dealer for cigarettes before rebuilding it, so the number of cigs in it is all that needs to be kept
+DEALER_ARRAY_CIGS = 18
+
+INVENTORY_SIZE = 19
+CHAMBER = 21
+KNOWN = CHAMBER + shell_capacity
+INVENTORY = KNOWN + 2 * shell_capacity
+BUGGED_COUNTS = INVENTORY + 2 * inventory_capacity
+# how many of each item is in each inventory, kept alongside the ordered inventory so counting is O(1)
+ITEM_COUNTS = BUGGED_COUNTS + 2 * NUM_ITEMS
+
+STATE_SIZE = ITEM_COUNTS + 2 * NUM_ITEMS
+
+# param offsets, see rules_to_params
+ROUNDS_PER_MATCH = 0
+MIN_SHELLS = 1
+MAX_SHELLS = 2
+MIN_HEALTH = 3
+MAX_HEALTH_PARAM = 4
+MAX_ITEMS_TOTAL = 5
+MIN_ITEMS = 6
+MAX_ITEMS = 7
+BASE_DAMAGE = 8
+SAWED_OFF_DAMAGE = 9
+ITEM_LIMITS = 10
+
+PARAMS_SIZE = ITEM_LIMITS + NUM_ITEMS
+
+## random numbers and arrays ##
+
+if have_numba:
+    @numba.njit(cache=True)
+    def _rand_int(low, high):
+        return numpy.random.randint(low, high + 1)
+    
+    @numba.njit(cache=True)
+    def _seed(seed):
+        numpy.random.seed(seed)
+    
+    @numba.njit(cache=True)
+    def _zeros(size):
+        return numpy.zeros(size, numpy.int64)
+    
+    def new_array(size):
+        return numpy.zeros(size, numpy.int64)
+else:
+    _random = random.Random()
+    
+    def _rand_int(low, high):
+        return _random.randint(low, high)
+    
+    def _seed(seed):
+        _random.seed(seed)
+    
+    def _zeros(size):
+        return [0] * size
+    
+    def new_array(size):
+        return [0] * size
+
+def seed(seed):
+    _seed(seed)
+
+## rules ##
+
+# the rules as an array of ints for the kernel.  raises ValueError if the rules can't be played by the kernel.
+def rules_to_params(rules=None):
+    if rules is None:
+        rules = buckshot.default_rules
+    
+    if tuple(rules.item_behaviors.items()) != tuple(buckshot.all_item_behaviors.items()):
+        raise ValueError("the kernel only supports the standard items")
+    
+    if rules.max_shells_per_set > shell_capacity or rules.max_items_total + 1 > inventory_capacity:
+        raise ValueError("too many shells or items for the kernel")
+    
+    params = new_array(PARAMS_SIZE)
+    
+    params[ROUNDS_PER_MATCH] = rules.rounds_per_match
+    params[MIN_SHELLS] = rules.min_shells_per_set
+    params[MAX_SHELLS] = rules.max_shells_per_set
+    params[MIN_HEALTH] = rules.min_health
+    params[MAX_HEALTH_PARAM] = rules.max_health
+    params[MAX_ITEMS_TOTAL] = rules.max_items_total
+    params[MIN_ITEMS] = rules.min_items_per_set
+    params[MAX_ITEMS] = rules.max_items_per_set
+    params[BASE_DAMAGE] = rules.base_live_damage
+    params[SAWED_OFF_DAMAGE] = rules.sawedoff_live_damage
+    
+    for item_id, limit in enumerate(rules.item_limit_array):
+        params[ITEM_LIMITS + item_id] = limit
+    
+    return params
+
+## inventories ##
+
+@_jit
+def inventory_count(s, seat, item):
+    return s[ITEM_COUNTS + seat * NUM_ITEMS + item]
+
+@_jit
+def _inventory_remove(s, seat, item):
+    start = INVENTORY + seat * inventory_capacity
+    size = s[INVENTORY_SIZE + seat]
+    
+    for i in range(size):
+        if s[start + i] == item:
+            for j in range(i, size - 1):
+                s[start + j] = s[start + j + 1]
+            
+            # unused slots are always zero, so equal states are equal arrays
+            s[start + size - 1] = 0
+            s[INVENTORY_SIZE + seat] = size - 1
+            s[ITEM_COUNTS + seat * NUM_ITEMS + item] -= 1
+            
+            return
+
+# adrenaline puts the stolen item at the front of the inventory, same as Inventory.add_item with ignore_limits
+@_jit
+def _inventory_prepend(s, seat, item):
+    start = INVENTORY + seat * inventory_capacity
+    size = s[INVENTORY_SIZE + seat]
+    
+    for i in range(size, 0, -1):
+        s[start + i] = s[start + i - 1]
+    
+    s[start] = item
+    s[INVENTORY_SIZE + seat] = size + 1
+    s[ITEM_COUNTS + seat * NUM_ITEMS + item] += 1
+
+@_jit
+def _consume_item(s, seat, item):
+    _inventory_remove(s, seat, item)
+    
+    s[BUGGED_COUNTS + seat * NUM_ITEMS + item] -= 1
+
+@_jit
+def _reset_items(s, seat):
+    for i in range(s[INVENTORY_SIZE + seat]):
+        s[INVENTORY + seat * inventory_capacity + i] = 0
+    
+    s[INVENTORY_SIZE + seat] = 0
+    
+    for item in range(NUM_ITEMS):
+        s[BUGGED_COUNTS + seat * NUM_ITEMS + item] = 0
+        s[ITEM_COUNTS + seat * NUM_ITEMS + item] = 0
+    
+    if seat == dealer_seat:
+        s[DEALER_ARRAY_CIGS] = 0
+
+# draw num items for both seats the same way as draw_set_items and give them out like Participant.give_item_list
+@_jit
+def _draw_items(s, p, num, handsaw_blocked):
+    limits = _zeros(NUM_ITEMS)
+    counts = _zeros(NUM_ITEMS)
+    
+    for seat in range(2):
+        for item in range(NUM_ITEMS):
+            limits[item] = p[ITEM_LIMITS + item] - s[BUGGED_COUNTS + seat * NUM_ITEMS + item]
+            counts[item] = 0
+        
+        if handsaw_blocked:
+            limits[HANDSAW] = 0
+        
+        for i in range(num):
+            # items that can still be drawn, picked uniformly like random.choice over pickable_ids
+            num_pickable = 0
+            
+            for item in range(NUM_ITEMS):
+                if counts[item] < limits[item]:
+                    num_pickable += 1
+            
+            if num_pickable < 1:
+                break
+            
+            pick = _rand_int(0, num_pickable - 1)
+            item = 0
+            
+            for candidate in range(NUM_ITEMS):
+                if counts[candidate] < limits[candidate]:
+                    if pick == 0:
+                        item = candidate
+                        break
+                    
+                    pick -= 1
+            
+            counts[item] += 1
+            
+            # only items that fit count towards the limits
+            size = s[INVENTORY_SIZE + seat]
+            
+            if size < p[MAX_ITEMS_TOTAL]:
+                s[INVENTORY + seat * inventory_capacity + size] = item
+                s[INVENTORY_SIZE + seat] = size + 1
+                s[ITEM_COUNTS + seat * NUM_ITEMS + item] += 1
+                
+                s[BUGGED_COUNTS + seat * NUM_ITEMS + item] += 1
+            
+            # but every drawn item goes in the dealer's item array
+            if seat == dealer_seat and item == CIGS:
+                s[DEALER_ARRAY_CIGS] += 1
+
+## chamber ##
+
+@_jit
+def num_live(s):
+    count = 0
+    
+    for i in range(s[NUM_SHELLS]):
+        count += s[CHAMBER + i]
+    
+    return count
+
+@_jit
+def _pop_shell(s):
+    shell = s[CHAMBER]
+    size = s[NUM_SHELLS]
+    
+    for i in range(size - 1):
+        s[CHAMBER + i] = s[CHAMBER + i + 1]
+        s[KNOWN + i] = s[KNOWN + i + 1]
+        s[KNOWN + shell_capacity + i] = s[KNOWN + shell_capacity + i + 1]
+    
+    s[CHAMBER + size - 1] = 0
+    s[KNOWN + size - 1] = UNKNOWN
+    s[KNOWN + shell_capacity + size - 1] = UNKNOWN
+    s[NUM_SHELLS] = size - 1
+    
+    return shell
+
+@_jit
+def _load_chamber(s, p):
+    total = _rand_int(p[MIN_SHELLS], p[MAX_SHELLS])
+    lives = total // 2
+    
+    # slots past the end are zeroed too, since the old chamber may not have been empty
+    for i in range(shell_capacity):
+        s[CHAMBER + i] = LIVE if i < lives else BLANK
+    
+    # same shuffle as random.shuffle
+    for i in range(total - 1, 0, -1):
+        j = _rand_int(0, i)
+        
+        shell = s[CHAMBER + i]
+        s[CHAMBER + i] = s[CHAMBER + j]
+        s[CHAMBER + j] = shell
+    
+    s[NUM_SHELLS] = total
+    
+    for i in range(2 * shell_capacity):
+        s[KNOWN + i] = UNKNOWN
+
+## set and round transitions ##
+
+@_jit
+def _on_set_end(s, p):
+    s[SETS_WON] += 1
+    s[SAWED_OFF] = 0
+    
+    _load_chamber(s, p)
+    
+    s[TURN] = player_seat
+    
+    num = _rand_int(p[MIN_ITEMS], p[MAX_ITEMS])
+    
+    # no handsaw on the very first set if health is 2
+    _draw_items(s, p, num, s[CURRENT_SET] == 0 and s[MAX_HEALTH + player_seat] == 2)
+    
+    s[CURRENT_SET] += 1
+
+@_jit
+def _give_random_health(s, p):
+    health = _rand_int(p[MIN_HEALTH], p[MAX_HEALTH_PARAM])
+    
+    for seat in range(2):
+        s[HEALTH + seat] = health
+        s[MAX_HEALTH + seat] = health
+
+@_jit
+def _on_round_end(s, p):
+    s[CURRENT_ROUND] += 1
+    
+    if s[CURRENT_ROUND] > p[ROUNDS_PER_MATCH]:
+        s[MATCHES_WON] += 1
+        s[CURRENT_ROUND] = 1
+    else:
+        # items don't reset between matches, see BuckshotRun.on_round_end
+        _reset_items(s, player_seat)
+        _reset_items(s, dealer_seat)
+    
+    _give_random_health(s, p)
+    
+    s[CURRENT_SET] = 0
+    
+    _on_set_end(s, p)
+
+# fill s with a brand new game, same as BuckshotRun()
+@_jit
+def new_game(s, p):
+    for i in range(STATE_SIZE):
+        s[i] = 0
+    
+    s[CUFFED] = nobody
+    s[CURRENT_ROUND] = 1
+    s[SETS_WON] = -1
+    s[DEALER_KNOWN_SHELL] = UNKNOWN
+    
+    _give_random_health(s, p)
+    _on_set_end(s, p)
+
+@_jit
+def rounds_won(s, p):
+    return s[MATCHES_WON] * p[ROUNDS_PER_MATCH] + s[CURRENT_ROUND] - 1
+
+## actions ##
+
+@_jit
+def shoot(s, p, shooting_self):
+    shooter = s[TURN]
+    opponent = 1 - shooter
+    
+    shell = _pop_shell(s)
+    
+    damage = 0
+    
+    if shell == LIVE:
+        damage = p[SAWED_OFF_DAMAGE] if s[SAWED_OFF] else p[BASE_DAMAGE]
+    
+    if not shooting_self:
+        s[HEALTH + opponent] -= damage
+        
+        if s[CUFFED] == opponent:
+            s[CUFFED] = nobody
+        else:
+            s[TURN] = opponent
+    else:
+        s[HEALTH + shooter] -= damage
+        
+        if shell == LIVE:
+            if s[CUFFED] == opponent:
+                s[CUFFED] = nobody
+            else:
+                s[TURN] = opponent
+    
+    s[SAWED_OFF] = 0
+    
+    if s[HEALTH + player_seat] < 1:
+        s[GAME_OVER] = 1
+    elif s[HEALTH + dealer_seat] < 1:
+        _on_round_end(s, p)
+    elif s[NUM_SHELLS] == 0:
+        _on_set_end(s, p)
+    
+    return TURN_OVER
+
+# the effect of an item, see the item behaviors in buckshot.py.  returns TURN_OVER if the round reset (which also means the item isn't consumed)
+@_jit
+def _item_behavior(s, p, user, item):
+    opponent = 1 - user
+    
+    if item == HANDSAW:
+        s[SAWED_OFF] = 1
+    elif item == CIGS:
+        s[HEALTH + user] = min(s[HEALTH + user] + 1, s[MAX_HEALTH + user])
+    elif item == MEDICINE:
+        if _rand_int(0, 1) == 0:
+            s[HEALTH + user] = min(s[HEALTH + user] + 2, s[MAX_HEALTH + user])
+        else:
+            s[HEALTH + user] -= 1
+            
+            if s[HEALTH + player_seat] < 1:
+                s[GAME_OVER] = 1
+                
+                return TURN_OVER
+            elif s[HEALTH + dealer_seat] < 1:
+                _on_round_end(s, p)
+                
+                return TURN_OVER
+    elif item == MAGNIFIER:
+        s[KNOWN + user * shell_capacity] = s[CHAMBER]
+    elif item == INVERTER:
+        s[CHAMBER] = 1 - s[CHAMBER]
+    elif item == PHONE:
+        if s[NUM_SHELLS] >= 2:
+            position = _rand_int(1, s[NUM_SHELLS] - 1)
+            
+            # the phone never tells the player about the 8th shell
+            if user == player_seat and position == 7:
+                position -= 1
+            
+            s[KNOWN + user * shell_capacity + position] = s[CHAMBER + position]
+    elif item == BEER:
+        _pop_shell(s)
+        
+        if s[NUM_SHELLS] == 0:
+            _on_set_end(s, p)
+            
+            return TURN_OVER
+    elif item == HANDCUFFS:
+        s[CUFFED] = opponent
+    
+    return OK
+
+# whoever has the turn uses item.  returns OK, TURN_OVER or ILLEGAL
+@_jit
+def use_item(s, p, item):
+    user = s[TURN]
+    
+    if item == ADRENALINE or inventory_count(s, user, item) == 0:
+        return ILLEGAL
+    
+    if item == HANDCUFFS and s[CUFFED] == 1 - user:
+        return ILLEGAL
+    
+    if _item_behavior(s, p, user, item) == TURN_OVER:
+        return TURN_OVER
+    
+    _consume_item(s, user, item)
+    
+    return OK
+
+# whoever has the turn uses adrenaline to steal steal_item and use it immediately.  returns OK, TURN_OVER or ILLEGAL
+@_jit
+def use_adrenaline(s, p, steal_item):
+    user = s[TURN]
+    opponent = 1 - user
+    
+    if inventory_count(s, user, ADRENALINE) == 0 or steal_item == ADRENALINE or inventory_count(s, opponent, steal_item) == 0:
+        return ILLEGAL
+    
+    if steal_item == HANDCUFFS and s[CUFFED] == opponent:
+        return ILLEGAL
+    
+    # the opponent's bugged count goes down, the user's goes down once the stolen item is used, see adrenaline_behavior
+    _consume_item(s, opponent, steal_item)
+    _inventory_prepend(s, user, steal_item)
+    
+    # if the round resets, neither the stolen item nor the adrenaline are consumed
+    if _item_behavior(s, p, user, steal_item) == TURN_OVER:
+        return TURN_OVER
+    
+    _consume_item(s, user, steal_item)
+    _consume_item(s, user, ADRENALINE)
+    
+    return OK
+
+# apply a decision (SHOOT_OPPONENT, SHOOT_SELF, USE_ITEM + item id or STEAL_ITEM + item id) for whoever has the turn, like BuckshotRun.apply_decision.
+# returns OK if the same participant decides again, TURN_OVER or ILLEGAL
+@_jit
+def apply_decision(s, p, decision):
+    if decision == SHOOT_OPPONENT:
+        return shoot(s, p, False)
+    elif decision == SHOOT_SELF:
+        return shoot(s, p, True)
+    elif decision < STEAL_ITEM:
+        return use_item(s, p, decision - USE_ITEM)
+    else:
+        return use_adrenaline(s, p, decision - STEAL_ITEM)
+
+# fill decisions with every legal decision for whoever has the turn, in the same order as policies.legal_decisions.  returns how many there are
+@_jit
+def legal_decisions(s, decisions):
+    user = s[TURN]
+    opponent = 1 - user
+    
+    decisions[0] = SHOOT_OPPONENT
+    decisions[1] = SHOOT_SELF
+    
+    count = 2
+    
+    for item in range(NUM_ITEMS):
+        if inventory_count(s, user, item) == 0 or (item == HANDCUFFS and s[CUFFED] == opponent) or (item == HANDSAW and s[SAWED_OFF]):
+            continue
+        
+        if item == ADRENALINE:
+            for steal_item in range(NUM_ITEMS):
+                if steal_item == ADRENALINE or inventory_count(s, opponent, steal_item) == 0 or (steal_item == HANDCUFFS and s[CUFFED] == opponent) or (steal_item == HANDSAW and s[SAWED_OFF]):
+                    continue
+                
+                decisions[count] = STEAL_ITEM + steal_item
+                count += 1
+        else:
+            decisions[count] = USE_ITEM + item
+            count += 1
+    
+    return count
+
+## dealer ai ##
+
+# see Dealer.coin_flip
+@_jit
+def _dealer_coin_flip(s):
+    lives = num_live(s)
+    blanks = s[NUM_SHELLS] - lives
+    
+    if lives == blanks:
+        return _rand_int(0, 1)
+    elif lives > blanks:
+        return 1
+    else:
+        return 0
+
+# see Dealer.can_peek_next_shell
+@_jit
+def _dealer_can_peek_next_shell(s):
+    known = KNOWN + dealer_seat * shell_capacity
+    
+    if s[known] != UNKNOWN:
+        return True
+    
+    lives = num_live(s)
+    blanks = s[NUM_SHELLS] - lives
+    
+    if lives == 0 or blanks == 0:
+        return True
+    
+    for i in range(s[NUM_SHELLS]):
+        if s[known + i] == LIVE:
+            lives -= 1
+        elif s[known + i] == BLANK:
+            blanks -= 1
+    
+    return lives == 0 or blanks == 0
+
+@_jit
+def _dealer_set_target(s, shell):
+    s[DEALER_KNOWN_SHELL] = shell
+    s[DEALER_TARGET] = TARGET_SELF if shell == BLANK else TARGET_OPPONENT
+
+# the dealer takes his turn until he shoots or the round resets, following Dealer.take_turn step by step.  returns TURN_OVER, or ILLEGAL if it isn't the dealer's turn
+@_jit
+def dealer_take_turn(s, p):
+    if s[TURN] != dealer_seat:
+        return ILLEGAL
+    
+    dealer = dealer_seat
+    opponent = player_seat
+    
+    main_loop_finished = False
+    s[DEALER_USING_HANDSAW] = 0
+    s[DEALER_USING_MEDICINE] = 0
+    
+    # his inventory followed by the opponent's if he has adrenaline, like item_array_dealer
+    item_array = _zeros(2 * inventory_capacity)
+    
+    while True:
+        wants = -1
+        
+        if not s[DEALER_KNOWS_SHELL]:
+            if _dealer_can_peek_next_shell(s):
+                s[DEALER_KNOWS_SHELL] = 1
+                
+                _dealer_set_target(s, s[CHAMBER])
+        
+        if s[NUM_SHELLS] == 1:
+            _dealer_set_target(s, s[CHAMBER])
+            
+            s[DEALER_KNOWS_SHELL] = 1
+        
+        has_cigs = s[DEALER_ARRAY_CIGS] > 0
+        
+        using_adrenaline = inventory_count(s, dealer, ADRENALINE) > 0
+        
+        array_size = 0
+        
+        for k in range(2):
+            seat = dealer if k == 0 else opponent
+            
+            if seat == opponent and not using_adrenaline:
+                break
+            
+            for i in range(s[INVENTORY_SIZE + seat]):
+                item_array[array_size] = s[INVENTORY + seat * inventory_capacity + i]
+                array_size += 1
+        
+        s[DEALER_ARRAY_CIGS] = 0
+        
+        for i in range(array_size):
+            if item_array[i] == CIGS:
+                s[DEALER_ARRAY_CIGS] += 1
+        
+        num_shells = s[NUM_SHELLS]
+        known_shell = s[DEALER_KNOWN_SHELL]
+        health = s[HEALTH + dealer]
+        max_health = s[MAX_HEALTH + dealer]
+        
+        for i in range(array_size):
+            item = item_array[i]
+            
+            if item == MAGNIFIER and not s[DEALER_KNOWS_SHELL] and num_shells != 1:
+                wants = item
+                s[DEALER_KNOWS_SHELL] = 1
+                
+                _dealer_set_target(s, s[CHAMBER])
+                
+                break
+            
+            if item == CIGS and health < max_health:
+                wants = item
+                
+                break
+            
+            if item == MEDICINE and health < max_health and not has_cigs and not s[DEALER_USING_MEDICINE] and health != 1:
+                wants = item
+                s[DEALER_USING_MEDICINE] = 1
+                
+                break
+            
+            if item == BEER and known_shell != LIVE and num_shells != 1:
+                wants = item
+                s[DEALER_KNOWS_SHELL] = 0
+                s[DEALER_KNOWN_SHELL] = UNKNOWN
+                
+                break
+            
+            if item == HANDCUFFS and s[CUFFED] != opponent and num_shells != 1:
+                wants = item
+                
+                break
+            
+            if item == HANDSAW and not s[SAWED_OFF] and known_shell == LIVE:
+                wants = item
+                s[DEALER_USING_HANDSAW] = 1
+                
+                break
+            
+            if item == PHONE and num_shells > 2:
+                wants = item
+                
+                break
+            
+            if item == INVERTER and s[DEALER_KNOWS_SHELL] and known_shell == BLANK:
+                wants = item
+                s[DEALER_KNOWN_SHELL] = LIVE
+                s[DEALER_KNOWS_SHELL] = 1
+                s[DEALER_TARGET] = TARGET_OPPONENT
+                
+                break
+        
+        if wants == -1:
+            main_loop_finished = True
+        
+        has_handsaw = False
+        
+        for i in range(array_size):
+            if item_array[i] == HANDSAW:
+                has_handsaw = True
+        
+        # the dealer sometimes saws on a hunch, see Dealer.take_turn
+        if main_loop_finished and not s[DEALER_USING_HANDSAW] and has_handsaw and not s[SAWED_OFF] and s[DEALER_KNOWN_SHELL] != BLANK:
+            if _dealer_coin_flip(s) == 0:
+                s[DEALER_TARGET] = TARGET_SELF
+            else:
+                s[DEALER_TARGET] = TARGET_OPPONENT
+                wants = HANDSAW
+                s[DEALER_USING_HANDSAW] = 1
+        
+        if wants != -1:
+            if inventory_count(s, dealer, wants) == 0:
+                status = use_adrenaline(s, p, wants)
+            else:
+                status = use_item(s, p, wants)
+            
+            if status == TURN_OVER:
+                return TURN_OVER
+            
+            # take the used item out of the item array
+            for i in range(array_size):
+                if item_array[i] == wants:
+                    for j in range(i, array_size - 1):
+                        item_array[j] = item_array[j + 1]
+                    
+                    array_size -= 1
+                    
+                    break
+            
+            if wants == CIGS:
+                s[DEALER_ARRAY_CIGS] -= 1
+        else:
+            if s[DEALER_TARGET] == TARGET_NONE:
+                if _dealer_coin_flip(s) == 0:
+                    s[DEALER_TARGET] = TARGET_SELF
+                else:
+                    s[DEALER_TARGET] = TARGET_OPPONENT
+            
+            shoot(s, p, s[DEALER_TARGET] == TARGET_SELF)
+            
+            s[DEALER_TARGET] = TARGET_NONE
+            s[DEALER_KNOWN_SHELL] = UNKNOWN
+            s[DEALER_KNOWS_SHELL] = 0
+            
+            return TURN_OVER
+
+## rollouts ##
+
+# play s until the game is over, with uniformly random legal decisions for the player (like policies.RandomPolicy) and the dealer's ai for the dealer
+@_jit
+def play_random(s, p):
+    decisions = _zeros(NUM_DECISIONS)
+    
+    while not s[GAME_OVER]:
+        if s[TURN] == player_seat:
+            count = legal_decisions(s, decisions)
+            
+            apply_decision(s, p, decisions[_rand_int(0, count - 1)])
+        else:
+            dealer_take_turn(s, p)
+
+@_jit
+def _play_random_games(p, results):
+    s = _zeros(STATE_SIZE)
+    
+    for game in range(len(results)):
+        new_game(s, p)
+        play_random(s, p)
+        
+        results[game][0] = rounds_won(s, p)
+        results[game][1] = s[SETS_WON]
+
+# play num_games whole games with random player decisions.  returns a list of (rounds won, sets won), same as policies.play_game
+def play_random_games(num_games, rules=None, seed=None):
+    params = rules_to_params(rules)
+    
+    if not seed is None:
+        _seed(seed)
+    
+    if have_numba:
+        results = numpy.zeros((num_games, 2), numpy.int64)
+    else:
+        results = [[0, 0] for game in range(num_games)]
+    
+    _play_random_games(params, results)
+    
+    return [(int(rounds), int(sets)) for rounds, sets in results]
+
+# what a rollout player does: shoot the dealer if the next shell is known to be live, shoot themselves if it's known to be blank, otherwise a uniformly random legal decision
+@_jit
+def rollout_decision(s, decisions):
+    count = legal_decisions(s, decisions)
+    
+    lives = num_live(s)
+    next_shell = s[KNOWN + s[TURN] * shell_capacity]
+    
+    if next_shell == UNKNOWN:
+        if lives == s[NUM_SHELLS]:
+            next_shell = LIVE
+        elif lives == 0:
+            next_shell = BLANK
+    
+    if next_shell == LIVE:
+        return SHOOT_OPPONENT
+    elif next_shell == BLANK:
+        return SHOOT_SELF
+    
+    return decisions[_rand_int(0, count - 1)]
+
+# play s with rollout_decision for the player until the current round is over.  returns 1 if the player won the round, 0 if they died
+@_jit
+def rollout_round(s, p):
+    start = rounds_won(s, p)
+    decisions = _zeros(NUM_DECISIONS)
+    
+    while not s[GAME_OVER] and rounds_won(s, p) == start:
+        if s[TURN] == player_seat:
+            apply_decision(s, p, rollout_decision(s, decisions))
+        else:
+            dealer_take_turn(s, p)
+    
+    return 0 if s[GAME_OVER] else 1
+
+# number of rounds won out of count rollouts from copies of s, s itself is left alone
+@_jit
+def rollout_many(s, p, count):
+    wins = 0
+    copy = _zeros(STATE_SIZE)
+    
+    for rollout in range(count):
+        for i in range(STATE_SIZE):
+            copy[i] = s[i]
+        
+        wins += rollout_round(copy, p)
+    
+    return wins
+
+# rollout_many with the rollouts spread over numba's threads.  the same as rollout_many without numba
+if have_numba:
+    @numba.njit(parallel=True, cache=True)
+    def rollout_many_parallel(s, p, count):
+        wins = numpy.zeros(count, numpy.int64)
+        
+        for rollout in numba.prange(count):
+            wins[rollout] = rollout_round(s.copy(), p)
+        
+        return wins.sum()
+else:
+    rollout_many_parallel = rollout_many
+
+## converting decisions ##
+
+# a kernel decision in the format of BuckshotRun.apply_decision, for whoever has the turn in s
+def decision_to_tuple(s, decision):
+    if decision == SHOOT_OPPONENT:
+        return ("shoot", "dealer" if s[TURN] == player_seat else "player")
+    elif decision == SHOOT_SELF:
+        return ("shoot", "self")
+    elif decision < STEAL_ITEM:
+        return ("use", buckshot.default_rules.item_names[decision - USE_ITEM])
+    else:
+        return ("use", "adrenaline", buckshot.default_rules.item_names[decision - STEAL_ITEM])
+
+def decision_from_tuple(decision):
+    if decision[0] == "shoot":
+        return SHOOT_SELF if decision[1] == "self" else SHOOT_OPPONENT
+    elif len(decision) > 2:
+        return STEAL_ITEM + buckshot.default_rules.item_ids[decision[2]]
+    else:
+        return USE_ITEM + buckshot.default_rules.item_ids[decision[1]]
+
+## converting runs ##
+
+def _shell_to_int(shell):
+    if shell is None or shell == "":
+        return UNKNOWN
+    
+    return LIVE if buckshot.shell_is_live(shell) else BLANK
+
+# the state of a BuckshotRun (including the dealer's decision state and the bugged item counts) as a kernel state, so rollouts can start from the middle of a real game
+def encode_run(run):
+    rules_to_params(run.rules)
+    
+    s = new_array(STATE_SIZE)
+    
+    s[GAME_OVER] = int(run.game_over)
+    s[TURN] = run.whose_turn_id
+    s[CUFFED] = run.who_handcuffed_id
+    s[SAWED_OFF] = int(bool(run.is_sawed_off))
+    s[CURRENT_ROUND] = run.current_round
+    s[CURRENT_SET] = run.current_set
+    s[SETS_WON] = run.sets_won
+    s[MATCHES_WON] = run.matches_won
+    s[NUM_SHELLS] = len(run.chamber)
+    
+    for i, shell in enumerate(run.chamber):
+        s[CHAMBER + i] = _shell_to_int(shell)
+    
+    for seat, participant in enumerate((run.player, run.dealer)):
+        s[HEALTH + seat] = participant.health
+        s[MAX_HEALTH + seat] = participant.current_max_health
+        
+        for i in range(shell_capacity):
+            s[KNOWN + seat * shell_capacity + i] = _shell_to_int(participant.known_sequence[i]) if i < len(participant.known_sequence) else UNKNOWN
+        
+        s[INVENTORY_SIZE + seat] = len(participant.inventory.items)
+        
+        for i, item_name in enumerate(participant.inventory.items):
+            s[INVENTORY + seat * inventory_capacity + i] = run.rules.item_ids[item_name]
+            s[ITEM_COUNTS + seat * NUM_ITEMS + run.rules.item_ids[item_name]] += 1
+        
+        for item_name, count in participant.item_counts_for_bugged_limits.items():
+            s[BUGGED_COUNTS + seat * NUM_ITEMS + run.rules.item_ids[item_name]] = count
+    
+    dealer = run.dealer
+    
+    s[DEALER_TARGET] = {"": TARGET_NONE, "self": TARGET_SELF, "player": TARGET_OPPONENT}[dealer.dealer_target]
+    s[DEALER_KNOWN_SHELL] = _shell_to_int(dealer.known_shell)
+    s[DEALER_KNOWS_SHELL] = int(bool(dealer.dealer_knows_shell))
+    s[DEALER_USING_MEDICINE] = int(dealer.using_medicine)
+    s[DEALER_USING_HANDSAW] = int(dealer.using_handsaw)
+    s[DEALER_ARRAY_CIGS] = dealer.item_array_dealer.count("cigs")
+    
+    return s
+
+## checking against the engine ##
+
+# total variation distance between the distributions of two lists of outcomes
+def total_variation(outcomes_a, outcomes_b):
+    counts_a = dict()
+    counts_b = dict()
+    
+    for outcome in outcomes_a:
+        counts_a[outcome] = counts_a.get(outcome, 0) + 1
+    
+    for outcome in outcomes_b:
+        counts_b[outcome] = counts_b.get(outcome, 0) + 1
+    
+    return 0.5 * sum(abs(counts_a.get(outcome, 0) / len(outcomes_a) - counts_b.get(outcome, 0) / len(outcomes_b)) for outcome in set(counts_a) | set(counts_b))
+
+# python kernel.py [num_games]
+# plays random games with the kernel and with BuckshotRun, compares the distributions of outcomes and the speed of both.
+def main(argc, argv):
+    import policies
+    
+    num_games = int(argv[1]) if argc > 1 else 20000
+    
+    print("numba: " + ("yes" if have_numba else "no, running the pure python fallback"))
+    
+    # compile before timing
+    play_random_games(1, seed=0)
+    
+    start = time.perf_counter()
+    kernel_results = play_random_games(num_games, seed=1)
+    kernel_elapsed = time.perf_counter() - start
+    
+    policy = policies.RandomPolicy()
+    
+    start = time.perf_counter()
+    reference_results = [policies.play_game(policy, seed) for seed in range(num_games)]
+    reference_elapsed = time.perf_counter() - start
+    
+    # a second independent batch from the kernel shows how big the distance is from sampling noise alone
+    noise_results = play_random_games(num_games, seed=2)
+    
+    for name, results in (("reference", reference_results), ("kernel", kernel_results)):
+        print("{}: {:.4f} rounds/game, {:.4f} sets/game".format(name, sum(rounds for rounds, sets in results) / num_games, sum(sets for rounds, sets in results) / num_games))
+    
+    print("total variation, kernel vs reference: {:.4f}".format(total_variation(kernel_results, reference_results)))
+    print("total variation, kernel vs kernel: {:.4f}".format(total_variation(kernel_results, noise_results)))
+    
+    print("reference: {:.1f}us/game".format(reference_elapsed / num_games * 1e6))
+    print("kernel: {:.1f}us/game ({:.0f}x)".format(kernel_elapsed / num_games * 1e6, reference_elapsed / kernel_elapsed))
+    
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))
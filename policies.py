@@ -0,0 +1,237 @@
+### player policies ###
+# a policy plays the player's side of a BuckshotRun.  every policy has:
+    # take_turn(run): take actions for the player until the player shoots or the turn ends early (same as BuckshotPredictor_CrossEntropy.take_turn)
+    # policy_hash(): a string that changes whenever the policy's behavior changes.  used to key cached results, see tournament.py.
+    # seed(seed): reset any randomness the policy has of its own, so that games with the same seed play out the same
+# policies that decide one action at a time should subclass DecisionPolicy and implement decide(run), which returns a decision in the format of BuckshotRun.apply_decision.
+
+import random
+import hashlib
+
+from buckshot import BuckshotRun, Dealer, RoundResetException
+
+# every decision the player (or whoever has the turn) is allowed to make right now
+def legal_decisions(run):
+    user, opposite = run.whose_turn()
+    
+    decisions = [("shoot", "dealer" if user is run.player else "player"), ("shoot", "self")]
+    
+    def can_use(item_name):
+        if item_name == "handcuffs" and run.is_handcuffed(opposite):
+            return False
+        
+        if item_name == "handsaw" and run.is_sawed_off:
+            return False
+        
+        return True
+    
+    for item_name in sorted(set(user.inventory.items), key=run.rules.item_ids.get):
+        if not can_use(item_name):
+            continue
+        
+        if item_name == "adrenaline":
+            for steal_item_name in sorted(set(opposite.inventory.items), key=run.rules.item_ids.get):
+                if steal_item_name != "adrenaline" and can_use(steal_item_name):
+                    decisions.append(("use", "adrenaline", steal_item_name))
+        else:
+            decisions.append(("use", item_name))
+    
+    return decisions
+
+class DecisionPolicy():
+    def decide(self, run):
+        raise NotImplementedError()
+    
+    def take_turn(self, run):
+        while not run.is_over() and run.is_player_turn():
+            if run.apply_decision(self.decide(run)):
+                break
+    
+    def seed(self, seed):
+        pass
+    
+    def policy_hash(self):
+        return type(self).__name__
+
+# picks uniformly from the legal decisions
+class RandomPolicy(DecisionPolicy):
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+    
+    def decide(self, run):
+        return self.random.choice(legal_decisions(run))
+    
+    # seeded from a string instead of seed itself.  play_game seeds the global random module with the same seed, and two generators seeded the same would make the policy's picks follow the game's own random numbers
+    def seed(self, seed):
+        self.random.seed("RandomPolicy:" + str(seed))
+    
+    def policy_hash(self):
+        return "random:2"
+
+# the dealer's brain, sitting in the player's seat.  this reuses Dealer.take_turn as-is, but reads health, items and known shells from the player instead of the dealer.
+class _PlayerSeatDealer(Dealer):
+    # NOTE: Participant.__init__ is deliberately skipped.  everything that would normally belong to this participant belongs to the player instead (see the properties below), so only the dealer's own decision state is set up here.
+    def __init__(self):
+        self.player = None
+        
+        # the decision state here belongs to the policy, not to a run, so it isn't hashed (see Dealer.dealer_target)
+        self.state_hash = None
+        
+        self.dealer_target = ""
+        self.known_shell = None
+        self.dealer_knows_shell = False
+        self.using_medicine = False
+        self.using_handsaw = False
+        self.main_loop_finished = False
+        
+        self.item_array_dealer = []
+    
+    @property
+    def name(self):
+        return self.player.name
+    
+    @property
+    def health(self):
+        return self.player.health
+    
+    @property
+    def current_max_health(self):
+        return self.player.current_max_health
+    
+    @property
+    def inventory(self):
+        return self.player.inventory
+    
+    @property
+    def known_sequence(self):
+        return self.player.known_sequence
+    
+    def take_turn(self, run):
+        self.player = run.player
+        
+        # the real dealer's item array is filled from his draws, the player doesn't have one so this starts from the player's inventory every turn
+        self.item_array_dealer = run.player.inventory.as_list()
+        
+        super().take_turn(run)
+
+# plays with the same logic as the dealer's ai
+class DealerLogicPolicy():
+    def __init__(self):
+        self.brain = _PlayerSeatDealer()
+    
+    def take_turn(self, run):
+        try:
+            self.brain.take_turn(run)
+        except RoundResetException:
+            pass
+    
+    def seed(self, seed):
+        pass
+    
+    def policy_hash(self):
+        return "dealer_logic"
+
+# plays with a BuckshotPredictor_CrossEntropy
+class PredictorPolicy(DecisionPolicy):
+    def __init__(self, predictor, name="predictor"):
+        self.predictor = predictor
+        self.name = name
+    
+    def decide(self, run):
+        self.predictor.set_run(run)
+        
+        return self.predictor.make_decisions_batch([run])[0]
+    
+    def decide_batch(self, runs):
+        return self.predictor.make_decisions_batch(runs)
+    
+    def seed(self, seed):
+        self.predictor.seed(seed)
+    
+    # hash of the predictor's weights, so a retrained predictor never reuses old results
+    def policy_hash(self):
+        digest = hashlib.sha1()
+        
+        # decisions are sampled with the predictor's torch generator, results from before that can't be reused
+        digest.update(b"torch_generator")
+        
+        for module_name in ("core_model", "who_to_shoot_or_use_item", "which_item_to_use", "which_item_to_steal"):
+            for parameter_name, tensor in getattr(self.predictor, module_name).state_dict().items():
+                digest.update((module_name + "." + parameter_name).encode())
+                digest.update(repr(tensor.tolist()).encode())
+        
+        return self.name + ":" + digest.hexdigest()[:16]
+
+# plays one whole run with policy as the player.  the global random module is seeded with seed first, so two policies (or the same policy twice) given the same seed start from the same game.
+# limits is a buckshot.RunLimits to cap the run at.  returns (rounds won, sets won), or (rounds won, sets won, status) with status from BuckshotRun.status ("dead" or "truncated") if with_status is set
+# with common_random, the game draws its random events from streams seeded with seed (see buckshot.RandomStreams), so different policies face the same chambers, health and items wherever their games line up, not just at the start.  comparisons between policies need far fewer games that way, but the games are different from the ones played without it.
+def play_game(policy, seed, rules=None, limits=None, with_status=False, common_random=False):
+    random.seed(seed)
+    policy.seed(seed)
+    
+    run = BuckshotRun(logging=False, rules=rules, limits=limits, stream_seed=seed if common_random else None)
+    
+    while run.advance_to_player_decision():
+        policy.take_turn(run)
+    
+    if with_status:
+        return run.rounds_won(), run.sets_won, run.status()
+    
+    return run.rounds_won(), run.sets_won
+
+# plays n whole runs with policy as the player, batch_size runs at a time, and returns a list of (rounds won, sets won) in the order the runs were started.
+# policy is either a function that takes a list of runs and returns a decision for each one (in the format of BuckshotRun.apply_decision), or a policy object.  policies with decide_batch (like PredictorPolicy) decide for the whole batch at once, other DecisionPolicies decide one run at a time and anything else takes whole turns with take_turn.
+# if seed isn't None, the global random module and the policy are seeded with it once, so the same call plays the same games.  the runs share the global random numbers, so the games are different from play_game's with the same seeds.
+# limits and with_status are the same as for play_game.
+def play_many(policy, n, batch_size=64, rules=None, seed=None, limits=None, with_status=False):
+    if not seed is None:
+        random.seed(seed)
+        
+        if hasattr(policy, "seed"):
+            policy.seed(seed)
+    
+    if hasattr(policy, "decide_batch"):
+        decide_batch = policy.decide_batch
+    elif isinstance(policy, DecisionPolicy):
+        decide_batch = lambda runs: [policy.decide(run) for run in runs]
+    elif callable(policy):
+        decide_batch = policy
+    else:
+        decide_batch = None
+    
+    results = [None] * n
+    
+    # (index, run) of every run being played
+    active = []
+    started = 0
+    
+    while started < n or len(active) > 0:
+        while len(active) < batch_size and started < n:
+            active.append((started, BuckshotRun(logging=False, rules=rules, limits=limits)))
+            started += 1
+        
+        waiting = []
+        
+        for index, run in active:
+            if run.advance_to_player_decision():
+                waiting.append((index, run))
+            elif with_status:
+                results[index] = (run.rounds_won(), run.sets_won, run.status())
+            else:
+                results[index] = (run.rounds_won(), run.sets_won)
+        
+        active = waiting
+        
+        if len(active) == 0:
+            continue
+        
+        if decide_batch is None:
+            for index, run in active:
+                policy.take_turn(run)
+        else:
+            runs = [run for index, run in active]
+            
+            for run, decision in zip(runs, decide_batch(runs)):
+                run.apply_decision(decision)
+    
+    return results
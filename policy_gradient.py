@@ -0,0 +1,280 @@
+### policy gradient training ###
+# trains every head of a BuckshotPredictor_CrossEntropy (core_model, who_to_shoot_or_use_item, which_item_to_use and which_item_to_steal) with batched advantage actor-critic.  REINFORCE with a learned baseline is the special case lam=1.
+# num_envs BuckshotRuns are played at once.  every iteration takes rollout_length decisions in each of them, with one batched forward pass per step and no gradients, and keeps the observations, item masks, actions, rewards and done flags in preallocated tensors.
+# the reward of a decision is the rounds the player won between it and their next decision (the dealer's turns in between included), so the return of a whole run is its rounds won.  a run that ends is replaced by a new one in the same slot.  a run truncated by buckshot.RunLimits ends too, but the player didn't lose it, so its last decision is bootstrapped from the value of the state it was cut off in instead of from 0.
+# after the rollout, the whole batch goes through the predictor and a ValueHead on the same core features in one pass with gradients:
+    # the sampled actions are scored again with action_log_probs under the masks they were sampled with
+    # advantages are generalized advantage estimates against the value head, bootstrapped from the value of the state each run stopped in
+    # one optimizer step minimizes the policy gradient loss plus value_coefficient times the value head's squared error
+# PolicyGradientTrainer.step has the signature of jobs.run_training's step.  the unfinished runs are kept in the state as BuckshotRun.to_bytes along with the value head, so a resumed training run carries on with the same games and makes exactly the same updates.
+
+import sys
+import json
+import time
+
+import torch
+
+import buckshot
+from buckshot import BuckshotRun
+from cross_entropy import BuckshotPredictor_CrossEntropy, get_legal_item_masks
+import jobs
+
+# value of the state behind a batch of core features, in rounds won from here on
+class ValueHead(torch.nn.Module):
+    def __init__(self, feature_size):
+        super().__init__()
+        
+        self.linear = torch.nn.Linear(feature_size, 1)
+    
+    def forward(self, features):
+        return self.linear(features).squeeze(-1)
+
+class PolicyGradientTrainer():
+    # gamma is the discount per decision and lam the advantage estimate's lambda.  advantages are normalized over every batch if normalize_advantages, and the gradient norm is clipped to max_grad_norm.
+    # limits is a buckshot.RunLimits for the runs, so a policy that gets good can't make them endless
+    def __init__(self, predictor, num_envs=64, rollout_length=16, learning_rate=0.003, gamma=1.0, lam=0.95, value_coefficient=0.5, normalize_advantages=True, max_grad_norm=1.0, limits=None):
+        self.predictor = predictor
+        self.rules = predictor.rules
+        self.device = predictor.device
+        
+        self.num_envs = num_envs
+        self.rollout_length = rollout_length
+        self.gamma = gamma
+        self.lam = lam
+        self.value_coefficient = value_coefficient
+        self.normalize_advantages = normalize_advantages
+        self.max_grad_norm = max_grad_norm
+        self.limits = limits
+        
+        self.value_head = ValueHead(predictor.feature_size).to(self.device)
+        
+        modules = (predictor.core_model, predictor.who_to_shoot_or_use_item, predictor.which_item_to_use, predictor.which_item_to_steal, self.value_head)
+        
+        self.parameters = [parameter for module in modules for parameter in module.parameters()]
+        self.optimizer = torch.optim.Adam(self.parameters, lr=learning_rate)
+        
+        # everything besides the predictor and the optimizer that a checkpoint needs, see jobs.run_training
+        self.state = {"value_head": self.value_head}
+        
+        self.runs = None
+        
+        # the rollout, (step, run) for every field
+        size = (rollout_length, num_envs)
+        num_items = predictor.num_total_items
+        
+        self.obs = torch.zeros(size + (predictor.input_size,), device=self.device)
+        self.use_mask = torch.zeros(size + (num_items,), dtype=torch.bool, device=self.device)
+        self.steal_mask = torch.zeros(size + (num_items,), dtype=torch.bool, device=self.device)
+        self.use_item = torch.zeros(size, dtype=torch.bool, device=self.device)
+        self.shoot_dealer = torch.zeros(size, dtype=torch.long, device=self.device)
+        self.item = torch.zeros(size, dtype=torch.long, device=self.device)
+        self.steal = torch.zeros(size, dtype=torch.long, device=self.device)
+        self.rewards = torch.zeros(size, device=self.device)
+        self.dones = torch.zeros(size, device=self.device)
+        
+        # value of the state a run was truncated in, 0 where the run didn't end or the player died
+        self.truncated_values = torch.zeros(size, device=self.device)
+    
+    # a new run, advanced to the player's first decision
+    def new_run(self):
+        while True:
+            run = BuckshotRun(logging=False, rules=self.rules, limits=self.limits)
+            
+            if run.advance_to_player_decision():
+                return run
+    
+    # observations and masks of runs as tensors
+    def encode(self, runs):
+        masks = [get_legal_item_masks(run) for run in runs]
+        
+        obs = torch.tensor([self.predictor.get_input_list(run) for run in runs], dtype=torch.float32, device=self.device)
+        use_mask = torch.tensor([use for use, steal in masks], device=self.device)
+        steal_mask = torch.tensor([steal for use, steal in masks], device=self.device)
+        
+        return obs, use_mask, steal_mask
+    
+    # play rollout_length decisions in every run.  returns the rounds won of every run that ended
+    def collect(self):
+        predictor = self.predictor
+        finished = []
+        
+        with torch.no_grad():
+            for t in range(self.rollout_length):
+                obs, use_mask, steal_mask = self.encode(self.runs)
+                
+                self.obs[t] = obs
+                self.use_mask[t] = use_mask
+                self.steal_mask[t] = steal_mask
+                
+                actions = predictor.sample_actions(*predictor.fused(obs, use_mask, steal_mask), use_mask)
+                
+                self.use_item[t] = actions.use_item
+                self.shoot_dealer[t] = actions.shoot_dealer
+                self.item[t] = actions.item
+                self.steal[t] = actions.steal
+                
+                rewards = []
+                dones = []
+                truncated = []
+                
+                for i, decision in enumerate(predictor.actions_to_decisions(actions)):
+                    run = self.runs[i]
+                    rounds = run.rounds_won()
+                    
+                    run.apply_decision(decision)
+                    alive = run.advance_to_player_decision()
+                    
+                    rewards.append(run.rounds_won() - rounds)
+                    dones.append(0.0 if alive else 1.0)
+                    
+                    if not alive:
+                        finished.append(run.rounds_won())
+                        
+                        if run.status() == "truncated":
+                            truncated.append((i, run))
+                        
+                        self.runs[i] = self.new_run()
+                
+                self.rewards[t] = torch.tensor(rewards, dtype=torch.float32, device=self.device)
+                self.dones[t] = torch.tensor(dones, device=self.device)
+                self.truncated_values[t] = 0
+                
+                if len(truncated) > 0:
+                    indices = torch.tensor([i for i, run in truncated], device=self.device)
+                    obs = torch.tensor([predictor.get_input_list(run) for i, run in truncated], dtype=torch.float32, device=self.device)
+                    
+                    self.truncated_values[t, indices] = self.value_head(predictor.core_model(obs))
+        
+        return finished
+    
+    # generalized advantage estimates and value targets for the rollout from its values (step, run) and the values of the states the runs stopped in
+    def advantages(self, values, last_values):
+        advantages = torch.zeros_like(values)
+        
+        next_value = last_values
+        running = torch.zeros_like(last_values)
+        
+        for t in reversed(range(self.rollout_length)):
+            not_done = 1 - self.dones[t]
+            
+            # a run that ended doesn't continue into the next step's run in its slot, but a truncated one still has the value of where it was cut off
+            delta = self.rewards[t] + self.gamma * (next_value * not_done + self.truncated_values[t]) - values[t]
+            running = delta + self.gamma * self.lam * not_done * running
+            
+            advantages[t] = running
+            next_value = values[t]
+        
+        return advantages, advantages + values
+    
+    # one optimizer step on the rollout.  returns (policy loss, value loss, mean value)
+    def update(self):
+        predictor = self.predictor
+        steps = self.rollout_length * self.num_envs
+        
+        obs = self.obs.view(steps, -1)
+        use_mask = self.use_mask.view(steps, -1)
+        steal_mask = self.steal_mask.view(steps, -1)
+        
+        confidences, item_confidences, steal_confidences = predictor.fused(obs, use_mask, steal_mask)
+        
+        log_probs = predictor.action_log_probs(confidences, item_confidences, steal_confidences, use_mask, self.use_item.view(steps), self.shoot_dealer.view(steps), self.item.view(steps), self.steal.view(steps))
+        values = self.value_head(predictor.core_model(obs))
+        
+        with torch.no_grad():
+            last_values = self.value_head(predictor.core_model(self.encode(self.runs)[0]))
+            advantages, returns = self.advantages(values.detach().view(self.rollout_length, self.num_envs), last_values)
+            
+            advantages = advantages.view(steps)
+            
+            if self.normalize_advantages:
+                advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
+        
+        policy_loss = -(log_probs * advantages).mean()
+        value_loss = ((values - returns.view(steps)) ** 2).mean()
+        
+        self.optimizer.zero_grad()
+        (policy_loss + self.value_coefficient * value_loss).backward()
+        
+        torch.nn.utils.clip_grad_norm_(self.parameters, self.max_grad_norm)
+        
+        self.optimizer.step()
+        
+        return policy_loss.item(), value_loss.item(), values.mean().item()
+    
+    # one iteration: a rollout and an update.  state is this trainer's state (the same dict as self.state after jobs.run_training restored it), and the unfinished runs are saved to it afterwards
+    def step(self, iteration, state):
+        if self.runs is None:
+            if "runs" in state:
+                self.runs = [BuckshotRun.from_bytes(bytes(data.tolist()), self.rules) for data in state["runs"]]
+            else:
+                self.runs = [self.new_run() for i in range(self.num_envs)]
+        
+        start = time.perf_counter()
+        
+        finished = self.collect()
+        
+        collected = time.perf_counter()
+        
+        policy_loss, value_loss, mean_value = self.update()
+        
+        end = time.perf_counter()
+        
+        state["runs"] = [torch.tensor(list(run.to_bytes()), dtype=torch.uint8) for run in self.runs]
+        
+        steps = self.rollout_length * self.num_envs
+        
+        return {
+            "steps_per_second": steps / (end - start),
+            "rollout_steps_per_second": steps / (collected - start),
+            "runs_finished": len(finished),
+            "rounds_won": sum(finished) / len(finished) if len(finished) > 0 else None,
+            "policy_loss": policy_loss,
+            "value_loss": value_loss,
+            "mean_value": mean_value
+        }
+
+# python policy_gradient.py [iterations] [num_envs] [checkpoint path]
+# trains a fresh predictor (or resumes the training in checkpoint path), prints the learning curve as it goes and appends every iteration's numbers to checkpoint path + ".log.jsonl"
+def main(argc, argv):
+    num_iterations = int(argv[1]) if argc > 1 else 300
+    num_envs = int(argv[2]) if argc > 2 else 64
+    path = argv[3] if argc > 3 else "policy_gradient.ckpt"
+    
+    # the batches are small, threads cost more than they save
+    torch.set_num_threads(1)
+    
+    import random
+    
+    random.seed(0)
+    torch.manual_seed(0)
+    
+    predictor = BuckshotPredictor_CrossEntropy()
+    predictor.seed(0)
+    
+    trainer = PolicyGradientTrainer(predictor, num_envs=num_envs, limits=buckshot.RunLimits(max_rounds=50))
+    
+    log_path = path + ".log.jsonl"
+    recent = []
+    
+    def on_step(iteration, metrics):
+        with open(log_path, "a") as f:
+            f.write(json.dumps(dict(metrics, iteration=iteration)) + "\n")
+        
+        if not metrics["rounds_won"] is None:
+            recent.extend([metrics["rounds_won"]] * metrics["runs_finished"])
+        
+        if (iteration + 1) % 10 == 0:
+            print("iteration {:4d}: {:6.0f} steps/s ({:6.0f} in rollouts), rounds won {:.3f} over the last {} runs, policy loss {:+.4f}, value loss {:.4f}, mean value {:.3f}".format(iteration + 1, metrics["steps_per_second"], metrics["rollout_steps_per_second"], sum(recent) / max(1, len(recent)), len(recent), metrics["policy_loss"], metrics["value_loss"], metrics["mean_value"]))
+            
+            recent.clear()
+    
+    start = time.perf_counter()
+    
+    curve, state = jobs.run_training(path, predictor, trainer.optimizer, trainer.step, num_iterations, state=trainer.state, on_step=on_step)
+    
+    print("{} iterations, {:.1f}s".format(len(curve), time.perf_counter() - start))
+    
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))
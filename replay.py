@@ -0,0 +1,298 @@
+### replay buffer for predictor training ###
+# a ring buffer of preallocated tensors, so collected decisions are written into place a batch at a time and minibatches are gathered with one index per field instead of being rebuilt from python lists.
+# every entry is one decision made by the player:
+    # obs: the predictor's input list (see BuckshotPredictor_CrossEntropy.get_input_list)
+    # use_mask, steal_mask: the legal item masks (see get_legal_item_masks)
+    # use_item: 1 if an item was used, 0 if a shot was fired
+    # shoot_dealer: 1 if the dealer was shot, 0 if the player shot themselves, -1 if an item was used instead
+    # item, steal: the item id that was used and the item id that was stolen with adrenaline, or -1 if that head wasn't used
+    # reward, done: the reward for the decision and whether the run ended after it
+# once the buffer is full, the oldest entries are overwritten first.
+# buffers bigger than max_memory_bytes can be backed by memory-mapped files in spill_dir instead of RAM.  the files are only scratch space for that buffer, they're overwritten when a new buffer is created in the same directory.
+
+import os
+import sys
+import time
+import random
+
+import torch
+
+import buckshot
+from buckshot import BuckshotRun
+import cross_entropy
+from cross_entropy import BuckshotPredictor_CrossEntropy, get_legal_item_masks
+
+# turn decisions in the format of BuckshotRun.apply_decision into the action fields of the buffer.
+# returns (use_item, shoot_dealer, item, steal) as lists
+def encode_decisions(decisions, rules=None):
+    if rules is None:
+        rules = buckshot.default_rules
+    
+    use_item = []
+    shoot_dealer = []
+    item = []
+    steal = []
+    
+    for decision in decisions:
+        if decision[0] == "use":
+            use_item.append(1)
+            shoot_dealer.append(-1)
+            item.append(rules.item_ids[decision[1]])
+            steal.append(rules.item_ids[decision[2]] if len(decision) > 2 else -1)
+        else:
+            use_item.append(0)
+            shoot_dealer.append(0 if decision[1] == "self" else 1)
+            item.append(-1)
+            steal.append(-1)
+    
+    return use_item, shoot_dealer, item, steal
+
+class ReplayBuffer():
+    # capacity is the number of decisions the buffer holds.  input_size and num_items are the predictor's input_size and num_total_items, see from_predictor.
+    # device is where the buffer lives and where sampled minibatches end up, cross_entropy.device if None.  buffers spilled to files always live on the cpu.
+    # if prioritized, sample draws entries in proportion to priority ** alpha and returns importance weights, see update_priorities.
+    def __init__(self, capacity, input_size, num_items, device=None, prioritized=False, alpha=0.6, beta=0.4, spill_dir=None, max_memory_bytes=1 << 30, seed=None):
+        self.capacity = capacity
+        self.input_size = input_size
+        self.num_items = num_items
+        self.device = cross_entropy.device if device is None else torch.device(device)
+        
+        self.prioritized = prioritized
+        self.alpha = alpha
+        self.beta = beta
+        
+        # field name -> (shape of one entry, dtype)
+        self.fields = {
+            "obs": ((input_size,), torch.float32),
+            "use_mask": ((num_items,), torch.bool),
+            "steal_mask": ((num_items,), torch.bool),
+            "use_item": ((), torch.int8),
+            "shoot_dealer": ((), torch.int8),
+            "item": ((), torch.int64),
+            "steal": ((), torch.int64),
+            "reward": ((), torch.float32),
+            "done": ((), torch.bool)
+        }
+        
+        if prioritized:
+            self.fields["priority"] = ((), torch.float32)
+        
+        self.spilled = not spill_dir is None and self.entry_bytes() * capacity > max_memory_bytes
+        self.storage_device = torch.device("cpu") if self.spilled else self.device
+        
+        self.storage = dict()
+        
+        for name, (shape, dtype) in self.fields.items():
+            if self.spilled:
+                self.storage[name] = self.map_file(os.path.join(spill_dir, name + ".bin"), shape, dtype)
+            else:
+                self.storage[name] = torch.zeros((capacity,) + shape, dtype=dtype, device=self.storage_device)
+        
+        # next entry to write, and number of entries written so far (up to capacity)
+        self.position = 0
+        self.size = 0
+        
+        self.max_priority = 1.0
+        
+        self.generator = torch.Generator(device=self.storage_device)
+        self.seed(seed)
+    
+    # buffer sized for predictor's input and item heads, on the predictor's device unless device is given
+    @classmethod
+    def from_predictor(cls, predictor, capacity, **kwargs):
+        kwargs.setdefault("device", predictor.device)
+        
+        return cls(capacity, predictor.input_size, predictor.num_total_items, **kwargs)
+    
+    def entry_bytes(self):
+        total = 0
+        
+        for shape, dtype in self.fields.values():
+            total += torch.tensor([], dtype=dtype).element_size() * (shape[0] if len(shape) > 0 else 1)
+        
+        return total
+    
+    def map_file(self, path, shape, dtype):
+        if os.path.exists(path):
+            os.remove(path)
+        
+        num_elements = self.capacity * (shape[0] if len(shape) > 0 else 1)
+        
+        return torch.from_file(path, shared=True, size=num_elements, dtype=dtype).view((self.capacity,) + shape)
+    
+    def seed(self, seed):
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+    
+    def __len__(self):
+        return self.size
+    
+    # write a batch of decisions.  every argument is a tensor or list with one row per decision, use encode_decisions for the action fields.
+    # if the batch is bigger than the buffer, only its last capacity entries are kept.
+    # returns the indices the batch was written to.
+    def add_batch(self, obs, use_mask, steal_mask, use_item, shoot_dealer, item, steal, reward, done):
+        values = {
+            "obs": obs,
+            "use_mask": use_mask,
+            "steal_mask": steal_mask,
+            "use_item": use_item,
+            "shoot_dealer": shoot_dealer,
+            "item": item,
+            "steal": steal,
+            "reward": reward,
+            "done": done
+        }
+        
+        num_entries = len(obs)
+        skip = max(0, num_entries - self.capacity)
+        
+        indices = (self.position + skip + torch.arange(num_entries - skip, device=self.storage_device)) % self.capacity
+        
+        for name, value in values.items():
+            value = torch.as_tensor(value, dtype=self.fields[name][1]).to(self.storage_device)
+            
+            self.storage[name][indices] = value[skip:]
+        
+        # new entries get the highest priority seen so far, so they are likely to be sampled before their real priority is known
+        if self.prioritized:
+            self.storage["priority"][indices] = self.max_priority
+        
+        self.position = (self.position + num_entries) % self.capacity
+        self.size = min(self.size + num_entries, self.capacity)
+        
+        return indices
+    
+    # gather a minibatch of batch_size entries, drawn with replacement.
+    # returns a dict of field name -> tensor on the buffer's device, plus "indices" (for update_priorities) and "weights" (importance sampling weights, all ones if not prioritized).
+    def sample(self, batch_size):
+        if self.size == 0:
+            raise ValueError("can't sample from an empty replay buffer")
+        
+        if self.prioritized:
+            # inverse transform sampling on the cumulative priorities, which works for any number of entries unlike torch.multinomial
+            probabilities = self.storage["priority"][:self.size].double() ** self.alpha
+            cumulative = torch.cumsum(probabilities, dim=0)
+            total = cumulative[-1]
+            
+            targets = torch.rand(batch_size, generator=self.generator, device=self.storage_device, dtype=torch.float64) * total
+            indices = torch.searchsorted(cumulative, targets).clamp_(max=self.size - 1)
+            
+            weights = (self.size * probabilities[indices] / total) ** -self.beta
+            weights = (weights / weights.max()).float()
+        else:
+            indices = torch.randint(self.size, (batch_size,), generator=self.generator, device=self.storage_device)
+            weights = torch.ones(batch_size, device=self.storage_device)
+        
+        batch = {name: self.storage[name][indices].to(self.device, non_blocking=True) for name in self.fields if name != "priority"}
+        
+        batch["indices"] = indices
+        batch["weights"] = weights.to(self.device, non_blocking=True)
+        
+        return batch
+    
+    # set the priorities of sampled entries, usually to their absolute td error or loss
+    def update_priorities(self, indices, priorities):
+        if not self.prioritized:
+            raise ValueError("replay buffer isn't prioritized")
+        
+        priorities = torch.as_tensor(priorities, dtype=torch.float32).to(self.storage_device).clamp(min=1e-6)
+        
+        self.storage["priority"][indices.to(self.storage_device)] = priorities
+        self.max_priority = max(self.max_priority, priorities.max().item())
+
+# play num_games games with predictor as the player, num_parallel at a time, and add every decision to buffer.
+# the reward for a decision is the number of rounds won by the time the player gets to decide again (or the run ends).
+def collect_games(predictor, buffer, num_games, num_parallel=64, rules=None):
+    runs = []
+    games_started = 0
+    
+    # pending[i] is the decision run i is waiting on a reward for
+    pending = dict()
+    
+    def start_run():
+        nonlocal games_started
+        
+        games_started += 1
+        
+        return BuckshotRun(logging=False, rules=rules)
+    
+    while games_started < num_games or len(runs) > 0:
+        while len(runs) < num_parallel and games_started < num_games:
+            runs.append(start_run())
+        
+        obs = [predictor.get_input_list(run) for run in runs]
+        masks = [get_legal_item_masks(run) for run in runs]
+        decisions = predictor.make_decisions_batch(runs)
+        
+        rounds_before = [run.rounds_won() for run in runs]
+        
+        for run, decision in zip(runs, decisions):
+            if run.apply_decision(decision):
+                run.advance_to_player_decision()
+        
+        use_item, shoot_dealer, item, steal = encode_decisions(decisions, predictor.rules)
+        
+        buffer.add_batch(
+            obs,
+            [use for use, steal in masks],
+            [steal for use, steal in masks],
+            use_item,
+            shoot_dealer,
+            item,
+            steal,
+            [run.rounds_won() - before for run, before in zip(runs, rounds_before)],
+            [run.is_over() for run in runs]
+        )
+        
+        runs = [run for run in runs if not run.is_over()]
+
+# python replay.py [num_games] [batch_size]
+# fills a buffer from batched rollouts, then compares sampling minibatches from it against rebuilding them from python lists.
+def main(argc, argv):
+    num_games = int(argv[1]) if argc > 1 else 500
+    batch_size = int(argv[2]) if argc > 2 else 256
+    num_batches = 1000
+    
+    predictor = BuckshotPredictor_CrossEntropy()
+    
+    for prioritized in (False, True):
+        buffer = ReplayBuffer.from_predictor(predictor, 1 << 16, prioritized=prioritized, seed=0)
+        
+        start = time.perf_counter()
+        
+        collect_games(predictor, buffer, num_games)
+        
+        collect_elapsed = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        
+        for i in range(num_batches):
+            batch = buffer.sample(batch_size)
+            
+            if prioritized:
+                buffer.update_priorities(batch["indices"], batch["reward"].abs() + 0.1)
+        
+        sample_elapsed = time.perf_counter() - start
+        
+        print("{} buffer: {} decisions from {} games in {:.2f}s, {:.1f}us per minibatch of {}".format("prioritized" if prioritized else "uniform", len(buffer), num_games, collect_elapsed, sample_elapsed / num_batches * 1e6, batch_size))
+    
+    # the same minibatches rebuilt from python lists, which is what training did before
+    entries = [[buffer.storage[name][i].tolist() for name in ("obs", "use_mask", "steal_mask", "use_item", "shoot_dealer", "item", "steal", "reward", "done")] for i in range(len(buffer))]
+    
+    start = time.perf_counter()
+    
+    for i in range(num_batches):
+        rows = random.choices(entries, k=batch_size)
+        
+        batch = [torch.tensor([row[field] for row in rows]).to(cross_entropy.device) for field in range(len(rows[0]))]
+    
+    list_elapsed = time.perf_counter() - start
+    
+    print("python lists: {:.1f}us per minibatch of {}".format(list_elapsed / num_batches * 1e6, batch_size))
+    
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))
@@ -0,0 +1,190 @@
+### bulk scenario generation ###
+# builds lots of BuckshotRuns directly in sampled states with BuckshotRun.from_state, for things like curriculum training on rare endgames that would take millions of normal games to reach.
+# every field of generate_runs can be given as:
+    # a plain value, which every run uses as-is
+    # choice([a, b, ...]), to pick one value uniformly for each run
+    # between(low, high), to pick a whole number from low to high (inclusive) for each run
+    # any other callable, which is called with the random.Random of the generator and returns a value
+# fields that aren't given are sampled the same way a normal game would deal them.
+
+import sys
+import time
+import random
+
+import buckshot
+from buckshot import BuckshotRun, live_token, blank_token
+
+# pick one of values uniformly
+class choice():
+    def __init__(self, values):
+        self.values = list(values)
+    
+    def __call__(self, rng):
+        return rng.choice(self.values)
+
+# pick a whole number from low to high, inclusive
+class between():
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+    
+    def __call__(self, rng):
+        return rng.randint(self.low, self.high)
+
+def sample(spec, rng):
+    if callable(spec):
+        return spec(rng)
+    else:
+        return spec
+
+# draw items for a seat the same way on_set_end does (without bugged counts), using rng instead of the global random module
+def sample_items(rng, rules, num_items=None):
+    if num_items is None:
+        num_items = rng.randint(rules.min_items_per_set, rules.max_items_per_set)
+    
+    limits = list(rules.item_limit_array)
+    counts = [0] * len(limits)
+    
+    pickable_ids = [item_id for item_id, limit in enumerate(limits) if limit > 0]
+    
+    items = []
+    
+    for i in range(min(num_items, rules.max_items_total)):
+        if len(pickable_ids) < 1:
+            break
+        
+        item_id = rng.choice(pickable_ids)
+        
+        items.append(rules.item_names[item_id])
+        
+        counts[item_id] += 1
+        
+        if counts[item_id] >= limits[item_id]:
+            pickable_ids.remove(item_id)
+    
+    return items
+
+# the seat knows each shell with probability known_probability
+def sample_known(rng, chamber, known_probability):
+    return [shell if rng.random() < known_probability else None for shell in chamber]
+
+# generate num_runs runs with fields sampled from the given distributions (see the top of the file).
+# num_live and num_blank decide the chamber, which is shuffled.  if neither is given, the chamber is dealt like a normal set.
+# player_known_probability and dealer_known_probability are the chance of each shell being known to that seat.
+# bugged counts are dicts of item name -> count, see adrenaline_behavior.
+# handcuffed is "player", "dealer" or None.  if it would cuff whoever has the turn, it's dropped for that run instead of failing.
+# seed seeds the generator's own random.Random, the global random module isn't touched.
+# raises InvalidStateException if the distributions produce an invalid state.
+def generate_runs(
+    num_runs,
+    num_live=None,
+    num_blank=None,
+    player_health=None,
+    dealer_health=None,
+    max_health=None,
+    player_items=None,
+    dealer_items=None,
+    player_known_probability=0.0,
+    dealer_known_probability=0.0,
+    player_bugged_counts=None,
+    dealer_bugged_counts=None,
+    handcuffed=None,
+    sawed_off=False,
+    player_turn=True,
+    current_round=1,
+    current_set=1,
+    rules=None,
+    seed=None
+):
+    if rules is None:
+        rules = buckshot.default_rules
+    
+    rng = random.Random(seed)
+    
+    runs = []
+    
+    for i in range(num_runs):
+        if num_live is None and num_blank is None:
+            run_num_live, run_num_blank = rules.chamber_compositions[rng.randint(rules.min_shells_per_set, rules.max_shells_per_set)]
+        else:
+            run_num_live = sample(num_live, rng) if not num_live is None else 0
+            run_num_blank = sample(num_blank, rng) if not num_blank is None else 0
+        
+        chamber = [live_token] * run_num_live + [blank_token] * run_num_blank
+        rng.shuffle(chamber)
+        
+        # health is dealt once for both participants, like at the start of a round
+        run_max_health = sample(max_health, rng) if not max_health is None else rng.randint(rules.min_health, rules.max_health)
+        
+        run_player_health = sample(player_health, rng) if not player_health is None else run_max_health
+        run_dealer_health = sample(dealer_health, rng) if not dealer_health is None else run_max_health
+        
+        run_max_health = max(run_max_health, run_player_health, run_dealer_health)
+        
+        run_player_items = sample(player_items, rng) if not player_items is None else sample_items(rng, rules)
+        run_dealer_items = sample(dealer_items, rng) if not dealer_items is None else sample_items(rng, rules)
+        
+        run_player_turn = sample(player_turn, rng)
+        run_handcuffed = sample(handcuffed, rng)
+        
+        if (run_handcuffed == "player" and run_player_turn) or (run_handcuffed == "dealer" and not run_player_turn):
+            run_handcuffed = None
+        
+        runs.append(BuckshotRun.from_state(
+            chamber,
+            run_player_health,
+            run_dealer_health,
+            player_max_health=run_max_health,
+            dealer_max_health=run_max_health,
+            player_items=run_player_items,
+            dealer_items=run_dealer_items,
+            player_known=sample_known(rng, chamber, sample(player_known_probability, rng)),
+            dealer_known=sample_known(rng, chamber, sample(dealer_known_probability, rng)),
+            player_bugged_counts=sample(player_bugged_counts, rng),
+            dealer_bugged_counts=sample(dealer_bugged_counts, rng),
+            handcuffed=run_handcuffed,
+            sawed_off=sample(sawed_off, rng),
+            player_turn=run_player_turn,
+            current_round=sample(current_round, rng),
+            current_set=sample(current_set, rng),
+            rules=rules
+        ))
+    
+    return runs
+
+# generates a batch of one-health endgames and plays them out with random player shots to show how fast it is
+def main(argc, argv):
+    num_runs = int(argv[1]) if argc > 1 else 10000
+    
+    start = time.perf_counter()
+    
+    runs = generate_runs(
+        num_runs,
+        num_live=between(1, 2),
+        num_blank=between(0, 2),
+        player_health=1,
+        dealer_health=1,
+        max_health=choice([2, 3, 4]),
+        player_items=[],
+        dealer_items=[],
+        player_known_probability=0.25,
+        seed=0
+    )
+    
+    elapsed = time.perf_counter() - start
+    
+    print("generated {} runs in {:.3f}s ({:.1f}us/run)".format(num_runs, elapsed, elapsed / num_runs * 1e6))
+    
+    survived = 0
+    
+    for run in runs:
+        run.shoot(shooting_self=random.random() < 0.5)
+        
+        survived += not run.is_over()
+    
+    print("survived the first shot: {:.2%}".format(survived / num_runs))
+    
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))
@@ -0,0 +1,510 @@
+### multi-session game server ###
+# hosts many BuckshotRuns at once over a JSON-lines protocol on a TCP or unix socket, using asyncio.
+# every request is one JSON object on one line, and every response is one JSON object on one line with the same "id" as the request:
+    # {"id": 1, "op": "new"}                                    -> starts a session.  the response includes "session" and "state".
+    # {"id": 2, "op": "state", "session": 5}                    -> current state of a session
+    # {"id": 3, "op": "use", "session": 5, "item": "beer"}      -> player uses an item
+    # {"id": 4, "op": "use", "session": 5, "item": "adrenaline", "steal": "cigs"}
+    # {"id": 5, "op": "shoot", "session": 5, "target": "self"}  -> target is "self" or "dealer"
+    # {"id": 6, "op": "ai_turn", "session": 5}                  -> the server's predictor takes the player's turn until it shoots or the turn ends
+    # {"id": 7, "op": "close", "session": 5}
+    # {"id": 8, "op": "stats"}                                  -> session counts and p50/p99 latencies per op
+# the dealer's turns are always played by the server right after the player's action, so every response leaves the session either on the player's turn or game over.
+# a session belongs to the connection that started it and is dropped when that connection goes away, so clients that disconnect without closing their sessions don't leak them.
+# pending ai_turn requests from every session are coalesced and decided with one batched predictor call every batch_interval seconds.
+
+import sys
+import json
+import time
+import random
+import asyncio
+import itertools
+import collections
+
+import buckshot
+from buckshot import BuckshotRun, NoItemException, InvalidItemException
+
+# keeps the last window_size latencies for each op
+class LatencyRecorder():
+    def __init__(self, window_size=10000):
+        self.window_size = window_size
+        self.latencies = dict()
+        self.counts = collections.Counter()
+    
+    def record(self, op, seconds):
+        if not op in self.latencies:
+            self.latencies[op] = collections.deque(maxlen=self.window_size)
+        
+        self.latencies[op].append(seconds)
+        self.counts[op] += 1
+    
+    @staticmethod
+    def percentile(sorted_values, fraction):
+        index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+        
+        return sorted_values[index]
+    
+    # {op: {"count", "p50_ms", "p99_ms"}}
+    def summary(self):
+        summary = dict()
+        
+        for op, latencies in self.latencies.items():
+            sorted_latencies = sorted(latencies)
+            
+            summary[op] = {
+                "count": self.counts[op],
+                "p50_ms": self.percentile(sorted_latencies, 0.50) * 1000,
+                "p99_ms": self.percentile(sorted_latencies, 0.99) * 1000
+            }
+        
+        return summary
+
+class ProtocolError(Exception):
+    pass
+
+class Session():
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.run = BuckshotRun(logging=False)
+        
+        # set while an ai turn is pending so that other requests can't change the run underneath it
+        self.busy = False
+    
+    def known_sequence(self):
+        known = []
+        
+        for shell in self.run.player.known_sequence:
+            if shell is None:
+                known.append(None)
+            elif buckshot.shell_is_live(shell):
+                known.append("live")
+            else:
+                known.append("blank")
+        
+        return known
+    
+    # everything the player is allowed to see
+    def state(self):
+        run = self.run
+        last_shell = run.get_last_shell_fired()
+        
+        return {
+            "session": self.session_id,
+            "over": run.is_over(),
+            "player_turn": run.is_player_turn(),
+            "round": run.current_round,
+            "set": run.current_set,
+            "matches_won": run.matches_won,
+            "rounds_won": run.rounds_won(),
+            "sets_won": run.sets_won,
+            "num_live": run.num_live(),
+            "num_blank": run.num_blank(),
+            "last_shell": None if last_shell is None else ("live" if buckshot.shell_is_live(last_shell) else "blank"),
+            "handcuffed": "player" if run.is_handcuffed(run.player) else ("dealer" if run.is_handcuffed(run.dealer) else None),
+            "sawed_off": run.is_sawed_off,
+            "player": {
+                "health": run.player.health,
+                "items": run.player.inventory.as_list(),
+                "known": self.known_sequence()
+            },
+            "dealer": {
+                "health": run.dealer.health,
+                "items": run.dealer.inventory.as_list()
+            }
+        }
+    
+    # apply a player decision and then let the dealer play.  returns True if the player's sequence of actions is over.
+    def apply_decision(self, decision):
+        if self.run.is_over():
+            raise ProtocolError("game is over")
+        
+        turn_over = self.run.apply_decision(decision)
+        
+        self.run.advance_to_player_decision()
+        
+        return turn_over
+
+class GameServer():
+    # predictor is a BuckshotPredictor_CrossEntropy used for ai_turn requests, or None to not allow them.
+    # batch_interval is how long (in seconds) pending ai decisions are collected before they're all decided in one call.
+    def __init__(self, predictor=None, batch_interval=0.002, max_batch_size=4096):
+        self.predictor = predictor
+        self.batch_interval = batch_interval
+        self.max_batch_size = max_batch_size
+        
+        self.sessions = dict()
+        self.session_ids = itertools.count(1)
+        
+        # sessions dropped because their connection went away without closing them
+        self.dropped_sessions = 0
+        
+        # list of (session, future) waiting for an ai decision
+        self.pending_decisions = []
+        self.pending_event = asyncio.Event()
+        self.batcher_task = None
+        
+        self.latency = LatencyRecorder()
+        self.batch_sizes = collections.deque(maxlen=10000)
+        
+        self.servers = []
+    
+    async def start_tcp(self, host="127.0.0.1", port=0):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        
+        self._on_started(server)
+        
+        return server
+    
+    async def start_unix(self, path):
+        server = await asyncio.start_unix_server(self.handle_connection, path)
+        
+        self._on_started(server)
+        
+        return server
+    
+    def _on_started(self, server):
+        self.servers.append(server)
+        
+        if self.batcher_task is None:
+            self.batcher_task = asyncio.get_running_loop().create_task(self.batch_decisions_forever())
+    
+    async def close(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        
+        if not self.batcher_task is None:
+            self.batcher_task.cancel()
+            
+            try:
+                await self.batcher_task
+            except asyncio.CancelledError:
+                pass
+            
+            self.batcher_task = None
+    
+    async def handle_connection(self, reader, writer):
+        # ids of the sessions started on this connection that are still open
+        connection_sessions = set()
+        
+        try:
+            while True:
+                line = await reader.readline()
+                
+                if not line:
+                    break
+                
+                start = time.perf_counter()
+                
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    response = {"id": None, "ok": False, "error": "bad json"}
+                    op = "bad_json"
+                else:
+                    op = request.get("op")
+                    response = await self.handle_request(request, connection_sessions)
+                
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+                
+                self.latency.record(str(op), time.perf_counter() - start)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for session_id in connection_sessions:
+                if not self.sessions.pop(session_id, None) is None:
+                    self.dropped_sessions += 1
+            
+            writer.close()
+    
+    def get_session(self, request):
+        session = self.sessions.get(request.get("session"))
+        
+        if session is None:
+            raise ProtocolError("no such session " + str(request.get("session")))
+        
+        if session.busy:
+            raise ProtocolError("session is waiting on an ai turn")
+        
+        return session
+    
+    # connection_sessions is the set of session ids started on the request's connection, kept up to date by new and close
+    async def handle_request(self, request, connection_sessions=None):
+        response = {"id": request.get("id"), "ok": True}
+        op = request.get("op")
+        
+        try:
+            if op == "new":
+                session = Session(next(self.session_ids))
+                self.sessions[session.session_id] = session
+                
+                if not connection_sessions is None:
+                    connection_sessions.add(session.session_id)
+                
+                response["state"] = session.state()
+            elif op == "state":
+                response["state"] = self.get_session(request).state()
+            elif op == "use":
+                session = self.get_session(request)
+                
+                if request.get("item") == "adrenaline":
+                    decision = ("use", "adrenaline", request.get("steal"))
+                else:
+                    decision = ("use", request.get("item"))
+                
+                session.apply_decision(decision)
+                
+                response["state"] = session.state()
+            elif op == "shoot":
+                session = self.get_session(request)
+                
+                target = request.get("target")
+                
+                if not target in ("self", "dealer"):
+                    raise ProtocolError("target must be \"self\" or \"dealer\"")
+                
+                session.apply_decision(("shoot", target))
+                
+                response["state"] = session.state()
+            elif op == "ai_turn":
+                session = self.get_session(request)
+                
+                if self.predictor is None:
+                    raise ProtocolError("server has no predictor")
+                
+                if session.run.is_over():
+                    raise ProtocolError("game is over")
+                
+                await self.queue_ai_turn(session)
+                
+                response["state"] = session.state()
+            elif op == "close":
+                session = self.get_session(request)
+                
+                del self.sessions[session.session_id]
+                
+                if not connection_sessions is None:
+                    connection_sessions.discard(session.session_id)
+            elif op == "stats":
+                response["stats"] = self.stats()
+            else:
+                raise ProtocolError("unknown op " + str(op))
+        except (ProtocolError, NoItemException, InvalidItemException, ValueError, TypeError) as e:
+            response["ok"] = False
+            response["error"] = str(e)
+        
+        return response
+    
+    def stats(self):
+        batch_sizes = list(self.batch_sizes)
+        
+        return {
+            "sessions": len(self.sessions),
+            "dropped_sessions": self.dropped_sessions,
+            "pending_decisions": len(self.pending_decisions),
+            "mean_batch_size": sum(batch_sizes) / len(batch_sizes) if len(batch_sizes) > 0 else 0,
+            "latency": self.latency.summary()
+        }
+    
+    # wait for the batcher to finish the session's ai turn
+    async def queue_ai_turn(self, session):
+        future = asyncio.get_running_loop().create_future()
+        
+        session.busy = True
+        
+        self.pending_decisions.append((session, future))
+        self.pending_event.set()
+        
+        try:
+            await future
+        finally:
+            session.busy = False
+    
+    async def batch_decisions_forever(self):
+        while True:
+            await self.pending_event.wait()
+            
+            # give other sessions a moment to queue up their decisions too
+            await asyncio.sleep(self.batch_interval)
+            
+            self.pending_event.clear()
+            
+            pending = self.pending_decisions[:self.max_batch_size]
+            self.pending_decisions = self.pending_decisions[self.max_batch_size:]
+            
+            if len(self.pending_decisions) > 0:
+                self.pending_event.set()
+            
+            self.decide_pending(pending)
+    
+    # decide for every pending session at once.  sessions whose turn continues (they used an item) are decided again in another batch right away until every turn is over.
+    def decide_pending(self, pending):
+        while len(pending) > 0:
+            pending = [(session, future) for session, future in pending if not future.done()]
+            
+            if len(pending) == 0:
+                break
+            
+            self.batch_sizes.append(len(pending))
+            
+            try:
+                decisions = self.predictor.make_decisions_batch([session.run for session, future in pending])
+            except Exception as e:
+                for session, future in pending:
+                    future.set_exception(e)
+                
+                break
+            
+            still_pending = []
+            
+            for (session, future), decision in zip(pending, decisions):
+                try:
+                    turn_over = session.apply_decision(decision)
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+                
+                if turn_over or session.run.is_over() or not session.run.is_player_turn():
+                    future.set_result(None)
+                else:
+                    still_pending.append((session, future))
+            
+            pending = still_pending
+
+# minimal client for the server's protocol, mostly for load testing and scripting agents
+class GameClient():
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.request_ids = itertools.count(1)
+    
+    @classmethod
+    async def connect_tcp(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        
+        return cls(reader, writer)
+    
+    @classmethod
+    async def connect_unix(cls, path):
+        reader, writer = await asyncio.open_unix_connection(path)
+        
+        return cls(reader, writer)
+    
+    # send one request and wait for its response.  requests on one client are answered in order, so one client should only be used by one coroutine at a time.
+    async def request(self, op, **fields):
+        request = {"id": next(self.request_ids), "op": op}
+        request.update(fields)
+        
+        self.writer.write(json.dumps(request).encode() + b"\n")
+        await self.writer.drain()
+        
+        response = json.loads(await self.reader.readline())
+        
+        if not response["ok"]:
+            raise ProtocolError(response["error"])
+        
+        return response
+    
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+# play a whole game over one client connection.  ai sessions use ai_turn for every player turn, the others play random legal moves like a (bad) human or remote agent would.
+# the session is closed at the end unless close is False, in which case it's left to the server to drop when the client disconnects
+async def play_session(client, use_ai, close=True):
+    state = (await client.request("new"))["state"]
+    session_id = state["session"]
+    
+    while not state["over"]:
+        if use_ai:
+            state = (await client.request("ai_turn", session=session_id))["state"]
+        else:
+            state = (await client.request("shoot", session=session_id, target=random.choice(["self", "dealer"])))["state"]
+    
+    if close:
+        await client.request("close", session=session_id)
+    
+    return state
+
+# starts a server on localhost, plays num_sessions concurrent games against it and prints the server's stats.  every tenth client disconnects without closing its session, and "leaked_sessions" counts the sessions still on the server afterwards (there shouldn't be any)
+async def load_test(num_sessions, ai_fraction, predictor):
+    server = GameServer(predictor=predictor)
+    
+    tcp_server = await server.start_tcp("127.0.0.1", 0)
+    port = tcp_server.sockets[0].getsockname()[1]
+    
+    async def one_session(i):
+        client = await GameClient.connect_tcp("127.0.0.1", port)
+        
+        try:
+            return await play_session(client, use_ai=predictor is not None and random.random() < ai_fraction, close=i % 10 != 0)
+        finally:
+            await client.close()
+    
+    start = time.perf_counter()
+    
+    final_states = await asyncio.gather(*[one_session(i) for i in range(num_sessions)])
+    
+    elapsed = time.perf_counter() - start
+    
+    # the server notices the disconnects on its next read
+    for i in range(100):
+        if len(server.sessions) == 0:
+            break
+        
+        await asyncio.sleep(0.01)
+    
+    stats = server.stats()
+    stats["leaked_sessions"] = len(server.sessions)
+    
+    await server.close()
+    
+    stats["games"] = len(final_states)
+    stats["total_rounds_won"] = sum(state["rounds_won"] for state in final_states)
+    stats["elapsed_s"] = elapsed
+    
+    return stats
+
+# python server.py serve [port | unix:path]   -> serve until interrupted
+# python server.py loadtest [num_sessions]     -> play num_sessions concurrent games against a localhost server and print its stats
+def main(argc, argv):
+    mode = argv[1] if argc > 1 else "serve"
+    
+    try:
+        from cross_entropy import BuckshotPredictor_CrossEntropy
+        predictor = BuckshotPredictor_CrossEntropy()
+    except ImportError:
+        print("torch isn't available, ai_turn will be disabled")
+        predictor = None
+    
+    if mode == "serve":
+        address = argv[2] if argc > 2 else "7777"
+        
+        async def serve():
+            server = GameServer(predictor=predictor)
+            
+            if address.startswith("unix:"):
+                await server.start_unix(address[len("unix:"):])
+            else:
+                await server.start_tcp("127.0.0.1", int(address))
+            
+            print("serving on " + address)
+            
+            await asyncio.Event().wait()
+        
+        asyncio.run(serve())
+    elif mode == "loadtest":
+        num_sessions = int(argv[2]) if argc > 2 else 1000
+        
+        stats = asyncio.run(load_test(num_sessions, 0.5, predictor))
+        
+        print(json.dumps(stats, indent=4))
+    else:
+        print("unknown mode " + mode)
+        return 1
+    
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))
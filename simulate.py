@@ -0,0 +1,339 @@
+### headless batch simulation ###
+# python -m buckshot simulate [options], or python simulate.py [options]
+# plays games with one policy as the player and prints a one line JSON summary (results and throughput) to stdout.  meant for batch jobs, so nothing is interactive and the exit status says how it went:
+    # 0: the games were played
+    # 1: the simulation failed (the error is printed to stderr as JSON)
+    # 2: bad command line arguments
+# only what the chosen policy needs is imported, so torch is never loaded unless the predictor is used.
+# game i is played with seed + i (see policies.play_game), so the same command always plays the same games no matter how many workers there are.
+# --max-matches, --max-rounds, --max-sets and --max-steps cap every game (see buckshot.RunLimits) so strong policies can't make a job run forever.  games that hit a cap are counted as truncated in the summary.
+# --checkpoint PATH saves the job's progress to PATH every so often (see jobs.py), and running the same command again after the job was killed finishes it with the same results as if it never was.  SIGTERM saves before exiting.
+
+import sys
+import json
+import time
+import signal
+import argparse
+
+import buckshot
+import policies
+
+# policy names for --policy.  some take a parameter after a colon, eg ismcts:50 or predictor:predictor.ckpt
+policy_names = ("random", "dealer_logic", "endgame", "ismcts", "predictor")
+policy_usage = "random, dealer_logic, endgame, ismcts[:deadline_ms] or predictor[:checkpoint path]"
+
+# make the policy described by spec for rules.  raises ValueError for unknown policies
+def make_policy(spec, rules):
+    name, _, parameter = spec.partition(":")
+    
+    if name == "random":
+        return policies.RandomPolicy()
+    elif name == "dealer_logic":
+        return policies.DealerLogicPolicy()
+    elif name == "endgame":
+        from endgame import EndgamePolicy, EndgameTable
+        
+        return EndgamePolicy(EndgameTable.cached(rules))
+    elif name == "ismcts":
+        from ismcts import ISMCTSPolicy
+        
+        return ISMCTSPolicy(deadline_ms=float(parameter) if parameter != "" else 100)
+    elif name == "predictor":
+        import torch
+        
+        # one thread per worker process, the workers are the parallelism
+        torch.set_num_threads(1)
+        
+        if parameter != "":
+            from checkpoint import load_predictor
+            
+            predictor, extra = load_predictor(parameter, rules)
+        else:
+            from cross_entropy import BuckshotPredictor_CrossEntropy
+            
+            # fixed initialization, so every worker plays with the same untrained predictor
+            torch.manual_seed(0)
+            
+            predictor = BuckshotPredictor_CrossEntropy(rules)
+        
+        return policies.PredictorPolicy(predictor)
+    else:
+        raise ValueError("unknown policy " + spec + ", expected " + policy_usage)
+
+# raises ValueError if spec isn't a policy make_policy can make, without making it (a checkpoint isn't loaded, so a missing one only shows up when the games start)
+def check_policy(spec):
+    name, _, parameter = spec.partition(":")
+    
+    if not name in policy_names:
+        raise ValueError("unknown policy " + spec + ", expected " + policy_usage)
+    
+    if name == "ismcts" and parameter != "":
+        try:
+            float(parameter)
+        except ValueError:
+            raise ValueError("ismcts takes a deadline in milliseconds, not " + parameter)
+
+# whether a rule value parsed from JSON has the type of the rule's default.  item_limits is a dict of item name -> int
+def _rule_type_matches(value, default):
+    if isinstance(default, dict):
+        return isinstance(value, dict) and all(type(limit) is int for limit in value.values())
+    
+    return type(value) is type(default)
+
+# the rules with overrides applied.  overrides are "name=value" strings, and values are parsed as JSON (so numbers are numbers) and have to have the type of the rule's default
+def make_rules(overrides):
+    defaults = buckshot.default_rules.as_dict()
+    parameters = dict()
+    
+    for override in overrides:
+        name, equals, value = override.partition("=")
+        name = name.strip()
+        
+        if equals == "":
+            raise ValueError("rule overrides look like name=value, not " + override)
+        
+        # the behaviors are functions
+        if name == "item_behaviors":
+            raise ValueError("item_behaviors can't be overridden from the command line")
+        
+        try:
+            parameters[name] = json.loads(value)
+        except json.JSONDecodeError:
+            raise ValueError("bad value for rule " + name + ": " + value)
+        
+        if name in defaults and not _rule_type_matches(parameters[name], defaults[name]):
+            raise ValueError("rule {} takes {}, not {}".format(name, "a JSON object of item name -> int" if isinstance(defaults[name], dict) else type(defaults[name]).__name__, value))
+    
+    return buckshot.default_rules.with_overrides(**parameters)
+
+## worker processes ##
+
+_worker_policy = None
+_worker_rules = None
+_worker_limits = None
+_worker_common_random = False
+
+def _init_worker(spec, rules, limits, common_random):
+    global _worker_policy, _worker_rules, _worker_limits, _worker_common_random
+    
+    _worker_rules = rules
+    _worker_limits = limits
+    _worker_common_random = common_random
+    _worker_policy = make_policy(spec, rules)
+
+def _play_block(start_seed, num_seeds):
+    return [policies.play_game(_worker_policy, seed, _worker_rules, _worker_limits, with_status=True, common_random=_worker_common_random) for seed in range(start_seed, start_seed + num_seeds)]
+
+# play games with seeds seed to seed + num_games - 1, each capped at limits (a buckshot.RunLimits, or None for no caps) and with common random numbers if common_random is set (see policies.play_game).  returns the list of (rounds won, sets won, status) and the policy's hash
+# if checkpoint is a path, progress is saved there whenever checkpointer (a jobs.Checkpointer, a default one if None) says it's due and when the simulation is interrupted, and a simulation that was already under way there is resumed.  on_resume(games done) is called with the number of games it resumed with if given.
+def simulate(spec, num_games, workers=1, seed=0, rules=None, limits=None, common_random=False, checkpoint=None, checkpointer=None, on_resume=None):
+    if rules is None:
+        rules = buckshot.default_rules
+    
+    if not checkpoint is None:
+        return _simulate_resumable(spec, num_games, workers, seed, rules, limits, common_random, checkpoint, checkpointer, on_resume)
+    
+    if workers <= 1:
+        _init_worker(spec, rules, limits, common_random)
+        
+        return _play_block(seed, num_games), _worker_policy.policy_hash()
+    
+    import concurrent.futures
+    
+    # a few blocks per worker, so one slow block doesn't leave the others idle at the end
+    block_size = max(1, -(-num_games // (workers * 4)))
+    starts = list(range(seed, seed + num_games, block_size))
+    sizes = [min(block_size, seed + num_games - start) for start in starts]
+    
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(spec, rules, limits, common_random)) as pool:
+        blocks = list(pool.map(_play_block, starts, sizes))
+    
+    return [result for block in blocks for result in block], make_policy(spec, rules).policy_hash()
+
+# games per block of a resumable simulation.  it's part of what a checkpoint describes, so it doesn't depend on the number of workers and a job can resume with a different number
+checkpoint_block_size = 100
+
+def _simulate_resumable(spec, num_games, workers, seed, rules, limits, common_random, checkpoint, checkpointer, on_resume):
+    import jobs
+    
+    policy_hash = make_policy(spec, rules).policy_hash()
+    
+    description = {
+        "policy": spec,
+        "policy_hash": policy_hash,
+        "seed": seed,
+        "rules_fingerprint": rules.fingerprint(),
+        "limits": None if limits is None else limits.as_dict(),
+        "common_random": common_random
+    }
+    
+    progress = jobs.SimulationProgress.load_or_new(checkpoint, description, num_games, checkpoint_block_size)
+    
+    if checkpointer is None:
+        checkpointer = jobs.Checkpointer()
+    
+    if not on_resume is None:
+        on_resume(progress.games_done())
+    
+    def write():
+        progress.save(checkpoint)
+    
+    remaining = progress.remaining_blocks()
+    
+    try:
+        if workers <= 1:
+            _init_worker(spec, rules, limits, common_random)
+            
+            for block in remaining:
+                start, size = progress.block_range(block)
+                
+                progress.record_block(block, _play_block(seed + start, size))
+                
+                if checkpointer.due():
+                    checkpointer.save(write)
+        else:
+            import concurrent.futures
+            
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(spec, rules, limits, common_random)) as pool:
+                futures = dict()
+                
+                for block in remaining:
+                    start, size = progress.block_range(block)
+                    
+                    futures[pool.submit(_play_block, seed + start, size)] = block
+                
+                try:
+                    # blocks are stored by position, so the order they finish in doesn't matter
+                    for future in concurrent.futures.as_completed(futures):
+                        progress.record_block(futures[future], future.result())
+                        
+                        if checkpointer.due():
+                            checkpointer.save(write)
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    
+                    raise
+    finally:
+        # on the way out too, so an interrupted simulation keeps every block that finished
+        checkpointer.save(write)
+    
+    return progress.results(), policy_hash
+
+def _describe(values):
+    mean = sum(values) / len(values)
+    variance = sum((value - mean) ** 2 for value in values) / max(1, len(values) - 1)
+    
+    histogram = dict()
+    
+    for value in values:
+        histogram[str(value)] = histogram.get(str(value), 0) + 1
+    
+    return {
+        "mean": mean,
+        "stdev": variance ** 0.5,
+        "min": min(values),
+        "max": max(values),
+        "histogram": dict(sorted(histogram.items(), key=lambda entry: int(entry[0])))
+    }
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(prog="python -m buckshot simulate", description="play games with a policy and print a JSON summary")
+    
+    parser.add_argument("--policy", default="random", help=policy_usage + " (default random)")
+    parser.add_argument("--games", type=int, default=1000, help="number of games (default 1000)")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes (default 1)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first game (default 0)")
+    parser.add_argument("--rule", action="append", default=[], metavar="NAME=VALUE", help="override a rule, eg --rule max_health=6.  can be repeated")
+    parser.add_argument("--max-matches", type=int, default=None, metavar="N", help="stop a game once the player has won N matches")
+    parser.add_argument("--max-rounds", type=int, default=None, metavar="N", help="stop a game once the player has won N rounds")
+    parser.add_argument("--max-sets", type=int, default=None, metavar="N", help="stop a game once the player has won N sets")
+    parser.add_argument("--max-steps", type=int, default=None, metavar="N", help="stop a game after N shots")
+    parser.add_argument("--common-random", action="store_true", help="draw each kind of random event from its own stream, so runs of different policies with the same --seed are directly comparable")
+    parser.add_argument("--output", default=None, metavar="PATH", help="also write the summary with every game's result to PATH")
+    parser.add_argument("--checkpoint", default=None, metavar="PATH", help="save progress to PATH as the games are played, and resume from it if it's there")
+    parser.add_argument("--checkpoint-interval", type=float, default=60.0, metavar="SECONDS", help="seconds between checkpoints (default 60).  saves are spaced out further if they'd take more than 2%% of the time")
+    
+    return parser.parse_args(argv)
+
+# argv is the arguments after "simulate".  returns the exit status
+def main(argc, argv):
+    arguments = parse_arguments(argv[1:argc])
+    
+    if arguments.games < 1 or arguments.workers < 1:
+        print(json.dumps({"status": "error", "error": "--games and --workers must be at least 1"}), file=sys.stderr)
+        
+        return 2
+    
+    try:
+        rules = make_rules(arguments.rule)
+        limits = buckshot.RunLimits(arguments.max_matches, arguments.max_rounds, arguments.max_sets, arguments.max_steps)
+        
+        check_policy(arguments.policy)
+    except ValueError as e:
+        print(json.dumps({"status": "error", "error": str(e)}), file=sys.stderr)
+        
+        return 2
+    
+    checkpointer = None
+    resumed_games = 0
+    
+    if not arguments.checkpoint is None:
+        import jobs
+        
+        checkpointer = jobs.Checkpointer(arguments.checkpoint_interval)
+        
+        # a job being preempted usually gets SIGTERM first.  exiting through SystemExit lets simulate save on the way out
+        signal.signal(signal.SIGTERM, lambda signal_number, frame: sys.exit(128 + signal_number))
+    
+    def on_resume(games_done):
+        nonlocal resumed_games
+        
+        resumed_games = games_done
+    
+    start = time.perf_counter()
+    
+    try:
+        results, policy_hash = simulate(arguments.policy, arguments.games, arguments.workers, arguments.seed, rules, limits, arguments.common_random, arguments.checkpoint, checkpointer, on_resume)
+    except Exception as e:
+        print(json.dumps({"status": "error", "error": type(e).__name__ + ": " + str(e)}), file=sys.stderr)
+        
+        return 1
+    
+    elapsed = time.perf_counter() - start
+    
+    rule_values = rules.as_dict()
+    del rule_values["item_behaviors"]
+    
+    summary = {
+        "status": "ok",
+        "policy": arguments.policy,
+        "policy_hash": policy_hash,
+        "games": arguments.games,
+        "seed": arguments.seed,
+        "workers": arguments.workers,
+        "rules": rule_values,
+        "rules_fingerprint": rules.fingerprint(),
+        "limits": limits.as_dict(),
+        "common_random": arguments.common_random,
+        "truncated": sum(1 for rounds, sets, status in results if status == "truncated"),
+        "rounds_won": _describe([rounds for rounds, sets, status in results]),
+        "sets_won": _describe([sets for rounds, sets, status in results]),
+        "elapsed_seconds": elapsed,
+        "games_per_second": (arguments.games - resumed_games) / elapsed
+    }
+    
+    if not arguments.checkpoint is None:
+        summary["resumed_games"] = resumed_games
+        summary["checkpoint_overhead"] = checkpointer.overhead()
+    
+    print(json.dumps(summary))
+    
+    if not arguments.output is None:
+        with open(arguments.output, "w") as f:
+            json.dump(dict(summary, results=[list(result) for result in results]), f)
+    
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))
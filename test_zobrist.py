@@ -0,0 +1,109 @@
+### tests for the incremental state hash ###
+# python -m pytest test_zobrist.py
+# every test plays seeded games, so failures are reproducible.
+
+import random
+
+import buckshot
+from buckshot import BuckshotRun, RoundResetException, NoItemException, InvalidItemException
+from zobrist import compute_state_hash
+
+# one random action for whoever has the turn, like zobrist.main
+def play_random_step(run, rng):
+    try:
+        if run.is_player_turn():
+            items = run.player.inventory.as_list()
+            
+            if len(items) > 0 and rng.random() < 0.5:
+                item_name = rng.choice(items)
+                
+                if item_name == "adrenaline":
+                    steal_items = run.dealer.inventory.as_list()
+                    
+                    if len(steal_items) > 0:
+                        run.use_adrenaline(rng.choice(steal_items))
+                else:
+                    run.use_item(item_name)
+            else:
+                run.shoot(shooting_self=rng.random() < 0.5)
+        else:
+            run.dealer_ai_turn()
+    except (RoundResetException, NoItemException, InvalidItemException):
+        pass
+
+def assert_hashes_match(run):
+    for seat_id in (None, run.player_id, run.dealer_id):
+        assert run.get_state_hash(seat_id) == compute_state_hash(run, seat_id)
+
+def test_incremental_hash_matches_from_scratch():
+    rng = random.Random(0)
+    
+    for seed in range(200):
+        run = BuckshotRun(logging=False, stream_seed=seed)
+        
+        while not run.is_over():
+            assert_hashes_match(run)
+            play_random_step(run, rng)
+        
+        assert_hashes_match(run)
+
+def test_bytes_round_trip_keeps_hash():
+    rng = random.Random(1)
+    
+    for seed in range(50):
+        run = BuckshotRun(logging=False, stream_seed=seed)
+        
+        while not run.is_over():
+            copy = BuckshotRun.from_bytes(run.to_bytes())
+            
+            assert copy.get_state_hash() == run.get_state_hash()
+            assert_hashes_match(copy)
+            
+            play_random_step(run, rng)
+
+def test_from_state_hash_matches_from_scratch():
+    run = BuckshotRun.from_state(
+        [buckshot.live_token, buckshot.blank_token, buckshot.live_token],
+        3,
+        2,
+        player_max_health=4,
+        player_items=["beer", "cigs"],
+        dealer_items=["handsaw", "cigs", "cigs"],
+        player_bugged_counts={"cigs": -1, "beer": 1},
+        dealer_item_array=["cigs"],
+        current_round=2,
+        current_set=3,
+        matches_won=1,
+        sets_won=7
+    )
+    
+    assert_hashes_match(run)
+
+# each of these changes how the game goes on, so it has to change the full hash
+def test_hash_covers_position_bugged_counts_and_dealer_memory():
+    run = BuckshotRun(logging=False, stream_seed=0)
+    
+    changes = [
+        lambda run: setattr(run, "current_set", run.current_set + 1),
+        lambda run: setattr(run, "current_round", run.current_round % run.rules.rounds_per_match + 1),
+        lambda run: setattr(run, "matches_won", run.matches_won + 1),
+        lambda run: run.player.set_bugged_count("cigs", run.player.item_counts_for_bugged_limits["cigs"] - 1),
+        lambda run: setattr(run.dealer, "dealer_target", "player"),
+        lambda run: setattr(run.dealer, "known_shell", buckshot.live_token),
+        lambda run: setattr(run.dealer, "dealer_knows_shell", True),
+        lambda run: setattr(run.dealer, "item_array_dealer", run.dealer.item_array_dealer + ["cigs"])
+    ]
+    
+    for change in changes:
+        changed = BuckshotRun.from_bytes(run.to_bytes())
+        change(changed)
+        
+        assert changed.get_state_hash() != run.get_state_hash()
+        assert_hashes_match(changed)
+    
+    # the dealer's memory is his alone
+    changed = BuckshotRun.from_bytes(run.to_bytes())
+    changed.dealer.dealer_target = "player"
+    
+    assert changed.get_state_hash(run.player_id) == run.get_state_hash(run.player_id)
+    assert changed.get_state_hash(run.dealer_id) != run.get_state_hash(run.dealer_id)
@@ -0,0 +1,253 @@
+### round-robin tournaments ###
+# every policy plays the same blocks of seeds as the player against the dealer, so each seed is a head-to-head comparison between every pair of policies.
+# results are cached in a JSON file keyed by (policy hash, rules fingerprint, seed block).  a policy is only re-evaluated on the blocks it doesn't have results for yet, so adding one new checkpoint to a nightly comparison only plays that checkpoint's games.
+# ratings are Bradley-Terry strengths fit to the head-to-head comparisons, reported on the Elo scale.  on each seed the policy that won more rounds (or survived more sets if rounds are tied) wins, and a complete tie counts as half a win for each.
+
+import os
+import sys
+import json
+import math
+import time
+import concurrent.futures
+
+import buckshot
+import policies
+
+## worker processes ##
+
+_worker_policies = None
+_worker_rules = None
+
+def _init_worker(policies_by_name, rules):
+    global _worker_policies, _worker_rules
+    
+    _worker_policies = policies_by_name
+    _worker_rules = rules
+
+def _play_block(name, start_seed, num_seeds):
+    policy = _worker_policies[name]
+    
+    return [policies.play_game(policy, seed, _worker_rules) for seed in range(start_seed, start_seed + num_seeds)]
+
+## results cache ##
+
+class ResultsCache():
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = dict()
+        
+        if not path is None and os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+    
+    @staticmethod
+    def key(policy_hash, rules, start_seed, num_seeds):
+        return policy_hash + "|" + rules.fingerprint() + "|" + str(start_seed) + "+" + str(num_seeds)
+    
+    def get(self, key):
+        entry = self.entries.get(key)
+        
+        if entry is None:
+            return None
+        
+        return [tuple(result) for result in entry]
+    
+    def put(self, key, results):
+        self.entries[key] = [list(result) for result in results]
+    
+    # write to a temporary file and rename it over the old one, so an interrupted save never leaves a broken cache behind
+    def save(self):
+        if self.path is None:
+            return
+        
+        temp_path = self.path + ".tmp"
+        
+        with open(temp_path, "w") as f:
+            json.dump(self.entries, f)
+        
+        os.replace(temp_path, self.path)
+
+## ratings ##
+
+# number of head-to-head wins on shared seeds.  wins[a][b] is how many seeds a beat b on, with ties counting as half.
+def pairwise_wins(results_by_name):
+    names = list(results_by_name)
+    wins = {a: {b: 0.0 for b in names if b != a} for a in names}
+    
+    for i, a in enumerate(names):
+        for b in names[i + 1:]:
+            for result_a, result_b in zip(results_by_name[a], results_by_name[b]):
+                if result_a > result_b:
+                    wins[a][b] += 1
+                elif result_b > result_a:
+                    wins[b][a] += 1
+                else:
+                    wins[a][b] += 0.5
+                    wins[b][a] += 0.5
+    
+    return wins
+
+# fit Bradley-Terry strengths with the standard minorization-maximization updates and convert them to Elo ratings (mean 1500).
+# prior_games adds that many virtual tied games between every pair so a policy that wins (or loses) every comparison still gets a finite rating.
+def bradley_terry_elo(wins, prior_games=1.0, iterations=10000, tolerance=1e-10):
+    names = list(wins)
+    
+    if len(names) < 2:
+        return {name: 1500.0 for name in names}
+    
+    total_wins = {a: sum(wins[a].values()) + prior_games * 0.5 * (len(names) - 1) for a in names}
+    games = {a: {b: wins[a][b] + wins[b][a] + prior_games for b in names if b != a} for a in names}
+    
+    strengths = {name: 1.0 for name in names}
+    
+    for iteration in range(iterations):
+        new_strengths = dict()
+        
+        for a in names:
+            denominator = sum(games[a][b] / (strengths[a] + strengths[b]) for b in games[a])
+            new_strengths[a] = total_wins[a] / denominator
+        
+        # normalize so the geometric mean strength is 1
+        log_mean = sum(math.log(strength) for strength in new_strengths.values()) / len(names)
+        new_strengths = {name: strength / math.exp(log_mean) for name, strength in new_strengths.items()}
+        
+        change = max(abs(new_strengths[name] - strengths[name]) for name in names)
+        strengths = new_strengths
+        
+        if change < tolerance:
+            break
+    
+    return {name: 1500.0 + 400.0 * math.log10(strength) for name, strength in strengths.items()}
+
+## tournament ##
+
+class Tournament():
+    # policies_by_name maps a display name to a policy (see policies.py).  every policy must be picklable to be sent to worker processes.
+    # seeds base_seed to base_seed + num_games - 1 are played in blocks of block_size, which is also the granularity of the cache.
+    # workers is the number of worker processes, or 0 to play everything in this process.
+    def __init__(self, policies_by_name, num_games, block_size=100, base_seed=0, rules=None, cache_path=None, workers=None):
+        self.policies = dict(policies_by_name)
+        self.num_games = num_games
+        self.block_size = block_size
+        self.base_seed = base_seed
+        self.rules = buckshot.default_rules if rules is None else rules
+        self.workers = os.cpu_count() if workers is None else workers
+        
+        self.cache = ResultsCache(cache_path)
+        
+        self.games_played = 0
+    
+    def seed_blocks(self):
+        blocks = []
+        
+        for start in range(self.base_seed, self.base_seed + self.num_games, self.block_size):
+            blocks.append((start, min(self.block_size, self.base_seed + self.num_games - start)))
+        
+        return blocks
+    
+    # play every (policy, block) pair that isn't cached yet.  returns {name: [(rounds won, sets won) for each seed]}
+    def run(self):
+        hashes = {name: policy.policy_hash() for name, policy in self.policies.items()}
+        
+        missing = []
+        
+        for name in self.policies:
+            for start, size in self.seed_blocks():
+                key = ResultsCache.key(hashes[name], self.rules, start, size)
+                
+                if self.cache.get(key) is None:
+                    missing.append((name, start, size, key))
+        
+        if len(missing) > 0:
+            if self.workers == 0:
+                _init_worker(self.policies, self.rules)
+                
+                for name, start, size, key in missing:
+                    self.cache.put(key, _play_block(name, start, size))
+            else:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(self.policies, self.rules)) as pool:
+                    futures = {pool.submit(_play_block, name, start, size): key for name, start, size, key in missing}
+                    
+                    for future in concurrent.futures.as_completed(futures):
+                        self.cache.put(futures[future], future.result())
+            
+            self.cache.save()
+            
+            self.games_played += sum(size for name, start, size, key in missing)
+        
+        results = dict()
+        
+        for name in self.policies:
+            results[name] = []
+            
+            for start, size in self.seed_blocks():
+                results[name] += self.cache.get(ResultsCache.key(hashes[name], self.rules, start, size))
+        
+        return results
+    
+    # run the tournament and summarize it, best rated first
+    def standings(self):
+        results = self.run()
+        ratings = bradley_terry_elo(pairwise_wins(results))
+        
+        table = []
+        
+        for name, policy_results in results.items():
+            table.append({
+                "name": name,
+                "policy_hash": self.policies[name].policy_hash(),
+                "games": len(policy_results),
+                "mean_rounds_won": sum(rounds for rounds, sets in policy_results) / len(policy_results),
+                "mean_sets_won": sum(sets for rounds, sets in policy_results) / len(policy_results),
+                "elo": ratings[name]
+            })
+        
+        table.sort(key=lambda row: row["elo"], reverse=True)
+        
+        return table
+
+def print_standings(table):
+    print("name".ljust(24) + "elo".rjust(8) + "rounds/game".rjust(14) + "sets/game".rjust(12) + "games".rjust(8))
+    
+    for row in table:
+        print(row["name"].ljust(24) + "{:.0f}".format(row["elo"]).rjust(8) + "{:.3f}".format(row["mean_rounds_won"]).rjust(14) + "{:.3f}".format(row["mean_sets_won"]).rjust(12) + str(row["games"]).rjust(8))
+
+# python tournament.py [num_games] [workers] [cache_path]
+# compares the dealer's logic, random play, and a freshly initialized predictor if torch is available.
+def main(argc, argv):
+    num_games = int(argv[1]) if argc > 1 else 2000
+    workers = int(argv[2]) if argc > 2 else None
+    cache_path = argv[3] if argc > 3 else "tournament_cache.json"
+    
+    policies_by_name = {
+        "dealer_logic": policies.DealerLogicPolicy(),
+        "random": policies.RandomPolicy()
+    }
+    
+    try:
+        import torch
+        from cross_entropy import BuckshotPredictor_CrossEntropy
+        
+        # fixed initialization so the untrained predictor's hash (and so its cached results) stay the same between runs
+        torch.manual_seed(0)
+        
+        policies_by_name["predictor_init0"] = policies.PredictorPolicy(BuckshotPredictor_CrossEntropy(), name="predictor_init0")
+    except ImportError:
+        pass
+    
+    tournament = Tournament(policies_by_name, num_games, cache_path=cache_path, workers=workers)
+    
+    start = time.perf_counter()
+    
+    table = tournament.standings()
+    
+    elapsed = time.perf_counter() - start
+    
+    print_standings(table)
+    print("")
+    print("played {} new games in {:.2f}s".format(tournament.games_played, elapsed))
+    
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))
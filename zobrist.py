@@ -0,0 +1,217 @@
+### zobrist hashing for buckshot runs ###
+# a BuckshotRun keeps a StateHash that is updated by XOR every time part of the game state changes, so reading the hash of the current state is O(1).
+# the hash is split into a few accumulators so that seat-perspective hashes can leave out things that seat can't see:
+    # public: health, max health, inventories, the bugged item counts (see buckshot.adrenaline_behavior), handcuffs, sawed off, whose turn it is and the match, round and set.  both seats can see all of these.
+    # chamber: the actual order of the shells in the chamber.  only the full hash includes this.
+    # counts: the number of lives and blanks left.  this is implied by the chamber, so only seat hashes include it.
+    # known: one accumulator per seat for what only that seat knows: the shells it knows through items, and for the dealer his memory between turns (dealer_target, known_shell, dealer_knows_shell and the cigs in item_array_dealer).
+# the full hash covers everything that decides how the game goes on, so two runs with the same full hash play on the same way given the same random numbers.  it's meant as a transposition key.  what it leaves out doesn't change the game itself:
+    # sets_won, steps and the truncation state, which are the score and what RunLimits counts.  runs with limits can still be cut short at different points.
+    # the random streams, the limits, the rules, the event subscribers and logging.
+    # the dealer's using_medicine, using_handsaw and main_loop_finished, which are reset at the start of each of his turns.
+# shell positions are counted from the end of the chamber rather than the front.  the front of the chamber is what gets popped, so counting from the end means popping a shell only ever touches the key of that one shell.
+
+import sys
+import random
+import hashlib
+
+# every feature key is a 64 bit number
+hash_bits = 64
+
+_feature_keys = dict()
+
+# get the key for a feature tuple.  keys are derived from a hash of the feature instead of a seeded random generator so that every process (and every run of the program) agrees on them without having to fill a table in a fixed order first.
+def zobrist_key(feature):
+    key = _feature_keys.get(feature)
+    
+    if key is None:
+        digest = hashlib.blake2b(repr(feature).encode(), digest_size=hash_bits // 8).digest()
+        key = int.from_bytes(digest, "little")
+        
+        _feature_keys[feature] = key
+    
+    return key
+
+class StateHash():
+    def __init__(self):
+        self.public = 0
+        self.chamber = 0
+        self.counts = 0
+        self.known = [0, 0]
+    
+    # swap the key of a public feature from its old value to its new one.  None values don't contribute to the hash at all, so a feature going from or to None only toggles one key.
+    def replace(self, name, owner, old_value, new_value):
+        if old_value == new_value:
+            return
+        
+        if not old_value is None:
+            self.public ^= zobrist_key((name, owner, old_value))
+        
+        if not new_value is None:
+            self.public ^= zobrist_key((name, owner, new_value))
+    
+    # pos is the position of the shell counted from the end of the chamber
+    def toggle_shell(self, pos, shell):
+        self.chamber ^= zobrist_key(("shell", pos, shell))
+    
+    # swap the key of a feature only seat_id can see, like StateHash.replace
+    def replace_private(self, seat_id, name, old_value, new_value):
+        if old_value == new_value:
+            return
+        
+        if not old_value is None:
+            self.known[seat_id] ^= zobrist_key((name, seat_id, old_value))
+        
+        if not new_value is None:
+            self.known[seat_id] ^= zobrist_key((name, seat_id, new_value))
+    
+    def toggle_known(self, seat_id, pos, shell):
+        if not shell is None:
+            self.known[seat_id] ^= zobrist_key(("known", seat_id, pos, shell))
+    
+    # counts aren't toggled incrementally like everything else because there's only ever one key for them
+    def set_counts(self, num_live, num_blank):
+        self.counts = zobrist_key(("counts", num_live, num_blank))
+    
+    # hash of the complete game state, including the real order of the chamber
+    def full(self):
+        return self.public ^ self.chamber ^ self.known[0] ^ self.known[1]
+    
+    # hash of the game state as seen by one seat.  this includes the shell counts and the seat's own known sequence, but not the chamber or the other seat's known sequence.
+    def seat_view(self, seat_id):
+        return self.public ^ self.counts ^ self.known[seat_id]
+
+# compute the same hash as the run's StateHash from scratch.  this is slow, and only exists to check the incremental hash against.
+def compute_state_hash(run, seat_id=None):
+    state_hash = StateHash()
+    
+    for participant in (run.player, run.dealer):
+        seat = run.get_id(participant)
+        
+        state_hash.replace("health", seat, None, participant.health)
+        state_hash.replace("max_health", seat, None, participant.current_max_health)
+        
+        for item_name, count in participant.inventory.as_dict().items():
+            if count > 0:
+                state_hash.public ^= zobrist_key(("item", seat, item_name, count))
+        
+        for item_name, count in participant.item_counts_for_bugged_limits.items():
+            if count != 0:
+                state_hash.public ^= zobrist_key(("bugged", seat, item_name, count))
+        
+        num_known = len(participant.known_sequence)
+        
+        for i, shell in enumerate(participant.known_sequence):
+            state_hash.toggle_known(seat, num_known - 1 - i, shell)
+    
+    for i, shell in enumerate(run.chamber):
+        state_hash.toggle_shell(len(run.chamber) - 1 - i, shell)
+    
+    state_hash.set_counts(run.num_live(), run.num_blank())
+    
+    state_hash.replace("turn", None, None, run.whose_turn_id)
+    state_hash.replace("handcuffed", None, None, run.who_handcuffed_id)
+    state_hash.replace("sawed_off", None, None, run.is_sawed_off)
+    state_hash.replace("match", None, None, run.matches_won)
+    state_hash.replace("round", None, None, run.current_round)
+    state_hash.replace("set", None, None, run.current_set)
+    
+    dealer = run.dealer
+    
+    state_hash.replace_private(run.dealer_id, "dealer_target", None, dealer.dealer_target)
+    state_hash.replace_private(run.dealer_id, "known_shell", None, dealer.known_shell)
+    state_hash.replace_private(run.dealer_id, "dealer_knows_shell", None, bool(dealer.dealer_knows_shell))
+    state_hash.replace_private(run.dealer_id, "item_array_cigs", None, dealer.item_array_dealer.count("cigs"))
+    
+    if seat_id is None:
+        return state_hash.full()
+    else:
+        return state_hash.seat_view(seat_id)
+
+# everything the full hash is supposed to capture, as a plain tuple (see the top of the file for what it leaves out).  two states with different canonical tuples but the same hash are a collision.
+def canonical_state(run):
+    dealer = run.dealer
+    
+    return (
+        run.player.health, run.player.current_max_health, tuple(sorted(run.player.inventory.as_list())), tuple(run.player.known_sequence), tuple(sorted(run.player.item_counts_for_bugged_limits.items())),
+        dealer.health, dealer.current_max_health, tuple(sorted(dealer.inventory.as_list())), tuple(dealer.known_sequence), tuple(sorted(dealer.item_counts_for_bugged_limits.items())),
+        dealer.dealer_target, dealer.known_shell, bool(dealer.dealer_knows_shell), dealer.item_array_dealer.count("cigs"),
+        tuple(run.chamber), run.whose_turn_id, run.who_handcuffed_id, run.is_sawed_off, run.matches_won, run.current_round, run.current_set
+    )
+
+# plays games with random actions for both the player and the dealer's ai, checking the incremental hash against the from-scratch hash at every step and counting collisions between distinct states.
+# collisions are also counted for the hash truncated to fewer bits, where they're frequent enough to compare against the birthday bound.
+def main(argc, argv):
+    import buckshot
+    from buckshot import BuckshotRun, RoundResetException, NoItemException, InvalidItemException
+    
+    num_games = int(argv[1]) if argc > 1 else 2000
+    truncated_bits = [20, 24, 28, 32]
+    
+    seen_states = dict()
+    seen_truncated = {bits: dict() for bits in truncated_bits}
+    mismatches = 0
+    
+    def check(run):
+        nonlocal mismatches
+        
+        for seat_id in (None, run.player_id, run.dealer_id):
+            if run.get_state_hash(seat_id) != compute_state_hash(run, seat_id):
+                mismatches += 1
+        
+        state = canonical_state(run)
+        full_hash = run.get_state_hash()
+        
+        seen_states.setdefault(full_hash, set()).add(state)
+        
+        for bits in truncated_bits:
+            seen_truncated[bits].setdefault(full_hash & ((1 << bits) - 1), set()).add(state)
+    
+    for i in range(num_games):
+        run = BuckshotRun(logging=False)
+        
+        while not run.is_over():
+            check(run)
+            
+            try:
+                if run.is_player_turn():
+                    items = run.player.inventory.as_list()
+                    
+                    if len(items) > 0 and random.random() < 0.5:
+                        item_name = random.choice(items)
+                        
+                        if item_name == "adrenaline":
+                            steal_items = run.dealer.inventory.as_list()
+                            
+                            if len(steal_items) > 0:
+                                run.use_adrenaline(random.choice(steal_items))
+                        else:
+                            run.use_item(item_name)
+                    else:
+                        run.shoot(shooting_self=random.random() < 0.5)
+                else:
+                    run.dealer_ai_turn()
+            except (RoundResetException, NoItemException, InvalidItemException):
+                pass
+    
+    num_states = sum(len(states) for states in seen_states.values())
+    full_collisions = sum(len(states) - 1 for states in seen_states.values())
+    
+    print("games: " + str(num_games))
+    print("distinct states: " + str(num_states))
+    print("incremental/from-scratch mismatches: " + str(mismatches))
+    print("collisions at " + str(hash_bits) + " bits: " + str(full_collisions))
+    
+    for bits in truncated_bits:
+        collisions = sum(len(states) - 1 for states in seen_truncated[bits].values())
+        
+        # expected number of states that land in an already occupied bucket
+        buckets = 1 << bits
+        expected = num_states - buckets * (1 - (1 - 1 / buckets) ** num_states)
+        
+        print("collisions at {} bits: {} (expected {:.1f})".format(bits, collisions, expected))
+    
+    return 1 if mismatches > 0 or full_collisions > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))